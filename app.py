@@ -1,26 +1,121 @@
 import os
-import shutil
-from pathlib import Path
+import json
+import base64
+import asyncio
 import datetime
-import random
-import string
+from functools import partial
+from pathlib import Path
 import uvicorn
-from sqlalchemy import or_
+from contextlib import asynccontextmanager
+from sqlalchemy import or_, select
 from typing import Optional
 from pydantic import BaseModel
-from fastapi import FastAPI, Response, Depends, File, UploadFile, Query, responses, Body
+from fastapi import FastAPI, Request, Response, Depends, File, UploadFile, Query, responses, Body
 from fastapi.middleware.cors import CORSMiddleware
 from utils import databaseSchemas as DbSchemas
 from utils import usersManager as DbUsers
 from utils import databaseManager as DbModels
 from utils.databaseSchemas import ResponseModel
 from utils.systemInit import SystemInit
-
-
-app = FastAPI()
+from utils.imageStore import ImageStore, ImageStoreError, etag_matches
+from utils.orderManager import OrderError
+from utils.couponManager import CODE_PATTERN, normalize_code, apply_discount
+from utils.pricing import parse_price_tiers, dump_price_tiers
+from utils.rateLimiter import AdmissionController, AdmissionMiddleware
+from utils.auditLog import AuditLog
+from utils.profiler import SamplingProfiler, ProfilerMiddleware
+from utils.responseCache import ResponseCache
+from utils.exportStream import export_response, order_export_statement, card_export_statement, coupon_export_statement
+from utils.orderArchive import OrderArchive, MIN_HORIZON_DAYS
+from utils.readReplica import ReadYourWritesMiddleware
+from utils.backendMigration import BackendMigration, MigrationError, check_target
+from utils.scheduler import Scheduler, wal_checkpoint, analyze, vacuum
+from utils.metrics import MetricsMiddleware, instrument_engine, monitor_event_loop, registry as metrics_registry
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    应用生命周期: 启动和停止后台任务
+    """
+    await notice_dispatcher.start()
+    await asyncio.to_thread(sync_image_catalogue)
+    await payment_gateway.start()
+    await asyncio.to_thread(coupon_manager.refresh)
+    await audit_log.start()
+    loop_monitor = asyncio.create_task(monitor_event_loop())
+    schema_backfill = asyncio.create_task(system_init.schema_migrator.run_backfills())
+    await scheduler.start()
+    yield
+    await scheduler.stop()
+    schema_backfill.cancel()
+    loop_monitor.cancel()
+    profiler.close()
+    await audit_log.stop()
+    await payment_gateway.stop()
+    if system_init.writer is not None:
+        await asyncio.to_thread(system_init.writer.close)
+    await notice_dispatcher.stop()
+    image_store.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(DbModels.DatabaseSwitching)
+async def database_switching_handler(request: Request, exc: DbModels.DatabaseSwitching):
+    """
+    切换数据库的短暂暂停期间, 在事件循环中访问数据库的请求返回 503, 客户端按 Retry-After 重试
+    """
+    return responses.JSONResponse(status_code=503, headers={"Retry-After": "1"},
+                                  content=ResponseModel(code=503, data={}, msg=str(exc)).dict())
+
+
+# 读写分离: 传入 replica_urls=['postgresql://...replica'] 或 SQLite 副本 'sqlite:///file:database/replica.db?mode=ro&uri=true',
+# 仪表盘、搜索、导出等查询从副本读取, 下单和其它写操作只用主库
 system_init = SystemInit()
 db = system_init.db
 email_manager = system_init.email_manager
+notice_dispatcher = system_init.notice_dispatcher
+order_manager = system_init.order_manager
+payment_registry = system_init.payment_registry
+payment_gateway = system_init.payment_gateway
+sales_counter = system_init.sales_counter
+coupon_manager = system_init.coupon_manager
+audit_log = AuditLog(db)
+app.state.audit_log = audit_log  # 登录/注册事件由 UserManager 通过 request.app.state 记录
+# 每天把一年多以前已结束的订单搬到 database/archive.db, 订单表只保留近期订单
+order_archive = OrderArchive(db)
+# 在线迁移数据库后端, 由 /api/backend/database_migrate 发起, 同一时间只有一个
+backend_migration: Optional[BackendMigration] = None
+# 定时任务: 多进程部署时清理、归档、数据库维护只在持有租约的主节点进程执行, 副本检查和优惠券过滤器刷新每个进程都执行;
+# 同步函数在调度器自己的线程中执行, 不占用请求处理的线程和事件循环
+scheduler = Scheduler(db)
+scheduler.add('order_expire', order_manager.expire_orders, interval=60, jitter=5)
+scheduler.add('sales_flush', sales_counter.flush, interval=5, timeout=60)
+scheduler.add('coupon_refresh', coupon_manager.refresh, interval=30, leader_only=False)
+scheduler.add('sales_reconcile', sales_counter.reconcile, interval=3600, jitter=60, run_at_start=True, timeout=600)
+if db.replicas:
+    scheduler.add('replica_check', db.replicas.check, interval=10, leader_only=False)
+scheduler.add('login_log_purge', audit_log.purge, interval=3600, jitter=60, timeout=600)
+scheduler.add('wal_checkpoint', partial(wal_checkpoint, db), interval=600, jitter=30, timeout=60)
+scheduler.add('order_archive', order_archive.archive_once, cron='30 3 * * *', jitter=300, timeout=3600)
+scheduler.add('image_orphans', lambda: delete_orphan_images(24), cron='0 4 * * *', jitter=300, timeout=600)
+scheduler.add('analyze', partial(analyze, db), cron='30 4 * * *', jitter=300, timeout=600)
+scheduler.add('vacuum', partial(vacuum, db), cron='0 5 * * 0', timeout=3600)
+# 后台列表接口的响应缓存, 写接口按标签失效; 多进程部署时传入 RedisCacheBackend 共享缓存和失效
+response_cache = ResponseCache()
+
+# 慢请求采样: 默认关闭, 由 /api/backend/profiler_update 开启; 放在准入控制里层, 被拒绝的请求不采样
+profiler = SamplingProfiler()
+app.add_middleware(ProfilerMiddleware, profiler=profiler)
+
+# 准入控制: 按 IP/用户限流, 限制同时处理的请求数; 放在 CORS 里层, 被拒绝的响应也带跨域头
+admission = AdmissionController(DbUsers.SECRET)
+app.add_middleware(AdmissionMiddleware, controller=admission)
+
+# 读己之写: 请求头 X-Read-Your-Writes: 1 的请求只读主库, 不受副本复制延迟影响
+app.add_middleware(ReadYourWritesMiddleware)
 
 # 配置 CORS
 origins = [
@@ -34,6 +129,19 @@ app.add_middleware(CORSMiddleware,
                    allow_methods=["*"],
                    allow_headers=["*"])
 
+# 性能指标: 放在最外层, 被限流拒绝的请求和跨域预检也计入; SQL 按引擎统计并归属到发起它的请求
+instrument_engine(db.engine, 'main')
+instrument_engine(DbUsers.engine, 'users')
+app.add_middleware(MetricsMiddleware)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Prometheus 抓取接口, 文本格式; 不含业务数据, 只应在内网开放, 由反向代理屏蔽外部访问
+    """
+    return responses.PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
 
 # 仪表盘
 @app.get("/api/backend/dashboard", tags=["backend"],
@@ -44,8 +152,9 @@ async def get_dashboard():
              "order_statistics": 订单统计, "today_orders": 今日订单, "today_revenue": 今日的收入, "month_orders": 月订单,
               "month_revenue": 月收入, "yesterday_orders": 昨日订单, "yesterday_revenue": 昨日收入,
                "last_month_orders": 上月订单, "last_month_revenue": 上个月收入, "top_5_products": 销量前五名产品}
+    【其它说明】：自动统计销量时热销榜直接读取商品销量, 否则按订单汇总
     """
-    result = db.search_dashboard()
+    result = db.search_dashboard(sales_counter.top() if sales_counter.enabled else None)
     return ResponseModel(code=200, data=result, msg="仪表盘数据获取成功")
 
 
@@ -58,6 +167,7 @@ async def get_dashboard():
 
 @app.get("/api/backend/class_read", tags=["backend"],
          dependencies=[Depends(DbUsers.current_superuser)], summary="获取分类")
+@response_cache.cached('class')
 async def classification_read(skip: Optional[int] = Query(0, description="【默认 0】跳过的记录数"),
                               limit: Optional[int] = Query(10, description="【默认 10】获取的记录数")):
     """
@@ -81,6 +191,7 @@ async def classification_create(cla: DbSchemas.ProdCagCreate):
     if db.search_data(DbModels.ProdCag, DbSchemas.ProdCagResponse, [DbModels.ProdCag.name == cla.name]):
         return ResponseModel(code=500, data={}, msg="分类已存在")
     db.create_data(data)
+    await response_cache.invalidate('class')
     return ResponseModel(code=200, data=data_dict, msg="分类新增成功")
 
 
@@ -90,11 +201,13 @@ async def classification_update(cla: DbSchemas.ProdCagUpdate):
     """
     【输入参数】：参考 Request Body 里的 Schema
     【输出参数】：是否修改成功的结果，成功返回 200，失败返回 500。
+    【其它说明】：修改分类名称时, 该分类下商品的 prod_cag_name 同时改为新名称
     """
     data = dict(cla)
     record = db.update_data(DbModels.ProdCag, data)
     if record is None:
         return ResponseModel(code=500, data={}, msg="分类修改失败, 找不到指定的数据。")
+    await response_cache.invalidate('class', 'product')
     return ResponseModel(code=200, data=data, msg="分类修改成功")
 
 
@@ -104,6 +217,7 @@ async def classification_delete(item_id: int = Query(description="分类的唯
     """
     【输入参数】：参考 Parameters 里的说明
     【输出参数】：是否删除成功的结果，成功返回 200，找不到数据返回 404，失败返回 500。
+    【其它说明】：该分类下的商品不会被删除, 变为未分类
     """
     data = db.read_data(DbModels.ProdCag, item_id)
     if data is None:
@@ -111,6 +225,7 @@ async def classification_delete(item_id: int = Query(description="分类的唯
     record = db.delete_data(DbModels.ProdCag, item_id)
     if record is None:
         return ResponseModel(code=500, data={}, msg="分类删除失败")
+    await response_cache.invalidate('class', 'product')
     return ResponseModel(code=200, data={"id": item_id}, msg="分类删除成功")
 
 
@@ -123,6 +238,7 @@ async def classification_delete(item_id: int = Query(description="分类的唯
 
 @app.get("/api/backend/product_read", tags=["backend"],
          dependencies=[Depends(DbUsers.current_superuser)], summary="获取商品")
+@response_cache.cached('product', ttl=10)
 async def product_read(skip: Optional[int] = Query(0, description="【默认 0】跳过的记录数"),
                        limit: Optional[int] = Query(10, description="【默认 10】获取的记录数"),
                        classify: Optional[str] = Query(None, description="【可选】商品分类名称")):
@@ -130,14 +246,16 @@ async def product_read(skip: Optional[int] = Query(0, description="【默认 0
     【输入参数】：参考 Parameters 里的说明
     【输出参数】：商品信息列表 [{"id": int类型 商品唯一ID, "name": str类型 商品名称, "prod_cag_name": str类型 商品所属分类名称,
         "prod_info": str类型 商品描述, "prod_img_url": str类型 商品图片名称上传图像后会返回图像名称, "prod_discription": str类型 卡密使用教程,
-        "prod_price": float类型 商品价格, "prod_price_wholesale": str类型 批发价, "prod_sales": int类型 销量,
+        "prod_price": float类型 商品价格, "prod_price_wholesale": str类型 批发价展示文字,
+        "prod_price_tiers": str类型 批发阶梯价 JSON [[起购数量, 单价], ...], "prod_sales": int类型 销量,
         "prod_tag": str类型 商品标签, "auto": bool类型 是否自动上架, "sort": int类型 商品排序优先级, "state": bool类型 是否启用}]
     【其它说明】1.购买须知不要，省略这一步。直接跳转付款。2.库存稍后返回
     """
     if classify is None:
         prodinfos = db.read_datas(DbModels.ProdInfo, DbSchemas.ProdInfoResponse, skip, limit)
     else:
-        prodinfos = db.search_filter_page_turning(DbModels.ProdInfo, DbSchemas.ProdInfoResponse, {DbModels.ProdInfo.prod_cag_name == classify}, skip, limit)
+        classify_id = select(DbModels.ProdCag.id).where(DbModels.ProdCag.name == classify).scalar_subquery()
+        prodinfos = db.search_filter_page_turning(DbModels.ProdInfo, DbSchemas.ProdInfoResponse, {DbModels.ProdInfo.prod_cag_id == classify_id}, skip, limit)
     return ResponseModel(code=200, data=prodinfos, msg="商品信息查询成功")
 
 
@@ -147,13 +265,19 @@ async def product_create(cla: DbSchemas.ProdInfoCreate):
     """
     【输入参数】：参考 Request Body 里的 Schema
     【输出参数】：是否新增成功的结果，成功返回 200，失败返回 500
-    【其它说明】：数据暂时全部传嘛，缺字段通不过数据校验
+    【其它说明】：数据暂时全部传嘛，缺字段通不过数据校验; 阶梯价格式不对返回 400
     """
     data_dict = dict(cla)
+    try:
+        data_dict["prod_price_tiers"] = dump_price_tiers(parse_price_tiers(cla.prod_price_tiers))
+    except ValueError as e:
+        return ResponseModel(code=400, data={}, msg=f"阶梯价格式错误: {e}")
     data = DbModels.ProdInfo(**data_dict)
     if db.check_data(DbModels.ProdInfo, [DbModels.ProdInfo.name == cla.name]):
         return ResponseModel(code=500, data={}, msg="商品已存在")
     db.create_data(data)
+    order_manager.invalidate()
+    await response_cache.invalidate('product')
     return ResponseModel(code=200, data=data_dict, msg="商品信息新增成功")
 
 
@@ -163,15 +287,51 @@ async def product_update(cla: DbSchemas.ProdInfoUpdate):
     """
     【输入参数】：参考 Request Body 里的 Schema
     【输出参数】：是否修改成功的结果，成功返回 200，找不到数据返回 404，失败返回 500
-    【其它说明】：数据暂时全部传嘛，缺字段通不过数据校验
+    【其它说明】：数据暂时全部传嘛，缺字段通不过数据校验; 阶梯价格式不对返回 400
     """
     data = dict(cla)
+    try:
+        data["prod_price_tiers"] = dump_price_tiers(parse_price_tiers(cla.prod_price_tiers))
+    except ValueError as e:
+        return ResponseModel(code=400, data={}, msg=f"阶梯价格式错误: {e}")
     record = db.update_data(DbModels.ProdInfo, data)
     if record is None:
         return ResponseModel(code=500, data={}, msg="商品信息修改失败, 找不到指定的数据。")
+    order_manager.invalidate()
+    await response_cache.invalidate('product')
     return ResponseModel(code=200, data=data, msg="商品信息修改成功")
 
 
+@app.patch("/api/backend/product_batch_update", tags=["backend"],
+           dependencies=[Depends(DbUsers.current_superuser)], summary="批量修改商品")
+async def product_batch_update(cla: DbSchemas.ProdInfoBatchUpdate):
+    """
+    【输入参数】：参考 Request Body 里的 Schema, where + values 统一修改筛选出的商品, 或 items 逐个指定新值, 二选一
+    【输出参数】：{"updated": int类型 修改的商品数}, 没有筛选条件或没有要修改的字段返回 400
+    【其它说明】：可修改价格、上架状态、排序和标签; 一个事务内完成, 用于批量改价、整个分类上下架
+    """
+    if cla.items is not None:
+        rows = [dict(item) for item in cla.items]
+        updated = await asyncio.to_thread(db.update_batch_rows, DbModels.ProdInfo, rows)
+    else:
+        where = cla.where or DbSchemas.ProdInfoBatchFilter()
+        values = {key: value for key, value in dict(cla.values or {}).items() if value is not None}
+        filter_params = []
+        if where.prod_cag_name is not None:
+            filter_params.append(DbModels.ProdInfo.prod_cag_id == select(DbModels.ProdCag.id)
+                                 .where(DbModels.ProdCag.name == where.prod_cag_name).scalar_subquery())
+        if where.state is not None:
+            filter_params.append(DbModels.ProdInfo.state == where.state)
+        if where.ids is None and not filter_params:
+            return ResponseModel(code=400, data={}, msg="请指定要修改的商品: ids、prod_cag_name 或 state")
+        if not values:
+            return ResponseModel(code=400, data={}, msg="没有要修改的字段")
+        updated = await asyncio.to_thread(db.update_batch_data, DbModels.ProdInfo, values, filter_params, where.ids)
+    order_manager.invalidate()
+    await response_cache.invalidate('product')
+    return ResponseModel(code=200, data={"updated": updated}, msg="商品批量修改成功")
+
+
 @app.delete("/api/backend/product_delete", tags=["backend"],
             dependencies=[Depends(DbUsers.current_superuser)], summary="删除商品")
 async def product_delete(item_id: int = Query(description="商品的唯一ID")):
@@ -185,6 +345,8 @@ async def product_delete(item_id: int = Query(description="商品的唯一ID")):
     record = db.delete_data(DbModels.ProdInfo, item_id)
     if record is None:
         return ResponseModel(code=500, data={}, msg="商品信息删除失败, 找不到指定的数据。")
+    order_manager.invalidate()
+    await response_cache.invalidate('product')
     return ResponseModel(code=200, data={"id": item_id}, msg="商品信息删除成功")
 
 
@@ -197,6 +359,7 @@ async def product_delete(item_id: int = Query(description="商品的唯一ID")):
 
 @app.get("/api/backend/cami_read", tags=["backend"],
          dependencies=[Depends(DbUsers.current_superuser)], summary="获取卡密列表")
+@response_cache.cached('card', ttl=10)
 async def cami_read(skip: Optional[int] = Query(0, description="【默认 0】跳过的记录数"),
                     limit: Optional[int] = Query(10, description="【默认 10】获取的记录数")):
     """
@@ -219,6 +382,7 @@ async def cami_create(cla: DbSchemas.CardCreate):
     lines = cla.card.splitlines()
     data_list = [DbModels.Card(prod_name=cla.prod_name, card=line, reuse=cla.reuse) for line in lines]
     db.create_batch_data(data_list)
+    await response_cache.invalidate('card')
     return ResponseModel(code=200, data={}, msg="卡密新增成功")
 
 
@@ -234,6 +398,7 @@ async def cami_update(cla: DbSchemas.CardUpdate):
     record = db.update_data(DbModels.Card, data)
     if record is None:
         return ResponseModel(code=500, data={}, msg="卡密修改失败, 找不到指定的数据。")
+    await response_cache.invalidate('card')
     return ResponseModel(code=200, data=data, msg="卡密修改成功")
 
 
@@ -251,6 +416,20 @@ async def cami_search(cardstr: Optional[str] = Query(description="【必填】
     return ResponseModel(code=200, data=camis, msg="卡密搜索成功")
 
 
+@app.get("/api/backend/cami_export", tags=["backend"],
+         dependencies=[Depends(DbUsers.current_superuser)], summary="导出卡密")
+async def cami_export(fmt: str = Query("csv", pattern="^(csv|ndjson)$", description="【默认 csv】导出格式 csv 或 ndjson"),
+                      compress: bool = Query(False, description="【默认 false】是否 gzip 压缩, 压缩后下载 .gz 文件"),
+                      prod_name: Optional[str] = Query(None, description="【可选】商品名称"),
+                      isused: Optional[bool] = Query(None, description="【可选】是否已使用")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：卡密文件 [{"id", "prod_name", "card", "reuse", "isused"}], 按卡密ID顺序
+    """
+    statement = card_export_statement(prod_name, isused)
+    return export_response(db, statement, f"cards-{DbModels.beijing_now():%Y%m%d%H%M%S}", fmt, compress)
+
+
 @app.delete("/api/backend/cami_batch_delete", tags=["backend"],
             dependencies=[Depends(DbUsers.current_superuser)], summary="批量删除卡密")
 async def cami_batch_delete(cla: DbSchemas.CardFilterDelete):
@@ -263,9 +442,31 @@ async def cami_batch_delete(cla: DbSchemas.CardFilterDelete):
         if value is not None:
             dic[key] = value
     db.delete_batch_data(DbModels.Card, dic)
+    await response_cache.invalidate('card')
     return ResponseModel(code=200, data={}, msg="卡密批量删除成功")
 
 
+@app.patch("/api/backend/cami_batch_update", tags=["backend"],
+           dependencies=[Depends(DbUsers.current_superuser)], summary="批量修改卡密")
+async def cami_batch_update(cla: DbSchemas.CardBatchUpdate):
+    """
+    【输入参数】：参考 Request Body 里的 Schema
+    【输出参数】：{"updated": int类型 修改的卡密数}, 没有筛选条件或没有要修改的字段返回 400
+    【其它说明】：可修改是否重复使用、是否已使用, 或整批转给另一个商品; 一条语句完成
+    """
+    where = cla.where
+    values = {key: value for key, value in dict(cla.values).items() if value is not None}
+    filter_params = [getattr(DbModels.Card, key) == value for key, value in dict(where).items()
+                     if key != 'ids' and value is not None]
+    if where.ids is None and not filter_params:
+        return ResponseModel(code=400, data={}, msg="请指定要修改的卡密: ids、prod_name、reuse 或 isused")
+    if not values:
+        return ResponseModel(code=400, data={}, msg="没有要修改的字段")
+    updated = await asyncio.to_thread(db.update_batch_data, DbModels.Card, values, filter_params, where.ids)
+    await response_cache.invalidate('card')
+    return ResponseModel(code=200, data={"updated": updated}, msg="卡密批量修改成功")
+
+
 @app.delete("/api/backend/cami_clear_duplicates", tags=["backend"],
             dependencies=[Depends(DbUsers.current_superuser)], summary="一键卡密去重")
 async def cami_clear_duplicates():
@@ -274,6 +475,7 @@ async def cami_clear_duplicates():
     【输出参数】：是否删除成功的结果，成功返回 200
     """
     db.delete_card_duplicates()
+    await response_cache.invalidate('card')
     return ResponseModel(code=200, data={}, msg="卡密去重成功")
 
 
@@ -290,6 +492,7 @@ async def cami_delete(item_id: int = Query(description="【必填】卡密唯一
     record = db.delete_data(DbModels.Card, item_id)
     if record is None:
         return ResponseModel(code=500, data={}, msg="卡密删除失败, 找不到指定的数据。")
+    await response_cache.invalidate('card')
     return ResponseModel(code=200, data={"id": item_id}, msg="卡密删除成功")
 
 
@@ -300,54 +503,108 @@ async def cami_delete(item_id: int = Query(description="【必填】卡密唯一
 """
 
 
-@app.get("/api/backend/coupon_read", tags=["TodoBackend"],
+@app.get("/api/backend/coupon_read", tags=["backend"],
          dependencies=[Depends(DbUsers.current_superuser)], summary="获取优惠券列表")
-async def coupon_read():
+async def coupon_read(skip: int = Query(0, ge=0, description="【默认 0】跳过的记录数"),
+                      limit: int = Query(10, ge=1, le=100, description="【默认 10】获取的记录数"),
+                      batch: Optional[str] = Query(None, description="【可选】生成批次")):
     """
-    【输入参数】：无
-    【输出参数】：优惠券列表查询成功 返回 200
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：优惠券列表 [{"id": int类型 优惠券唯一ID, "code": str类型 券码, "batch": str类型 生成批次,
+     "discount_type": str类型 amount 立减/percent 百分比, "discount": float类型 立减金额或百分比, "min_amount": float类型 满多少可用,
+     "prod_name": str类型 限定商品, "remaining": int类型 剩余次数, "used": int类型 已用次数, "expires": datetime类型 过期时间,
+     "state": bool类型 是否启用, "updatetime": datetime类型 创建时间}, {...}, ...], 新建的在前
     """
-    return ResponseModel(code=200, data={"data": []}, msg="优惠券查询成功")
+    filter_params = [DbModels.Coupon.batch == batch] if batch is not None else []
+    coupons = db.read_datas(DbModels.Coupon, DbSchemas.CouponResponse, skip, limit, order_by=[DbModels.Coupon.id.desc()],
+                            filter_params=filter_params)
+    return ResponseModel(code=200, data=coupons, msg="优惠券查询成功")
 
 
-@app.post("/api/backend/coupon_create", tags=["TodoBackend"],
+@app.post("/api/backend/coupon_create", tags=["backend"],
           dependencies=[Depends(DbUsers.current_superuser)], summary="新增优惠券")
-async def coupon_create():
+async def coupon_create(cla: DbSchemas.CouponCreate):
     """
-    【输入参数】：无
-    【输出参数】：优惠券新增成功 返回 200
-    """
-    return ResponseModel(code=200, data={}, msg="优惠券新增成功")
-
-
-@app.patch("/api/backend/coupon_update", tags=["TodoBackend"],
+    【输入参数】：参考 Request Body 里的 Schema
+    【输出参数】：{"batch": str类型 批次, "created": int类型 新增个数, "code": str类型 自定义券码(填写时)};
+     券码格式不对、百分比超过 100 返回 400, 券码已存在返回 409
+    【其它说明】：不填 code 时随机生成 count 个 12 位券码, 每 5000 个一个事务写入; 生成后用 coupon_export 按批次下载
+    """
+    terms = {key: value for key, value in dict(cla).items() if key not in ('code', 'count', 'batch')}
+    if cla.discount_type == 'percent' and cla.discount > 100:
+        return ResponseModel(code=400, data={}, msg="百分比不能超过 100")
+    if cla.code is not None:
+        if not CODE_PATTERN.match(normalize_code(cla.code)):
+            return ResponseModel(code=400, data={}, msg="券码应为 4~32 位字母、数字、- 或 _")
+        try:
+            code = await asyncio.to_thread(coupon_manager.create, cla.code, batch=cla.batch, **terms)
+        except ValueError as e:
+            return ResponseModel(code=409, data={}, msg=str(e))
+        return ResponseModel(code=200, data={"batch": cla.batch, "created": 1, "code": code}, msg="优惠券新增成功")
+    result = await asyncio.to_thread(coupon_manager.generate, cla.count, cla.batch, **terms)
+    return ResponseModel(code=200, data=result, msg="优惠券新增成功")
+
+
+@app.patch("/api/backend/coupon_update", tags=["backend"],
            dependencies=[Depends(DbUsers.current_superuser)], summary="修改优惠券")
-async def coupon_update():
+async def coupon_update(cla: DbSchemas.CouponUpdate):
     """
-    【输入参数】：无
-    【输出参数】：优惠券修改成功 返回 200
+    【输入参数】：参考 Request Body 里的 Schema
+    【输出参数】：是否修改成功的结果，成功返回 200，找不到数据返回 404，百分比超过 100 返回 400
+    【其它说明】：不填的字段不修改; 券码不能修改, 需要新券码请新增
     """
-    return ResponseModel(code=200, data={}, msg="优惠券修改成功")
+    data = {key: value for key, value in dict(cla).items() if value is not None}
+    record = db.read_data(DbModels.Coupon, cla.id)
+    if record is None:
+        return ResponseModel(code=404, data={}, msg="找不到数据")
+    if data.get("discount_type", record.discount_type) == 'percent' and data.get("discount", record.discount) > 100:
+        return ResponseModel(code=400, data={}, msg="百分比不能超过 100")
+    db.update_data(DbModels.Coupon, data)
+    return ResponseModel(code=200, data=data, msg="优惠券修改成功")
 
 
-@app.delete("/api/backend/coupon_delete", tags=["TodoBackend"],
+@app.delete("/api/backend/coupon_delete", tags=["backend"],
             dependencies=[Depends(DbUsers.current_superuser)], summary="删除优惠券")
-async def coupon_delete():
+async def coupon_delete(item_id: int = Query(description="【必填】优惠券唯一ID")):
     """
-    【输入参数】：无
-    【输出参数】：优惠券删除成功 返回 200
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：是否删除成功的结果，成功返回 200, 失败返回 500, 找不到数据返回 404
+    【其它说明】：已使用过的订单保留券码记录不受影响
     """
-    return ResponseModel(code=200, data={}, msg="优惠券删除成功")
+    data = db.read_data(DbModels.Coupon, item_id)
+    if data is None:
+        return ResponseModel(code=404, data={}, msg="找不到数据")
+    record = db.delete_data(DbModels.Coupon, item_id)
+    if record is None:
+        return ResponseModel(code=500, data={}, msg="优惠券删除失败, 找不到指定的数据。")
+    return ResponseModel(code=200, data={"id": item_id}, msg="优惠券删除成功")
 
 
-@app.patch("/api/backend/coupon_switch", tags=["TodoBackend"],
+@app.patch("/api/backend/coupon_switch", tags=["backend"],
            dependencies=[Depends(DbUsers.current_superuser)], summary="开关优惠券")
-async def coupon_switch():
+async def coupon_switch(cla: DbSchemas.CouponSwitch):
     """
-    【输入参数】：无
-    【输出参数】：优惠券开关成功 返回 200
+    【输入参数】：参考 Request Body 里的 Schema
+    【输出参数】：是否修改成功的结果，成功返回 200，找不到数据返回 404
+    【其它说明】：停用后立即不能下单使用, 已下单的订单不受影响
+    """
+    record = db.update_data(DbModels.Coupon, {"id": cla.id, "state": cla.state})
+    if record is None:
+        return ResponseModel(code=404, data={}, msg="找不到数据")
+    return ResponseModel(code=200, data={"id": cla.id, "state": cla.state}, msg="优惠券开关成功")
+
+
+@app.get("/api/backend/coupon_export", tags=["backend"],
+         dependencies=[Depends(DbUsers.current_superuser)], summary="导出优惠券")
+async def coupon_export(fmt: str = Query("csv", pattern="^(csv|ndjson)$", description="【默认 csv】导出格式 csv 或 ndjson"),
+                        compress: bool = Query(False, description="【默认 false】是否 gzip 压缩, 压缩后下载 .gz 文件"),
+                        batch: Optional[str] = Query(None, description="【可选】生成批次, 不填时导出全部")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：优惠券文件, 字段同 coupon_read, 按优惠券ID顺序
     """
-    return ResponseModel(code=200, data={}, msg="优惠券开关成功")
+    statement = coupon_export_statement(batch)
+    return export_response(db, statement, f"coupons-{batch or DbModels.beijing_now().strftime('%Y%m%d%H%M%S')}", fmt, compress)
 
 
 """
@@ -376,7 +633,8 @@ async def order_read(skip: Optional[int] = Query(0, description="【可选】跳
           dependencies=[Depends(DbUsers.current_superuser)], summary="搜索订单")
 async def order_search(cla: DbSchemas.OrderSearch,
                        skip: Optional[int] = Query(0, description="【可选】跳过的记录数"),
-                       limit: Optional[int] = Query(10, description="【可选】获取的记录数")):
+                       limit: Optional[int] = Query(10, description="【可选】获取的记录数"),
+                       archive: bool = Query(False, description="【默认 false】是否同时搜索已归档的订单, 归档订单排在后面")):
     """
     【输入参数】：参考 Parameters 里的说明 和 Request Body 的 schema
     【输出参数】：订单列表 [{"id": int类型 订单唯一ID, "status": bool类型 订单状态, "out_order_id": str类型 订单号,
@@ -387,10 +645,130 @@ async def order_search(cla: DbSchemas.OrderSearch,
     filter_params = [or_(DbModels.Order.out_order_id.like(f"%{cla.out_order_id}%"),
                          DbModels.Order.contact.like(f"%{cla.contact}%"),
                          DbModels.Order.card.like(f"%{cla.card}%"))]
+    if archive:
+        orders = await asyncio.to_thread(order_archive.search, DbSchemas.OrderResponse, filter_params, skip, limit)
+        return ResponseModel(code=200, data=orders, msg="订单查询成功")
     orders = db.search_filter_page_turning(DbModels.Order, DbSchemas.OrderResponse, filter_params, skip, limit)
     return ResponseModel(code=200, data=orders, msg="订单查询成功")
 
 
+@app.get("/api/backend/order_export", tags=["backend"],
+         dependencies=[Depends(DbUsers.current_superuser)], summary="导出订单")
+async def order_export(fmt: str = Query("csv", pattern="^(csv|ndjson)$", description="【默认 csv】导出格式 csv 或 ndjson"),
+                       compress: bool = Query(False, description="【默认 false】是否 gzip 压缩, 压缩后下载 .gz 文件"),
+                       start: Optional[datetime.datetime] = Query(None, description="【可选】下单时间起点(含), 如 2024-01-01 00:00:00"),
+                       end: Optional[datetime.datetime] = Query(None, description="【可选】下单时间终点(不含)"),
+                       state: Optional[str] = Query(None, pattern="^(pending|paid|delivered|expired)$",
+                                                    description="【可选】订单状态 pending/paid/delivered/expired"),
+                       name: Optional[str] = Query(None, description="【可选】商品名称"),
+                       archive: bool = Query(False, description="【默认 false】是否同时导出已归档的订单")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：订单文件, 字段同 order_read 另加 state 和 user_id, 按订单ID顺序; 包含归档订单时归档订单接在最后
+    【其它说明】：边查询边下载, 不受订单数量限制, 替代用 order_read 逐页翻页导出
+    """
+    statement = order_export_statement(start, end, state, name)
+    return export_response(db, statement, f"orders-{DbModels.beijing_now():%Y%m%d%H%M%S}", fmt, compress,
+                           archive=order_archive.archive if archive else None)
+
+
+@app.get("/api/backend/schema_status", tags=["backend"],
+         dependencies=[Depends(DbUsers.current_superuser)], summary="数据库结构版本")
+async def schema_status():
+    """
+    【输入参数】：无
+    【输出参数】：{"version": 之前版本全部完成的最高版本, "latest": 最新版本, "pending": [未完成的版本], "pending_names": [未完成的迁移],
+               "backfilling": [本进程正在回填的版本], "applied_after_pending": [未完成版本之后已完成的版本],
+               "backfill_progress": {回填步骤: 已处理行数}, "steps": [本次启动执行的每一步及耗时]}
+    【其它说明】：已有数据库启动时先执行结构变更, 数据回填在后台分批执行, 完成后版本才会更新
+    """
+    return ResponseModel(code=200, data=system_init.schema_migrator.stats(), msg="数据库结构版本获取成功")
+
+
+@app.get("/api/backend/scheduler_status", tags=["backend"],
+         dependencies=[Depends(DbUsers.current_superuser)], summary="定时任务状态")
+async def scheduler_status():
+    """
+    【输入参数】：无
+    【输出参数】：{"leader": 本进程是否为主节点, "owner": 本进程的租约标识, "jobs": [{"name": 任务名称, "schedule": 执行周期,
+               "leader_only": 是否只在主节点执行, "running": 是否正在执行, "runs": 执行次数, "failures": 失败次数,
+               "timeouts": 超时次数, "skipped": 上次未结束而跳过的次数, "last_start": 上次开始时间, "last_seconds": 上次耗时,
+               "last_result": 上次结果, "last_error": 上次错误, "next_run": 下次执行时间}]}
+    【其它说明】：多进程部署时每个进程各自返回, 主节点任务只在 leader 为 true 的进程中有执行记录
+    """
+    return ResponseModel(code=200, data=scheduler.stats(), msg="定时任务状态获取成功")
+
+
+@app.get("/api/backend/replica_status", tags=["backend"],
+         dependencies=[Depends(DbUsers.current_superuser)], summary="只读副本状态")
+async def replica_status():
+    """
+    【输入参数】：无
+    【输出参数】：{"replica_reads": 从副本读取次数, "primary_reads": 未配置副本时读主库次数, "pinned_reads": 读己之写读主库次数,
+               "fallbacks": 副本都不可用时回退主库次数, "replicas": [各副本的地址、是否健康、复制延迟、读取次数、失败次数]}
+    """
+    return ResponseModel(code=200, data=db.replicas.stats(), msg="只读副本状态获取成功")
+
+
+@app.post("/api/backend/database_migrate", tags=["backend"],
+          dependencies=[Depends(DbUsers.current_superuser)], summary="在线迁移数据库")
+async def database_migrate(target_url: str = Body(..., embed=True,
+                                                  description="目标数据库地址, 如 sqlite:////data/database.db")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：迁移已开始 返回 200, 进度通过 GET 同一地址查看
+    【其它说明】：迁移期间网站照常读写: 先在目标库建表并双写, 再分批复制全部数据, 最后短暂暂停后切换到目标库;
+               切换前任何一步出错都继续使用原数据库。用户表切换后仍同步到目标库, 需把 usersManager.DATABASE_URL
+               改为目标库后重启。目前只支持迁到另一个 SQLite 库, 其它数据库返回 400
+    """
+    global backend_migration
+    try:
+        check_target(target_url)
+    except MigrationError as e:
+        return ResponseModel(code=400, data={}, msg=str(e))
+    if backend_migration is not None and backend_migration.state not in ('done', 'aborted', 'failed'):
+        return ResponseModel(code=409, data=backend_migration.stats(), msg="已有迁移正在进行")
+    # 用户表在同一个库中, 由 usersManager 的异步引擎读写, 一起复制和双写
+    backend_migration = BackendMigration(db, target_url, extra_tables=[DbUsers.User.__table__],
+                                         extra_engines=[DbUsers.engine.sync_engine])
+
+    async def migrate(migration):
+        try:
+            await asyncio.to_thread(migration.run)
+        except Exception as e:
+            print(f"数据库迁移失败: {e!r}")
+            return
+        instrument_engine(db.engine, 'main')
+    asyncio.create_task(migrate(backend_migration))
+    return ResponseModel(code=200, data={"target": target_url.split('@')[-1]}, msg="数据库迁移已开始")
+
+
+@app.get("/api/backend/database_migrate", tags=["backend"],
+         dependencies=[Depends(DbUsers.current_superuser)], summary="数据库迁移进度")
+async def database_migrate_status():
+    """
+    【输入参数】：无
+    【输出参数】：{"state": idle/dual_write/copying/cutover/done/aborted/failed, "progress": {表名: 已复制行数},
+               "pending": 待同步的写入批数, "pause_seconds": 切换时暂停的秒数, "error": 出错原因}
+    """
+    if backend_migration is None:
+        return ResponseModel(code=404, data={}, msg="没有进行过迁移")
+    return ResponseModel(code=200, data=backend_migration.stats(), msg="数据库迁移进度获取成功")
+
+
+@app.post("/api/backend/order_archive", tags=["backend"],
+          dependencies=[Depends(DbUsers.current_superuser)], summary="归档旧订单")
+async def order_archive_run(horizon_days: Optional[int] = Query(None, ge=MIN_HORIZON_DAYS,
+                                                                description=f"【可选】归档多少天以前的订单, 不小于 {MIN_HORIZON_DAYS}")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：{"archived": int类型 本次归档条数, "stats": 累计归档条数、批数、上次归档时间和耗时}
+    【其它说明】：只归档已发货和已过期的订单; 后台每天自动归档一次, 此接口用于立即执行
+    """
+    archived = await asyncio.to_thread(order_archive.archive_once, horizon_days)
+    return ResponseModel(code=200, data={"archived": archived, "stats": order_archive.stats()}, msg="订单归档完成")
+
+
 @app.delete("/api/backend/order_delete", tags=["backend"],
             dependencies=[Depends(DbUsers.current_superuser)], summary="删除订单")
 async def order_delete(item_id: int = Query(description="【必填】订单ID")):
@@ -418,6 +796,20 @@ async def order_delete_all():
     return ResponseModel(code=200, data={}, msg="所有未完成订单删除成功")
 
 
+@app.patch("/api/backend/order_deliver", tags=["backend"],
+           dependencies=[Depends(DbUsers.current_superuser)], summary="手工发货")
+async def order_deliver(out_order_id: str = Query(description="【必填】订单号"),
+                        card: str = Body(description="【必填】发给用户的卡密内容")):
+    """
+    【输入参数】：参考 Parameters 里的说明 和 Request Body
+    【输出参数】：是否发货成功的结果，成功返回 200, 订单不是已支付状态返回 409
+    """
+    result = await asyncio.to_thread(order_manager.deliver, out_order_id, card)
+    if result is None:
+        return ResponseModel(code=409, data={"out_order_id": out_order_id}, msg="订单不是已支付状态")
+    return ResponseModel(code=200, data=result, msg="订单发货成功")
+
+
 """
 ========================================
 用户管理
@@ -483,12 +875,46 @@ async def user_delete(cla: DbUsers.UserID):
 
 UPLOAD_DIR = "drawingbed"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+image_store = ImageStore(UPLOAD_DIR)
+
 
+def image_response(request: Request, filename: str, variant: Optional[str]):
+    """
+    发送图像文件, 带 ETag/Cache-Control, 支持 If-None-Match 和 Range
+    """
+    file_location, headers = image_store.resolve(filename, variant)
+    if file_location is None:
+        return ResponseModel(code=404, data={"filename": filename}, msg="找不到文件")
+    if etag_matches(request.headers.get("if-none-match"), headers.get("etag")):
+        return Response(status_code=304, headers=headers)
+    return responses.FileResponse(file_location, headers=headers)
 
-def generate_random_filename(extension: str) -> str:
-    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    random_str = ''.join(random.choices(string.ascii_letters + string.digits, k=6))
-    return f"{timestamp}_{random_str}.{extension}"
+
+def sync_image_catalogue():
+    """
+    把图床目录中尚未建立索引的图像写入 ImageInfo, 启动时执行一次
+    """
+    known_names = [record.name for record in db.get_all_records(DbModels.ImageInfo)]
+    infos = image_store.scan(known_names)
+    if infos:
+        db.create_batch_data([image_info_record(info) for info in infos])
+        print(f"图床索引补建 {len(infos)} 张图像")
+
+
+def image_info_record(info: dict):
+    return DbModels.ImageInfo(name=info["filename"], hash=info["hash"], size=info["size"], mime=info["mime"],
+                              width=info["width"], height=info["height"])
+
+
+def image_records(page: dict):
+    """
+    给分页结果中的每张图像加上文件位置和引用它的商品
+    """
+    images = page["records"]
+    products = db.search_image_products([image.name for image in images])
+    records = [dict(image.dict(), filename=image.name, file_location=Path(UPLOAD_DIR) / image.name,
+                    products=products[image.name]) for image in images]
+    return {"records": records, "pager": page["pager"]}
 
 
 @app.get("/api/backend/drawingbed_read", tags=["backend"],
@@ -497,34 +923,69 @@ async def drawingbed_read(skip: Optional[int] = Query(0, description="【可选
                           limit: Optional[int] = Query(10, description="【可选】获取的记录数")):
     """
     【输入参数】：参考 Parameters 里的说明
-    【输出参数】：图像名称列表 [{"filename": str类型 图像名称, "file_location": str类型 图像位置}, {...}, ...]
+    【输出参数】：按上传时间倒序的图像列表 [{"filename": str类型 图像名称, "file_location": str类型 图像位置, "hash": str类型 内容哈希,
+     "size": int类型 字节数, "mime": str类型 图像类型, "width": int类型 宽, "height": int类型 高, "updatetime": datetime类型 上传时间,
+     "products": list类型 引用该图像的商品名称}, {...}, ...]
     """
-    files = list(Path(UPLOAD_DIR).iterdir())
-    total_files = len(files)
-    start = skip * limit
-    end = start + limit
-    files_on_page = files[start:end]
-    file_names = [file.name for file in files_on_page]
-    data = []
-    for file_name in file_names:
-        file_location = Path(UPLOAD_DIR) / file_name
-        data.append({"filename": file_name, "file_location": file_location})
-    res_data = {"records": data, "pager": {"page": skip, "pageSize": limit, "total": total_files}}
-    return ResponseModel(code=200, data=res_data, msg="图像查询成功")
+    page = db.read_datas(DbModels.ImageInfo, DbSchemas.ImageInfoResponse, skip, limit,
+                         order_by=[DbModels.ImageInfo.updatetime.desc(), DbModels.ImageInfo.id.desc()])
+    return ResponseModel(code=200, data=image_records(page), msg="图像查询成功")
+
+
+@app.get("/api/backend/drawingbed_orphans", tags=["backend"],
+         dependencies=[Depends(DbUsers.current_superuser)], summary="获取未被商品引用的图像")
+async def drawingbed_orphans(skip: Optional[int] = Query(0, description="【可选】跳过的记录数"),
+                             limit: Optional[int] = Query(10, description="【可选】获取的记录数")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：没有任何商品 prod_img_url 引用的图像列表, 字段同 drawingbed_read
+    """
+    page = db.search_orphan_images(DbSchemas.ImageInfoResponse, skip, limit)
+    return ResponseModel(code=200, data=image_records(page), msg="图像查询成功")
+
+
+@app.delete("/api/backend/drawingbed_orphans_delete", tags=["backend"],
+            dependencies=[Depends(DbUsers.current_superuser)], summary="清理未被商品引用的图像")
+async def drawingbed_orphans_delete(hours: int = Query(24, description="【默认 24】只清理上传超过该小时数的图像")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：删除的图像数量, 成功返回 200
+    """
+    return ResponseModel(code=200, data={"deleted": delete_orphan_images(hours)}, msg="图像清理成功")
+
+
+def delete_orphan_images(hours: int, batch: int = 100):
+    """
+    删除上传超过 hours 小时且未被引用的图像, 返回删除数量
+    从主库按 id 游标每次取 batch 张图像, 再用一次查询找出这批图像中被商品引用的, 不对每张图像做关联 LIKE 扫描;
+    游标只前进不回退, 删除失败或被引用的图像不会被反复读到
+    """
+    before = DbModels.beijing_now() - datetime.timedelta(hours=hours)
+    deleted, after = 0, 0
+    while True:
+        images = db.scan_images(DbSchemas.ImageInfoResponse, after, batch, before=before)
+        if not images or images[-1].id <= after:
+            return deleted
+        after = images[-1].id
+        refs = db.search_image_products([image.name for image in images], primary=True)
+        for image in images:
+            if refs[image.name]:
+                continue
+            image_store.delete(image.name)
+            db.delete_batch_data(DbModels.ImageInfo, {"id": image.id})
+            deleted += 1
 
 
 @app.get("/api/backend/drawingbed_show", tags=["backend"],
          dependencies=[Depends(DbUsers.current_superuser)], summary="获取图像")
-async def drawingbed_show(filename: str = Query(description="【必填】图像名称")):
+async def drawingbed_show(request: Request,
+                          filename: str = Query(description="【必填】图像名称"),
+                          variant: Optional[str] = Query(None, description="【可选】thumb 缩略图, webp 原尺寸WebP, 不填为原图")):
     """
     【输入参数】：参考 Parameters 里的说明
     【输出参数】：直接显示图像
     """
-    file_location = Path(UPLOAD_DIR) / filename
-    if file_location.exists():
-        return responses.FileResponse(file_location)
-    else:
-        return ResponseModel(code=404, data={"file_location": file_location}, msg="找不到文件")
+    return image_response(request, filename, variant)
 
 
 @app.post("/api/backend/drawingbed_create", tags=["backend"],
@@ -532,14 +993,18 @@ async def drawingbed_show(filename: str = Query(description="【必填】图像
 async def drawingbed_create(file: UploadFile = File(..., description="【必填】上传图像文件")):
     """
     【输入参数】：参考 Parameters 里的说明
-    【输出参数】：是否上传成功的结果，成功返回 200, 失败返回 500
+    【输出参数】：是否上传成功的结果，成功返回 200, 格式错误返回 400, 文件过大返回 413
+    【其它说明】：图像名称为内容哈希, 重复上传同一张图像返回已有的名称
     """
-    extension = file.filename.split(".")[-1]
-    filename = generate_random_filename(extension)
-    file_location = Path(UPLOAD_DIR) / filename
-    with open(file_location, "wb") as f:
-        shutil.copyfileobj(file.file, f)
-    return ResponseModel(code=200, data={"filename": filename, "file_location": file_location}, msg="图像上传成功")
+    try:
+        info = await image_store.save(file)
+    except ImageStoreError as e:
+        return ResponseModel(code=e.code, data={}, msg=e.msg)
+    if not db.check_data(DbModels.ImageInfo, [DbModels.ImageInfo.name == info["filename"]]):
+        db.create_data(image_info_record(info))
+    file_location = Path(UPLOAD_DIR) / info["filename"]
+    msg = "图像上传成功" if info["created"] else "图像已存在"
+    return ResponseModel(code=200, data={"filename": info["filename"], "file_location": file_location}, msg=msg)
 
 
 @app.delete("/api/backend/drawingbed_delete", tags=["backend"],
@@ -550,8 +1015,8 @@ async def drawingbed_delete(filename: str = Query(description="【必填】图
     【输出参数】：是否删除成功的结果，成功返回 200, 找不到文件返回 404
     """
     file_location = Path(UPLOAD_DIR) / filename
-    if file_location.exists():
-        os.remove(file_location)
+    if image_store.delete(filename):
+        db.delete_batch_data(DbModels.ImageInfo, {"name": filename})
         return ResponseModel(code=200, data={"file_location": file_location}, msg="图像删除成功")
     else:
         return ResponseModel(code=404, data={"file_location": file_location}, msg="找不到文件")
@@ -630,6 +1095,7 @@ async def update_theme():
 
 @app.get("/api/backend/payment_read", tags=["backend"],
          dependencies=[Depends(DbUsers.current_superuser)], summary="获取支付接口设置")
+@response_cache.cached('payment')
 async def payment_read(skip: Optional[int] = Query(0, description="【可选】跳过的记录数"),
                        limit: Optional[int] = Query(10, description="【可选】获取的记录数")):
     """
@@ -638,11 +1104,11 @@ async def payment_read(skip: Optional[int] = Query(0, description="【可选】
     "config": dict类型 每个支付方式有不同的配置 {"APPID": "XXXXXXXX", "MCH_ID": "XXXXXX", "APP_SECRET": "XXXXXX"},
     "info": str类型 支付方式介绍, "isactive": bool类型 是否激活该支付方式}]
     """
-    temp_dic = {}
-    payments = db.read_datas(DbModels.Payment, DbSchemas.PayResponse, skip, limit)
-    temp_dic["pager"] = payments['pager']
-    data = [payment.dict() for payment in payments['records']]
-    res_data = {"records": data, "pager": temp_dic['pager']}
+    entries = payment_registry.entries()
+    total = len(entries)
+    pager = {"page": (skip // limit) + 1, "pageSize": (total + limit - 1) // limit, "total": total}
+    data = [entry.dict() for entry in entries[skip:skip + limit]]
+    res_data = {"records": data, "pager": pager}
     return ResponseModel(code=200, data=res_data, msg="支付接口查询成功")
 
 
@@ -651,16 +1117,21 @@ async def payment_read(skip: Optional[int] = Query(0, description="【可选】
 async def payment_update(cla: DbSchemas.PayUpdate):
     """
     【输入参数】：参考 Request Body 的 schema
-    【输出参数】：返回当前用户所有的支付接口设置 [{"id": int类型 支付方式唯一ID, "name": str类型 支付方式名称, "icon": str类型 支付方式图标,
+    【输出参数】：返回更新后的支付接口设置 {"id": int类型 支付方式唯一ID, "name": str类型 支付方式名称, "icon": str类型 支付方式图标,
     "config": dict类型 每个支付方式有不同的配置 {"APPID": "XXXXXXXX", "MCH_ID": "XXXXXX", "APP_SECRET": "XXXXXX"},
-    "info": str类型 支付方式介绍, "isactive": bool类型 是否激活该支付方式}]
+    "info": str类型 支付方式介绍, "isactive": bool类型 是否激活该支付方式}, 格式同 payment_read 的一条记录
     """
-    cla.config = str(cla.config)
     data = dict(cla)
+    data = {key: value for key, value in data.items() if value is not None}
+    if cla.config is not None:
+        data["config"] = json.dumps(cla.config, ensure_ascii=False)
     record = db.update_data(DbModels.Payment, data)
     if record is None:
         return ResponseModel(code=500, data={}, msg="支付接口设置更新失败, 请检查修改的数据。")
-    return ResponseModel(code=200, data=data, msg="支付接口设置更新成功")
+    payment_registry.invalidate()
+    await response_cache.invalidate('payment')
+    entry = next(entry for entry in payment_registry.entries() if entry.id == cla.id)
+    return ResponseModel(code=200, data=entry.dict(), msg="支付接口设置更新成功")
 
 
 @app.patch("/api/backend/payment_callback_update", tags=["backend"],
@@ -669,8 +1140,10 @@ async def payment_callback_update(callback: str = Query(description="支付回
     """
     【输入参数】：支付回调地址
     【输出参数】：是否更新成功
+    【其它说明】：各支付平台的异步通知地址为 支付回调地址 + /api/frontend/payment_notify/{支付方式名称}
     """
     db.create_data(DbModels.Config(name="支付回调地址", info=callback, description="支付回调地址", isshow=True))
+    await response_cache.invalidate('config')
     return ResponseModel(code=200, data=callback, msg="支付回调地址保存成功")
 
 
@@ -681,14 +1154,17 @@ async def payment_callback_update(callback: str = Query(description="支付回
 """
 
 
-@app.get("/api/backend/message", tags=["TodoBackend"],
+@app.get("/api/backend/message", tags=["backend"],
          dependencies=[Depends(DbUsers.current_superuser)], summary="获取消息通知设置")
 async def get_message():
     """
     【输入参数】：无
-    【输出参数】：消息通知设置获取成功 返回 200
+    【输出参数】：{"records": 通知渠道列表 [{"id": int类型 渠道唯一ID, "name": str类型 渠道名称, "config": str类型 渠道配置,
+     "admin_account": str类型 管理员账号, "admin_switch": bool类型 管理员通知开关, "user_switch": bool类型 用户通知开关}, {...}],
+     "stats": 各渠道发送统计}
     """
-    return ResponseModel(code=200, data={"data": []}, msg="消息通知设置获取成功")
+    notices = db.search_filter(DbModels.Notice, DbSchemas.NoticeResponse, {})
+    return ResponseModel(code=200, data={"records": notices, "stats": notice_dispatcher.stats()}, msg="消息通知设置获取成功")
 
 
 @app.post("/api/backend/send_email_test", tags=["backend"],
@@ -714,38 +1190,69 @@ async def save_email_settings(config: dict = Body(default={'sendname': 'no_repla
     【输出参数】：SMTP设置保存成功 返回 200
     """
     try:
-        dic = {"name": "邮箱通知", "config": str(config), "admin_account": "admin@qq.com"}
+        dic = {"name": "邮箱通知", "config": json.dumps(config, ensure_ascii=False), "admin_account": "admin@qq.com"}
         db.update_data_name(DbModels.Notice, dic)
     except Exception:
-        db.create_data(DbModels.Notice(name="邮箱通知", config=str(config), admin_account="admin@qq.com"))
+        db.create_data(DbModels.Notice(name="邮箱通知", config=json.dumps(config, ensure_ascii=False), admin_account="admin@qq.com"))
+    notice_dispatcher.invalidate()
     return ResponseModel(code=200, data=config, msg="SMTP设置保存成功")
 
 
-@app.post("/api/backend/save_admin_setting", tags=["TodoBackend"], summary="测试Admin消息")
-async def save_admin_setting():
+@app.post("/api/backend/save_admin_setting", tags=["backend"],
+          dependencies=[Depends(DbUsers.current_superuser)], summary="设置Admin消息")
+async def save_admin_setting(name: str = Query(description="【必填】通知渠道名称，例 TG通知"),
+                             admin_account: Optional[str] = Query(None, description="【可选】管理员接收账号"),
+                             config: Optional[dict] = Body(None, description="【可选】渠道配置参数")):
     """
-    【输入参数】：无
-    【输出参数】：Admin消息测试成功 返回 200
+    【输入参数】：参考 Parameters 里的说明 和 Request Body
+    【输出参数】：Admin消息设置成功 返回 200, 找不到渠道返回 404
     """
-    return ResponseModel(code=200, data={}, msg="Admin消息测试成功")
+    dic = {"name": name}
+    if admin_account is not None:
+        dic["admin_account"] = admin_account
+    if config is not None:
+        dic["config"] = json.dumps(config, ensure_ascii=False)
+    record = db.update_data_name(DbModels.Notice, dic)
+    if record is None:
+        return ResponseModel(code=404, data={}, msg="找不到通知渠道")
+    notice_dispatcher.invalidate()
+    return ResponseModel(code=200, data=dic, msg="Admin消息设置成功")
 
 
-@app.patch("/api/backend/admin_message_test", tags=["TodoBackend"], summary="设置Admin消息")
-async def admin_message_test():
+@app.patch("/api/backend/admin_message_test", tags=["backend"],
+           dependencies=[Depends(DbUsers.current_superuser)], summary="测试Admin消息")
+async def admin_message_test(subject: str = Query("测试消息", description="消息标题"),
+                             content: str = Query("这是一条测试消息。", description="消息内容")):
     """
-    【输入参数】：无
-    【输出参数】：Admin消息设置成功 返回 200
+    【输入参数】：消息标题，消息内容
+    【输出参数】：消息已投递到所有开启了管理员通知的渠道 返回 200, 通知队列已满返回 503
     """
-    return ResponseModel(code=200, data={}, msg="Admin消息设置成功")
+    if not notice_dispatcher.notify(subject, content):
+        return ResponseModel(code=503, data={}, msg="通知队列已满")
+    return ResponseModel(code=200, data={}, msg="Admin消息测试成功")
 
 
-@app.patch("/api/backend/message_switch", tags=["TodoBackend"], summary="切换消息开关")
-async def switch_message():
+@app.patch("/api/backend/message_switch", tags=["backend"],
+           dependencies=[Depends(DbUsers.current_superuser)], summary="切换消息开关")
+async def switch_message(name: str = Query(description="【必填】通知渠道名称，例 邮箱通知"),
+                         admin_switch: Optional[bool] = Query(None, description="【可选】管理员通知开关"),
+                         user_switch: Optional[bool] = Query(None, description="【可选】用户通知开关")):
     """
-    【输入参数】：
-    【输出参数】：消息开关切换成功 返回 200
-    """
-    return ResponseModel(code=200, data={}, msg="消息开关切换成功")
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：消息开关切换成功 返回 200, 找不到渠道返回 404, 开启没有实现的渠道(如短信通知)返回 400
+    """
+    if (admin_switch or user_switch) and not notice_dispatcher.supports(name):
+        return ResponseModel(code=400, data={}, msg=f"{name} 暂不支持发送, 不能开启")
+    dic = {"name": name}
+    if admin_switch is not None:
+        dic["admin_switch"] = admin_switch
+    if user_switch is not None:
+        dic["user_switch"] = user_switch
+    record = db.update_data_name(DbModels.Notice, dic)
+    if record is None:
+        return ResponseModel(code=404, data={}, msg="找不到通知渠道")
+    notice_dispatcher.invalidate()
+    return ResponseModel(code=200, data=dic, msg="消息开关切换成功")
 
 
 """
@@ -757,13 +1264,15 @@ async def switch_message():
 
 @app.get("/api/backend/get_other_config", tags=["backend"],
          dependencies=[Depends(DbUsers.current_superuser)], summary="获取综合设置")
+@response_cache.cached('config')
 async def get_other_config():
     """
     【输入参数】：无
-    【输出参数】：综合设置查询成功 返回 200
+    【输出参数】：{"records": 综合设置列表 [{"id": int类型 设置唯一ID, "name": str类型 设置名称, "info": str类型 设置内容,
+     "description": str类型 设置说明, "isshow": bool类型 是否显示}, {...}]}
     """
     result = db.search_filter(DbModels.Config, DbSchemas.ConfigResponse, {})
-    return ResponseModel(code=200, data=result, msg="综合设置查询成功")
+    return ResponseModel(code=200, data={"records": result}, msg="综合设置查询成功")
 
 
 @app.patch("/api/backend/home_notice", tags=["backend"],
@@ -775,6 +1284,7 @@ async def update_home_notice(home_notice: str = Query(description="首页公告"
     """
     dic = {"name": "home_notice", "info": home_notice, "description": "首页公告", "isshow": True}
     db.update_data_name(DbModels.Config, dic)
+    await response_cache.invalidate('config')
     return ResponseModel(code=200, data=dic, msg="首页公告更新成功")
 
 
@@ -787,6 +1297,7 @@ async def update_icp(icp: str = Query(description="底部备案")):
     """
     dic = {"name": "icp", "info": icp, "description": "底部备案", "isshow": True}
     db.update_data_name(DbModels.Config, dic)
+    await response_cache.invalidate('config')
     return ResponseModel(code=200, data=dic, msg="底部备案更新成功")
 
 
@@ -800,9 +1311,18 @@ async def update_other_optional(other_optional: dict = Body(default={"login_mode
     """
     【输入参数】：参考 Parameters 里的说明
     【输出参数】：可选参数更新成功 返回 200
+    【其它说明】：sales_statistics 为 1 时自动统计商品销量, 打开时立即按订单重算一次; 为 0 时销量仅限手工修改
     """
-    dic = {"name": "other_optional", "info": str(other_optional), "description": "可选参数", "isshow": True}
+    dic = {"name": "other_optional", "info": json.dumps(other_optional, ensure_ascii=False), "description": "可选参数",
+           "isshow": True}
     db.update_data_name(DbModels.Config, dic)
+    enabled = str(other_optional.get('sales_statistics', 1)) == '1'
+    if enabled and not sales_counter.enabled:
+        sales_counter.configure(enabled)
+        await asyncio.to_thread(sales_counter.reconcile)
+        await response_cache.invalidate('product')
+    sales_counter.configure(enabled)
+    await response_cache.invalidate('config')
     return ResponseModel(code=200, data=dic, msg="可选参数更新成功")
 
 
@@ -815,6 +1335,58 @@ async def reset_admin_account():
     return ResponseModel(code=200, data={"暂未实现": ""}, msg="管理员账密修改成功")
 
 
+"""
+========================================
+慢请求采样
+========================================
+"""
+
+
+@app.get("/api/backend/profiler_read", tags=["backend"],
+         dependencies=[Depends(DbUsers.current_superuser)], summary="获取慢请求采样设置和结果列表")
+async def profiler_read():
+    """
+    【输入参数】：无
+    【输出参数】：{"config": 当前设置和采样计数, "records": 已保存的采样结果摘要 [{"id": int类型 结果ID, "method": 请求方法,
+     "path": 请求路径, "route": 路由模板, "status": 状态码, "elapsed_ms": 请求耗时, "forced": 是否为固定抽样,
+     "samples": 样本数, "time": 请求时间}, {...}]}
+    """
+    return ResponseModel(code=200, data={"config": profiler.status(), "records": profiler.profiles()},
+                         msg="慢请求采样查询成功")
+
+
+@app.patch("/api/backend/profiler_update", tags=["backend"],
+           dependencies=[Depends(DbUsers.current_superuser)], summary="开启或关闭慢请求采样")
+async def profiler_update(cla: DbSchemas.ProfilerConfig):
+    """
+    【输入参数】：参考 Request Body 的 schema
+    【输出参数】：更新后的设置
+    【其它说明】：默认关闭, 关闭时没有额外开销; 开启后采样线程每 interval_ms 毫秒读取一次调用栈, 只保存慢请求和抽中的请求
+    """
+    profiler.configure(cla.enabled, cla.threshold_ms, cla.sample_every, cla.paths, cla.interval_ms)
+    return ResponseModel(code=200, data=profiler.status(), msg="慢请求采样设置更新成功")
+
+
+@app.get("/api/backend/profiler_export", tags=["backend"],
+         dependencies=[Depends(DbUsers.current_superuser)], summary="导出慢请求采样结果")
+async def profiler_export(id: int = Query(description="采样结果ID"),
+                          fmt: str = Query("speedscope", pattern="^(speedscope|collapsed)$",
+                                           description="【默认 speedscope】speedscope: JSON, 可直接拖入 https://www.speedscope.app; "
+                                                       "collapsed: 折叠调用栈文本, 可用 flamegraph.pl 生成火焰图")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：采样结果文件, 不包装为 ResponseModel, 便于直接导入分析工具
+    """
+    entry = profiler.get(id)
+    if entry is None:
+        return ResponseModel(code=404, data={}, msg="采样结果不存在或已被新结果替换")
+    filename = f"profile-{id}.{'json' if fmt == 'speedscope' else 'txt'}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if fmt == 'collapsed':
+        return responses.PlainTextResponse(profiler.export(entry, fmt), headers=headers)
+    return responses.JSONResponse(profiler.export(entry, fmt), headers=headers)
+
+
 """
 ========================================
 返回商店主页
@@ -869,6 +1441,30 @@ async def home(skip: Optional[int] = Query(0, description="【默认 0】跳过
     return ResponseModel(code=200, data=prodinfos, msg="获取首页商品信息成功")
 
 
+@app.get("/api/frontend/class_nav", tags=["frontend"], summary="获取分类导航")
+@response_cache.cached('class', 'product', 'card', ttl=10)
+async def class_nav():
+    """
+    【输入参数】：无
+    【输出参数】：启用的分类, 按排序 {"records": [{"id": int类型 分类ID, "name": str类型 分类名称, "sort": int类型 排序,
+     "products": int类型 上架商品数, "stock": int类型 这些商品的库存合计}, {...}]}
+    【其它说明】：一次查询返回, 库存为未使用的卡密数, 可重复使用的卡密计 1; 最多 10 秒的缓存
+    """
+    records = await asyncio.to_thread(db.search_category_nav)
+    return ResponseModel(code=200, data={"records": records}, msg="分类导航查询成功")
+
+
+@app.get("/api/frontend/drawingbed_show", tags=["frontend"], summary="获取商品图像")
+async def frontend_drawingbed_show(request: Request,
+                                   filename: str = Query(description="【必填】图像名称"),
+                                   variant: Optional[str] = Query("thumb", description="【默认 thumb】thumb 缩略图, webp 原尺寸WebP, 空为原图")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：直接显示图像, 默认返回缩略图, 浏览器按 ETag/Cache-Control 缓存
+    """
+    return image_response(request, filename, variant or None)
+
+
 @app.get("/api/frontend/user_invitation", tags=["TodoFrontend"], summary="获取邀请好友信息接口")
 async def user_invitation(user: DbUsers.User = Depends(DbUsers.current_active_user)):
     """
@@ -878,28 +1474,84 @@ async def user_invitation(user: DbUsers.User = Depends(DbUsers.current_active_us
     return ResponseModel(code=200, data={}, msg="邀请好友信息查询成功")
 
 
-@app.get("/api/frontend/user_order", tags=["TodoFrontend"], summary="获取个人中心信息接口 返回最近订单")
-async def user_order(skip: Optional[int] = Query(0),
-                     limit: Optional[int] = Query(10),
+def encode_cursor(position) -> Optional[str]:
+    """把 (updatetime, id) 编码为分页游标"""
+    if position is None:
+        return None
+    updatetime, uid = position
+    return base64.urlsafe_b64encode(json.dumps([updatetime.isoformat(), uid]).encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str]):
+    """解析分页游标, 非法游标抛出 ValueError"""
+    if not cursor:
+        return None
+    try:
+        updatetime, uid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(updatetime), int(uid)
+    except Exception:
+        raise ValueError("无效的分页游标")
+
+
+def order_history(owner_filter, limit: int, cursor: Optional[str], exclude=None, archive=False):
+    """按游标分页查询订单历史, 返回 ResponseModel 的 data; archive 为 True 时合并归档库中的订单"""
+    if archive:
+        result = order_archive.history(DbSchemas.OrderResponse, owner_filter, limit, decode_cursor(cursor))
+    else:
+        result = db.search_order_history(DbSchemas.OrderResponse, owner_filter, limit, decode_cursor(cursor))
+    return {"records": [order.dict(exclude=exclude) for order in result['records']],
+            "pager": {"limit": limit, "next": encode_cursor(result['next'])}}
+
+
+@app.get("/api/frontend/user_order", tags=["frontend"], summary="获取个人中心信息接口 返回最近订单")
+async def user_order(limit: int = Query(10, ge=1, le=100, description="【默认 10】获取的记录数"),
+                     cursor: Optional[str] = Query(None, description="【可选】分页游标, 第一页不传, 之后传上一页返回的 pager.next"),
+                     archive: bool = Query(False, description="【默认 false】是否包含一年多以前已归档的订单"),
                      user: DbUsers.User = Depends(DbUsers.current_active_user)):
     """
     【输入参数】：用户 Token 验证身份, 参考 Parameters 里的说明
-    【输出参数】：用户订单信息查询结果 [{}, {}, ...]
+    【输出参数】：当前用户的订单, 按下单时间倒序 {"records": [{字段同 order_read}, {...}], "pager": {"limit": int类型 每页条数,
+     "next": str类型 下一页游标, 没有更多时为 null}}, 游标无效返回 400
     """
-    orders = db.read_datas(DbModels.Order, DbSchemas.OrderResponse, skip, limit)
-    return ResponseModel(code=200, data=orders, msg="用户订单信息查询成功")
+    try:
+        data = order_history(DbModels.Order.user_id == str(user.id), limit, cursor, archive=archive)
+    except ValueError as e:
+        return ResponseModel(code=400, data={}, msg=str(e))
+    return ResponseModel(code=200, data=data, msg="用户订单信息查询成功")
 
 
-@app.get("/api/frontend/user_payment_details", tags=["TodoFrontend"], summary="获取订单中心信息接口")
-async def user_payment_details(skip: Optional[int] = Query(0, description="【默认 0】跳过的记录数"),
-                               limit: Optional[int] = Query(10, description="【默认 10】获取的记录数"),
+@app.get("/api/frontend/user_payment_details", tags=["frontend"], summary="获取订单中心信息接口")
+async def user_payment_details(limit: int = Query(10, ge=1, le=100, description="【默认 10】获取的记录数"),
+                               cursor: Optional[str] = Query(None, description="【可选】分页游标, 第一页不传, 之后传上一页返回的 pager.next"),
+                               archive: bool = Query(False, description="【默认 false】是否包含一年多以前已归档的订单"),
                                user: DbUsers.User = Depends(DbUsers.current_active_user)):
     """
     【输入参数】：用户 Token 验证身份, 参考 Parameters 里的说明
-    【输出参数】：用户支付明细查询结果 [{}, {}, ...]
+    【输出参数】：当前用户已支付的订单明细, 格式同 user_order, 游标无效返回 400
     """
-    orders = db.read_datas(DbModels.Order, DbSchemas.OrderResponse, skip, limit)
-    return ResponseModel(code=200, data=orders, msg="用户支付明细查询成功")
+    owner_filter = (DbModels.Order.user_id == str(user.id)) & DbModels.Order.state.in_(('paid', 'delivered'))
+    try:
+        data = order_history(owner_filter, limit, cursor, archive=archive)
+    except ValueError as e:
+        return ResponseModel(code=400, data={}, msg=str(e))
+    return ResponseModel(code=200, data=data, msg="用户支付明细查询成功")
+
+
+@app.get("/api/frontend/guest_order", tags=["frontend"], summary="游客按联系方式查询订单")
+async def guest_order(contact: str = Query(description="【必填】下单时填写的联系方式"),
+                      limit: int = Query(10, ge=1, le=100, description="【默认 10】获取的记录数"),
+                      cursor: Optional[str] = Query(None, description="【可选】分页游标"),
+                      archive: bool = Query(False, description="【默认 false】是否包含一年多以前已归档的订单")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：该联系方式的游客订单, 格式同 user_order, 不包含卡密; 卡密通过 guest_order_query 按订单号和联系方式查询
+    """
+    owner_filter = (DbModels.Order.contact == contact) & DbModels.Order.user_id.is_(None)
+    try:
+        data = order_history(owner_filter, limit, cursor, exclude={"card"}, archive=archive)
+    except ValueError as e:
+        return ResponseModel(code=400, data={}, msg=str(e))
+    return ResponseModel(code=200, data=data, msg="订单查询成功")
 
 
 @app.get("/api/frontend/user_wallet", tags=["TodoFrontend"], summary="获取我的钱包信息接口")
@@ -913,13 +1565,112 @@ async def user_wallet(user: DbUsers.User = Depends(DbUsers.current_active_user))
     return ResponseModel(code=200, data=dict(wallet_balance), msg="我的钱包余额查询成功")
 
 
-@app.get("/api/frontend/user_order_query", tags=["TodoFrontend"], summary="查询订单信息接口")
-async def user_order_query(user: DbUsers.User = Depends(DbUsers.current_active_user)):
+@app.api_route("/api/frontend/payment_notify/{name}", methods=["GET", "POST"], tags=["frontend"],
+               summary="支付异步通知接口")
+async def payment_notify(name: str, request: Request):
     """
-    【输入参数】：用户 Token 验证身份
-    【输出参数】：订单查询结果 [{}, {}, ...]
+    【输入参数】：name 为支付方式名称, 其余参数由支付平台以 query 或表单形式提交
+    【输出参数】：纯文本应答, 内容按各支付平台要求(如 success), 验签失败或金额不符返回 400
+    【其它说明】：重复通知直接应答成功, 不会重复发货; 应答后在后台发货
+    """
+    params = dict(request.query_params)
+    if request.method == "POST":
+        params.update(await request.form())
+    ok, ack = await payment_gateway.handle(name, params)
+    return responses.PlainTextResponse(ack, status_code=200 if ok else 400)
+
+
+@app.get("/api/frontend/price_quote", tags=["frontend"], summary="商品询价")
+async def price_quote(name: str = Query(description="【必填】商品名称"),
+                      num: int = Query(1, ge=1, description="【默认 1】购买数量")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：{"name": str类型 商品名称, "num": int类型 数量, "price": float类型 该数量下的单价, "total_price": float类型 总价,
+     "tiers": [{"min_num": int类型 起购数量, "price": float类型 单价}, ...]}, 商品不存在返回 404
+    【其它说明】：与下单使用同一个内存价格表, 结果即下单时的价格
+    """
+    prices = order_manager.price_table()
+    if name not in prices:
+        return ResponseModel(code=404, data={}, msg="商品不存在")
+    price, total_price = prices.quote(name, num)
+    return ResponseModel(code=200, data={"name": name, "num": num, "price": price, "total_price": total_price,
+                                         "tiers": prices.tiers(name)}, msg="询价成功")
+
+
+@app.get("/api/frontend/coupon_check", tags=["frontend"], summary="查询优惠券")
+async def coupon_check(code: str = Query(description="【必填】优惠券码"),
+                       name: str = Query(description="【必填】商品名称"),
+                       num: int = Query(1, ge=1, description="【默认 1】购买数量")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：{"code": str类型 券码, "total_price": float类型 原价, "discounted": float类型 优惠后总价}; 券码无效或不满足使用条件返回 400
+    【其它说明】：只预览不核销, 下单时再核销; 无效券码由内存中的过滤器拒绝, 不查询数据库
+    """
+    prices = order_manager.price_table()
+    if name not in prices:
+        return ResponseModel(code=404, data={}, msg="商品不存在")
+    _, total_price = prices.quote(name, num)
+    coupon = await asyncio.to_thread(coupon_manager.lookup, code)
+    if coupon is None or not coupon.state or coupon.remaining < 1 or total_price < coupon.min_amount \
+            or (coupon.expires is not None and coupon.expires <= DbModels.beijing_now()) \
+            or (coupon.prod_name is not None and coupon.prod_name != name):
+        return ResponseModel(code=400, data={}, msg="优惠券不可用")
+    discounted = apply_discount(total_price, coupon.discount_type, coupon.discount)
+    return ResponseModel(code=200, data={"code": coupon.code, "total_price": total_price, "discounted": discounted},
+                         msg="优惠券可用")
+
+
+@app.post("/api/frontend/checkout", tags=["frontend"], summary="下单接口")
+async def checkout(cla: DbSchemas.OrderCreate, user: Optional[DbUsers.User] = Depends(DbUsers.current_optional_user)):
+    """
+    【输入参数】：参考 Request Body 里的 Schema
+    【输出参数】：待支付订单 {"out_order_id": str类型 订单号, "name": str类型 商品名称, "num": int类型 数量, "price": float类型 单价,
+     "total_price": float类型 总价, "payment": str类型 支付方式, "state": str类型 订单状态 pending}
+     "coupon": str类型 使用的优惠券码(使用时), 商品不存在返回 404, 支付方式或优惠券不可用返回 400, 库存不足返回 409
+    【其它说明】：订单超过支付时限未支付会自动过期, 使用的优惠券退回一次使用次数; 携带 Token 下单的订单会出现在 user_order 中
+    """
+    try:
+        order = await order_manager.checkout_async(cla.name, cla.num, cla.payment, cla.contact, cla.contact_txt,
+                                                   str(user.id) if user is not None else None, cla.coupon)
+    except OrderError as e:
+        return ResponseModel(code=e.code, data={}, msg=e.msg)
+    return ResponseModel(code=200, data=order, msg="下单成功")
+
+
+async def find_order(filter_params: list):
+    """按订单号和归属条件查找一条订单, 订单表中没有时再查归档库; 找不到返回 None"""
+    if not db.check_data(DbModels.Order, filter_params):
+        return await asyncio.to_thread(order_archive.find, DbSchemas.OrderResponse, filter_params)
+    return db.search_data(DbModels.Order, DbSchemas.OrderResponse, filter_params)
+
+
+@app.get("/api/frontend/user_order_query", tags=["frontend"], summary="查询订单信息接口")
+async def user_order_query(out_order_id: str = Query(description="【必填】订单号"),
+                           user: DbUsers.User = Depends(DbUsers.current_active_user)):
     """
-    return ResponseModel(code=200, data={}, msg="订单查询")
+    【输入参数】：用户 Token 验证身份, 参考 Parameters 里的说明
+    【输出参数】：订单信息, 字段同 order_read, state 为订单状态 pending/paid/delivered/expired; 找不到订单返回 404
+    【其它说明】：只能查到当前用户自己的订单, 别人的订单同样返回 404; 已归档的旧订单同样可以查到
+    """
+    order = await find_order([DbModels.Order.out_order_id == out_order_id, DbModels.Order.user_id == str(user.id)])
+    if order is None:
+        return ResponseModel(code=404, data={}, msg="找不到订单")
+    return ResponseModel(code=200, data=dict(order), msg="订单查询成功")
+
+
+@app.get("/api/frontend/guest_order_query", tags=["frontend"], summary="游客按订单号查询订单信息")
+async def guest_order_query(out_order_id: str = Query(description="【必填】订单号"),
+                            contact: str = Query(description="【必填】下单时填写的联系方式")):
+    """
+    【输入参数】：参考 Parameters 里的说明
+    【输出参数】：订单信息(含卡密), 字段同 user_order_query; 订单号和联系方式对不上返回 404
+    【其它说明】：只查游客订单, 登录用户下的订单需要用 user_order_query 查询
+    """
+    order = await find_order([DbModels.Order.out_order_id == out_order_id, DbModels.Order.contact == contact,
+                              DbModels.Order.user_id.is_(None)])
+    if order is None:
+        return ResponseModel(code=404, data={}, msg="找不到订单")
+    return ResponseModel(code=200, data=dict(order), msg="订单查询成功")
 
 
 @app.get("/api/frontend/logout", tags=["TodoFrontend"],
@@ -0,0 +1,152 @@
+import asyncio
+import time
+from datetime import timedelta
+from typing import Optional
+from sqlalchemy import insert, delete, select, func
+from utils.databaseManager import LoginLog, beijing_now
+
+
+"""
+代码说明：
+登录审计日志管道，登录请求只把事件追加到内存缓冲区，由后台协程批量写入 LoginLog。
+每 flush_interval 秒或攒够 batch_size 条写一次，一次事务插入整批，不和下单写入逐条争抢 SQLite 写锁。
+缓冲区最多 max_pending 条，超出时丢弃并计数；停止时把剩余事件全部写完。
+保留期按天切片清理: 每次只删除一天的数据，每天一个短事务，旧数据多时也不会长时间占用写锁；由定时任务每小时执行一次。
+"""
+
+INSERT_LOGIN_LOG = insert(LoginLog)
+
+
+class AuditLog:
+    """record 方法追加一条事件, 不等待写入, 缓冲区已满时返回 False。
+       start / stop 方法启动和停止后台写入协程, stop 时写完剩余事件。
+       purge 方法按天删除超过保留期的日志。
+    """
+
+    def __init__(self, db, flush_interval=0.5, batch_size=500, max_pending=10000, retention_days=90):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.retention_days = retention_days
+        self._pending = []
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+        self.counters = {"recorded": 0, "written": 0, "batches": 0, "dropped": 0, "failed": 0, "purged": 0}
+
+    def record(self, ip: str, user_id: Optional[str] = None, event: str = 'login') -> bool:
+        """追加一条事件, 时间在此刻取得, 与写入时间无关"""
+        if len(self._pending) >= self.max_pending:
+            self.counters["dropped"] += 1
+            return False
+        self._pending.append({"ip": ip, "user_id": user_id, "event": event, "updatetime": beijing_now()})
+        self.counters["recorded"] += 1
+        if len(self._pending) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    def write_batch(self, rows: list):
+        """一个事务插入一批事件, 在线程中执行"""
+        with self.db.engine.begin() as conn:
+            conn.execute(INSERT_LOGIN_LOG, rows)
+
+    async def flush(self):
+        """写入当前缓冲区中的全部事件, 写入失败时放回缓冲区等待下次重试"""
+        while self._pending:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            try:
+                await asyncio.to_thread(self.write_batch, batch)
+            except Exception as e:
+                self.counters["failed"] += 1
+                print(f"登录日志写入失败: {e!r}")
+                room = self.max_pending - len(self._pending)
+                self.counters["dropped"] += max(0, len(batch) - room)
+                self._pending = batch[:room] + self._pending
+                return
+            self.counters["written"] += len(batch)
+            self.counters["batches"] += 1
+
+    def purge(self, now=None) -> int:
+        """删除超过保留期的日志, 每次删除一天的数据, 返回删除条数; 在线程中执行"""
+        cutoff = (now or beijing_now()) - timedelta(days=self.retention_days)
+        deleted = 0
+        while True:
+            with self.db.engine.connect() as conn:
+                oldest = conn.execute(select(func.min(LoginLog.updatetime))).scalar()
+            if oldest is None or oldest >= cutoff:
+                break
+            day_end = min(cutoff, oldest.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1))
+            with self.db.engine.begin() as conn:
+                deleted += conn.execute(delete(LoginLog).where(LoginLog.updatetime < day_end)).rowcount
+        self.counters["purged"] += deleted
+        return deleted
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台协程并写完剩余事件"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._wakeup = None
+        await self.flush()
+
+    def stats(self):
+        return {**self.counters, "pending": len(self._pending)}
+
+
+async def benchmark_audit(events=20000):
+    """比较逐条插入和批量管道写入登录日志的耗时"""
+    import os
+    import tempfile
+    from utils.databaseManager import Database
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    db = Database(f'sqlite:///{path}', echo=False)
+    db.create_tables()
+    audit_log = AuditLog(db, retention_days=30)
+
+    begin = time.perf_counter()
+    for i in range(events // 10):
+        audit_log.write_batch([{"ip": f"10.0.{i % 256}.1", "user_id": None, "event": 'login', "updatetime": beijing_now()}])
+    single = (time.perf_counter() - begin) / (events // 10)
+    print(f"逐条插入: 每条 {single * 1e6:.0f}us, 约 {1 / single:.0f} 条/秒")
+
+    await audit_log.start()
+    begin = time.perf_counter()
+    for i in range(events):
+        audit_log.record(f"10.0.{i % 256}.1", f"user-{i}")
+        if i % 100 == 0:
+            # 约每秒 10 万次登录的突发, 给后台写入协程让出事件循环
+            await asyncio.sleep(0.001)
+    await audit_log.stop()
+    elapsed = time.perf_counter() - begin
+    print(f"批量管道: {events} 条全部落库耗时 {elapsed:.2f}s, {audit_log.stats()}")
+
+    with db.engine.begin() as conn:
+        old = beijing_now() - timedelta(days=120)
+        conn.execute(INSERT_LOGIN_LOG, [{"ip": "old", "event": 'login', "updatetime": old + timedelta(hours=i)} for i in range(24 * 100)])
+    begin = time.perf_counter()
+    print(f"保留期清理 {audit_log.purge()} 条, 耗时 {time.perf_counter() - begin:.2f}s")
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark_audit())
@@ -0,0 +1,382 @@
+import threading
+import time
+from collections import defaultdict
+from queue import Queue, Empty
+from sqlalchemy import event, select, insert, update, delete, func, bindparam, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import ArgumentError
+from sqlalchemy.sql.dml import Insert, Update, Delete
+from utils.databaseManager import Base
+
+
+"""
+代码说明：
+在线迁移数据库后端，例如从 SQLite 迁到 PostgreSQL/MySQL，迁移期间网站照常读写：
+1. start：在目标库建表，在源库引擎上开始记录写入。每条 INSERT/UPDATE/DELETE 执行时记下涉及的 (表, id)，
+   连接归还连接池时(事务已经提交或回滚)交给同步线程；同步线程按 id 从源库读出当前的行写入目标库，源库中已不存在的行从目标库删除。
+   同步的是行的最新状态而不是语句本身，重复同步、同步已回滚的行都没有影响，不依赖两种数据库的 SQL 方言一致。
+2. copy：按主键顺序分批把每张表复制到目标库，每批一个短事务，中断后重跑会覆盖已复制的行。
+   复制一批和同步一批互斥，谁后读源库谁后写目标库，目标库不会被旧数据覆盖。
+3. cutover：先追上积压的写入，再调用 Database.switch_database 暂停新的数据库访问、等待进行中的事务结束，
+   同步最后的写入、核对每张表的行数、校正 PostgreSQL 的自增序列后换上目标库；任一步出错都不切换，双写继续，可以再次 cutover。
+4. 用户表由 usersManager 的异步引擎单独读写，作为 extra_tables / extra_engines 传入：一样复制和双写，
+   切换后这些引擎仍写原库，同步继续，直到把 usersManager.DATABASE_URL 改成目标库(异步驱动)后重启。
+   仪表盘、订单归档里用到的 strftime、sqlite insert、PRAGMA 等 SQLite 专用写法改写之前，只允许迁到另一个 SQLite 库
+   (换磁盘、换路径)，check_target 拒绝其它数据库，避免切换后这些功能出错。
+"""
+
+# 应用里的查询已经兼容的目标数据库; 上面的 SQLite 专用写法改写后再加入 postgresql / mysql
+SUPPORTED_BACKENDS = ('sqlite',)
+
+
+def check_target(target_url: str):
+    """目标库地址无效或应用还不支持该数据库时抛出 MigrationError"""
+    try:
+        backend = make_url(target_url).get_backend_name()
+    except ArgumentError:
+        raise MigrationError("目标数据库地址无效")
+    if backend not in SUPPORTED_BACKENDS:
+        raise MigrationError(f"暂不支持迁移到 {backend}: 仪表盘、订单归档仍使用 SQLite 专用写法")
+
+
+class MigrationError(Exception):
+    """迁移中止, 网站继续使用源库"""
+
+
+class BackendMigration:
+    """start 方法在目标库建表并开始双写; copy 方法分批复制全部表; cutover 方法切换到目标库; abort 方法放弃迁移;
+       run 方法依次执行三步, 在线程中调用; stats 方法返回状态和进度。
+    """
+
+    def __init__(self, db, target_url, batch_size=1000, drain_timeout=10, extra_tables=(), extra_engines=()):
+        self.db = db
+        self.target_url = target_url
+        self.batch_size = batch_size
+        self.drain_timeout = drain_timeout
+        # 被外键引用的表在前; extra_tables 为同一个库中不属于 Base 的表, 由 extra_engines 写入
+        self.tables = list(Base.metadata.sorted_tables) + list(extra_tables)
+        self.extra_engines = list(extra_engines)
+        self._table_set = set(self.tables)
+        self.source = None
+        self.target = None
+        self.state = 'idle'
+        self.error = None
+        self._queue = Queue()
+        self._copy_lock = threading.Lock()
+        self._worker = None
+        self._rescan = set()  # 取不到新增行 id 的表, 切换前整表重新复制
+        self.progress = {table.name: 0 for table in self.tables}
+        self.counters = {"captured": 0, "synced": 0, "sync_batches": 0, "sync_errors": 0, "copy_seconds": 0.0,
+                         "pause_seconds": 0.0}
+
+    # ---------- 记录写入 ----------
+    def _before_execute(self, conn, clause, multiparams, params, execution_options):
+        if isinstance(clause, Insert) and clause.table in self._table_set:
+            # 多行 INSERT 默认拿不到新行的 id, 迁移期间让它们带上 RETURNING
+            if not clause._returning and not clause._return_defaults:
+                clause = clause.return_defaults()
+        elif isinstance(clause, (Update, Delete)) and clause.table in self._table_set:
+            # 执行之前按同样的条件查出会被修改的行
+            finder = select(clause.table.c.id)
+            if clause.whereclause is not None:
+                finder = finder.where(clause.whereclause)
+            keys = conn.info.setdefault('migration_keys', [])
+            for param_set in (multiparams or [params or {}]):
+                keys.extend((clause.table, key) for key in conn.execute(finder, param_set).scalars())
+        return clause, multiparams, params
+
+    def _after_execute(self, conn, clause, multiparams, params, execution_options, result):
+        if isinstance(clause, Insert) and clause.table in self._table_set:
+            try:
+                rows = result.inserted_primary_key_rows
+            except Exception:
+                rows = None
+            if not rows or any(row is None or row[0] is None for row in rows):
+                self._rescan.add(clause.table)
+                return
+            conn.info.setdefault('migration_keys', []).extend((clause.table, row[0]) for row in rows)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        """连接归还时事务已经结束, 这时交给同步线程读到的就是提交后的数据"""
+        keys = connection_record.info.pop('migration_keys', None)
+        if keys:
+            self.counters["captured"] += len(keys)
+            self._queue.put(keys)
+
+    # ---------- 同步 ----------
+    def _apply(self, conn, table, rows, ids):
+        """把源库中 ids 这些行的当前状态 rows 写入目标库: 已有的更新, 没有的插入, 源库已删除的删除"""
+        present = {row['id'] for row in rows}
+        missing = [key for key in ids if key not in present]
+        if missing:
+            conn.execute(delete(table).where(table.c.id.in_(missing)))
+        if not rows:
+            return
+        existing = set(conn.execute(select(table.c.id).where(table.c.id.in_(present))).scalars())
+        inserts = [dict(row) for row in rows if row['id'] not in existing]
+        updates = [{f"b_{key}": value for key, value in row.items()} for row in rows if row['id'] in existing]
+        if inserts:
+            conn.execute(insert(table), inserts)
+        if updates:
+            conn.execute(update(table).where(table.c.id == bindparam('b_id'))
+                         .values({column.name: bindparam(f"b_{column.name}") for column in table.columns
+                                  if column.name != 'id'}), updates)
+
+    def _sync(self, keys):
+        by_table = defaultdict(set)
+        for table, key in keys:
+            by_table[table].add(key)
+        with self._copy_lock:
+            with self.source.connect() as source, self.target.begin() as target:
+                for table in self.tables:
+                    ids = sorted(by_table.get(table, ()))
+                    for offset in range(0, len(ids), 500):
+                        chunk = ids[offset:offset + 500]
+                        rows = source.execute(select(table).where(table.c.id.in_(chunk))).mappings().all()
+                        self._apply(target, table, rows, chunk)
+        self.counters["synced"] += len(keys)
+        self.counters["sync_batches"] += 1
+
+    def _run_sync(self):
+        while True:
+            keys = self._queue.get()
+            if keys is None:
+                self._queue.task_done()
+                break
+            batch, taken = list(keys), 1
+            while len(batch) < 5000:
+                try:
+                    more = self._queue.get_nowait()
+                except Empty:
+                    break
+                taken += 1
+                if more is None:
+                    self._queue.put(None)  # 留给下一轮退出
+                    self._queue.task_done()
+                    taken -= 1
+                    break
+                batch.extend(more)
+            try:
+                self._sync(batch)
+            except Exception as e:
+                self.counters["sync_errors"] += 1
+                self.error = repr(e)[:300]
+                print(f"迁移同步失败, 稍后重试: {self.error}")
+                time.sleep(1)
+                self._queue.put(batch)
+            finally:
+                for _ in range(taken):
+                    self._queue.task_done()
+
+    # ---------- 三个步骤 ----------
+    def start(self):
+        """在目标库建表并开始双写"""
+        if self.state != 'idle':
+            raise MigrationError(f"迁移已经开始: {self.state}")
+        check_target(self.target_url)
+        self.source = self.db.engine
+        self.target = self.db._create_engine(self.target_url)
+        Base.metadata.create_all(self.target)
+        for table in self.tables:
+            table.create(self.target, checkfirst=True)
+        for engine in [self.source] + self.extra_engines:
+            event.listen(engine, 'before_execute', self._before_execute, retval=True)
+            event.listen(engine, 'after_execute', self._after_execute)
+            event.listen(engine, 'checkin', self._on_checkin)
+        self._worker = threading.Thread(target=self._run_sync, name='backend-migration', daemon=True)
+        self._worker.start()
+        self.state = 'dual_write'
+
+    def _copy_table(self, table):
+        after = None
+        while True:
+            with self._copy_lock:
+                with self.source.connect() as source:
+                    statement = select(table).order_by(table.c.id).limit(self.batch_size)
+                    if after is not None:
+                        statement = statement.where(table.c.id > after)
+                    rows = source.execute(statement).mappings().all()
+                if not rows:
+                    return
+                with self.target.begin() as target:
+                    ids = [row['id'] for row in rows]
+                    self._apply(target, table, rows, ids)
+            after = rows[-1]['id']
+            self.progress[table.name] += len(rows)
+
+    def copy(self):
+        """按主键顺序分批复制全部表"""
+        self.state = 'copying'
+        begin = time.perf_counter()
+        for table in self.tables:
+            self.progress[table.name] = 0
+            self._copy_table(table)
+        self.counters["copy_seconds"] = round(time.perf_counter() - begin, 3)
+        self.state = 'dual_write'
+
+    def _finish(self):
+        """暂停期间: 同步最后的写入, 补齐取不到 id 的表, 核对行数, 校正自增序列"""
+        self._queue.join()
+        for table in list(self._rescan):
+            self._copy_table(table)
+            self._rescan.discard(table)
+        with self.source.connect() as source, self.target.connect() as target:
+            for table in self.tables:
+                expected = source.execute(select(func.count()).select_from(table)).scalar()
+                copied = target.execute(select(func.count()).select_from(table)).scalar()
+                if expected != copied:
+                    raise MigrationError(f"{table.name} 行数不一致: 源库 {expected}, 目标库 {copied}")
+        if self.target.dialect.name == 'postgresql':
+            with self.target.begin() as target:
+                for table in self.tables:
+                    target.execute(text(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                                        f"coalesce(max(id), 0) + 1, false) FROM \"{table.name}\""))
+
+    def _stop_capture(self, engines):
+        for engine in engines:
+            for name, fn in (('before_execute', self._before_execute), ('after_execute', self._after_execute),
+                             ('checkin', self._on_checkin)):
+                if event.contains(engine, name, fn):
+                    event.remove(engine, name, fn)
+        if self.extra_engines and engines == [self.source]:
+            return  # 切换后 extra_engines 仍写原库, 同步线程继续
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join(timeout=10)
+            self._worker = None
+
+    def cutover(self):
+        """切换到目标库; 失败时抛出 MigrationError, 网站继续使用源库, 双写继续"""
+        self._queue.join()  # 先在暂停之外追上积压的写入, 暂停时只剩最后一点
+        self.state = 'cutover'
+        begin = time.perf_counter()
+        try:
+            self.db.switch_database(self.target_url, self.drain_timeout, before_swap=self._finish, engine=self.target)
+        except (MigrationError, TimeoutError) as e:
+            self.state = 'dual_write'
+            self.error = str(e)
+            raise MigrationError(f"未切换: {e}") from e
+        finally:
+            self.counters["pause_seconds"] = round(time.perf_counter() - begin, 3)
+        # 旧引擎已经没有借出的连接, 之后的写入都在目标库
+        self._stop_capture([self.source])
+        self.state = 'done'
+
+    def abort(self):
+        """放弃迁移, 停止双写; 目标库中已复制的数据保留, 重新开始时会被覆盖"""
+        if self.source is not None:
+            self._stop_capture([self.source] + self.extra_engines)
+        if self.target is not None and self.state != 'done':
+            self.target.dispose()
+        self.state = 'aborted'
+
+    def run(self):
+        """依次执行 start, copy, cutover, 在线程中调用; 出错时停止双写, 网站继续使用源库"""
+        try:
+            if self.state == 'idle':
+                self.start()
+            self.copy()
+            self.cutover()
+        except Exception as e:
+            self.error = repr(e)[:300]
+            self.abort()
+            self.state = 'failed'
+            raise
+
+    def stats(self):
+        url = self.target.url.render_as_string(hide_password=True) if self.target is not None else None
+        return {"state": self.state, "target": url, "error": self.error, "progress": dict(self.progress),
+                "following": [table.name for table in self.tables[len(Base.metadata.sorted_tables):]]
+                if self.state == 'done' and self._worker is not None else [],
+                "pending": self._queue.qsize(), **self.counters}
+
+
+def benchmark_migration(rows=100_000, writers=4):
+    """SQLite 迁到另一个 SQLite 文件(本机没有 PostgreSQL 时的替代): 复制期间 writers 个线程不停下单、支付和改商品,
+       切换后逐表比对两边的数据, 以及切换时暂停的时长
+    """
+    import os
+    import tempfile
+    from datetime import timedelta
+    from sqlalchemy import insert as core_insert
+    from utils.databaseManager import Database, Order, ProdInfo, Card, beijing_now
+    from utils.databaseSchemas import OrderResponse
+
+    folder = tempfile.mkdtemp()
+    source_url, target_url = f'sqlite:///{os.path.join(folder, "source.db")}', f'sqlite:///{os.path.join(folder, "target.db")}'
+    db = Database(source_url, echo=False)
+    db.create_tables()
+    now = beijing_now()
+    with db.engine.begin() as conn:
+        conn.execute(core_insert(ProdInfo), [{"name": f"商品{i}", "prod_price": 1, "state": True} for i in range(50)])
+        conn.execute(core_insert(Card), [{"prod_name": f"商品{i % 50}", "card": f"card-{i}"} for i in range(rows // 10)])
+        for offset in range(0, rows, 50000):
+            conn.execute(core_insert(Order), [
+                {"out_order_id": f"BENCH{i:012d}", "state": 'delivered', "status": True, "name": f"商品{i % 50}",
+                 "payment": "alipay", "num": 1, "price": 1, "total_price": 1, "contact": "-",
+                 "updatetime": now - timedelta(minutes=i)} for i in range(offset, min(rows, offset + 50000))])
+    snapshot, snapshot_seconds = {}, []
+    stop = threading.Event()
+    written = defaultdict(int)
+
+    def write_loop(worker):
+        i = 0
+        while not stop.is_set():
+            i += 1
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(core_insert(Order), [{"out_order_id": f"W{worker}-{i}", "state": 'pending', "status": False,
+                                                       "name": "商品1", "payment": "alipay", "num": 1, "price": 1,
+                                                       "total_price": 1, "contact": "-"}])
+                    conn.execute(update(Order).where(Order.out_order_id == f"W{worker}-{i - 1}").values(state='paid', status=True))
+                    conn.execute(update(Card).where(Card.id == (i * 7 + worker) % (rows // 10) + 1).values(isused=True))
+                    conn.execute(delete(Order).where(Order.out_order_id == f"BENCH{(i * 31 + worker) % rows:012d}"))
+                db.update_data(ProdInfo, {"id": worker + 1, "prod_sales": i})
+                written[worker] += 1
+            except Exception as e:
+                print(f"写入失败: {e!r}")
+            time.sleep(0.001)
+
+    def differences():
+        """两边逐表逐行比对, 返回 {表名: (源库行数, 目标库行数, 不同的行数)}"""
+        result = {}
+        with migration.source.connect() as old, migration.target.connect() as new:
+            for table in Base.metadata.sorted_tables:
+                old_rows = {row['id']: dict(row) for row in old.execute(select(table)).mappings()}
+                new_rows = {row['id']: dict(row) for row in new.execute(select(table)).mappings()}
+                keys = old_rows.keys() | new_rows.keys()
+                result[table.name] = (len(old_rows), len(new_rows),
+                                      sum(1 for key in keys if old_rows.get(key) != new_rows.get(key)))
+        return result
+
+    threads = [threading.Thread(target=write_loop, args=(worker,)) for worker in range(writers)]
+    for thread in threads:
+        thread.start()
+    migration = BackendMigration(db, target_url)
+    finish = migration._finish
+
+    def checked_finish():
+        # 暂停期间两边都没有写入, 同步完最后的写入后应当完全一致
+        finish()
+        begin = time.perf_counter()
+        snapshot.update(differences())
+        snapshot_seconds.append(time.perf_counter() - begin)
+    migration._finish = checked_finish
+    migration.start()
+    migration.copy()
+    time.sleep(0.5)
+    migration.cutover()
+    time.sleep(0.2)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    print(f"迁移完成, 期间写入 {sum(written.values())} 轮, 暂停 {migration.counters['pause_seconds'] - snapshot_seconds[0]:.3f}s"
+          f"(不含比对耗时), {migration.stats()}")
+    print(f"当前数据库: {db.engine.url}, 切换后目标库订单 {db.read_datas(Order, OrderResponse, limit=1)['pager']['total']} 行")
+    for name, (old_count, new_count, differ) in snapshot.items():
+        if old_count or new_count:
+            print(f"  切换时 {name}: 源库 {old_count} 行, 目标库 {new_count} 行, 不同 {differ} 行")
+
+
+if __name__ == '__main__':
+    benchmark_migration()
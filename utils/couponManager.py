@@ -0,0 +1,260 @@
+import hashlib
+import math
+import re
+import secrets
+import threading
+import time
+from typing import Optional
+from sqlalchemy import select, insert, update, or_, bindparam
+from sqlalchemy.exc import IntegrityError
+from utils.databaseManager import Coupon, beijing_now
+
+
+"""
+代码说明：
+优惠券。券码有唯一索引，按券码查找和核销都只走这个索引。
+1. 每个进程在内存里为全部券码维护一个布隆过滤器(10 万个券码约 180KB)：格式不对或过滤器判定不存在的券码直接拒绝，
+   不查询数据库，暴力猜券码的请求碰不到数据库；过滤器只会误判“可能存在”(默认 0.1%)，这时再查数据库确认。
+   本进程新建的券码立即加入过滤器，其它进程新建的券码由定时任务 refresh 沿主键增量加入(默认 30 秒一次)；删除的券码留在过滤器里，只会多一次数据库查询。
+2. 核销是一条带全部使用条件的 UPDATE：启用、剩余次数大于 0、未过期、限定商品、满足最低金额，同时剩余次数减一，
+   按影响行数判断是否成功(MySQL 不支持 UPDATE ... RETURNING)，成功后在同一个事务里读出折扣，这时该行已被本事务锁定；
+   并发核销同一个券码时数据库按行串行执行，剩余次数不会减成负数，也不会超发。
+   核销和订单插入在同一个事务里，库存不足等原因下单失败时核销一起回滚；待支付订单过期时 release 把次数还回去，
+   过期后又支付的订单由 retake 重新扣减一次，次数已用完时不接受这次支付(utils/orderManager.py pay)。
+3. generate 批量生成随机券码：每 chunk_size 个一批，每批一个短事务 executemany 插入，内存里只有一批；
+   与已有券码重复(概率极低)时剔除后补足。生成的券码按批次由 coupon_export 流式导出。
+"""
+
+CODE_ALPHABET = 'ABCDEFGHJKMNPQRSTUVWXYZ23456789'  # 去掉容易看错的 I L O 0 1
+CODE_PATTERN = re.compile(r'^[A-Z0-9_-]{4,32}$')
+
+REDEEM_COUPON = update(Coupon).where(
+    Coupon.code == bindparam('b_code'), Coupon.state == True, Coupon.remaining > 0,
+    or_(Coupon.expires.is_(None), Coupon.expires > bindparam('b_now')),
+    or_(Coupon.prod_name.is_(None), Coupon.prod_name == bindparam('b_name')),
+    Coupon.min_amount <= bindparam('b_total')
+).values(remaining=Coupon.remaining - 1, used=Coupon.used + 1)
+SELECT_DISCOUNT = select(Coupon.discount_type, Coupon.discount).where(Coupon.code == bindparam('b_code'))
+RETAKE_COUPON = update(Coupon).where(Coupon.code == bindparam('b_code'), Coupon.remaining > 0).values(
+    remaining=Coupon.remaining - 1, used=Coupon.used + 1)
+RELEASE_COUPON = update(Coupon).where(Coupon.code == bindparam('b_code')).values(
+    remaining=Coupon.remaining + bindparam('b_count'), used=Coupon.used - bindparam('b_count'))
+INSERT_COUPON = insert(Coupon)
+
+
+def normalize_code(code: str) -> str:
+    return code.strip().upper()
+
+
+def apply_discount(total: float, discount_type: str, discount: float) -> float:
+    """优惠后的总价, 不低于 0"""
+    if discount_type == 'percent':
+        return round(max(0.0, total * (100 - discount) / 100), 2)
+    return round(max(0.0, total - discount), 2)
+
+
+class BloomFilter:
+    """capacity 个元素时误判率约为 error_rate; 双重哈希从一次 blake2b 摘要得到全部位置"""
+
+    def __init__(self, capacity: int, error_rate=0.001):
+        self.capacity = max(capacity, 1000)
+        self.size = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class CouponManager:
+    """might_exist 方法用布隆过滤器预先拒绝无效券码; lookup 方法按券码查询; redeem / release / retake 方法在订单事务中核销、归还和重新扣减;
+       generate 方法批量生成券码, create 方法新建单个券码; refresh 方法把其它进程新建的券码加入过滤器; stats 方法返回计数。
+    """
+
+    def __init__(self, db, capacity=100_000, error_rate=0.001):
+        self.db = db
+        self.error_rate = error_rate
+        self._filter = BloomFilter(capacity, error_rate)
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self.counters = {"checks": 0, "format_rejects": 0, "filter_rejects": 0, "db_lookups": 0, "db_misses": 0,
+                         "redeemed": 0, "redeem_failed": 0, "retake_failed": 0, "released": 0, "generated": 0}
+
+    def refresh(self) -> int:
+        """把上次之后新建的券码加入过滤器, 返回加入的个数; 超出容量时按两倍容量重建, 误判率不随券码增多而上升"""
+        with self._lock:
+            with self.db.engine.connect() as conn:
+                rows = conn.execute(select(Coupon.id, Coupon.code).where(Coupon.id > self._last_id)
+                                    .order_by(Coupon.id)).all()
+                if not rows:
+                    return 0
+                if self._filter.count + len(rows) > self._filter.capacity:
+                    rebuilt = BloomFilter(2 * (self._filter.count + len(rows)), self.error_rate)
+                    rows = conn.execute(select(Coupon.id, Coupon.code).order_by(Coupon.id)).all()
+                    for _, code in rows:
+                        rebuilt.add(code)
+                    self._filter = rebuilt
+                else:
+                    for _, code in rows:
+                        self._filter.add(code)
+            self._last_id = max(self._last_id, rows[-1][0])
+            return len(rows)
+
+    def might_exist(self, code: str) -> bool:
+        """格式正确且过滤器中可能存在; 返回 False 时券码一定无效"""
+        self.counters["checks"] += 1
+        code = normalize_code(code)
+        if not CODE_PATTERN.match(code):
+            self.counters["format_rejects"] += 1
+            return False
+        if code not in self._filter:
+            self.counters["filter_rejects"] += 1
+            return False
+        return True
+
+    def lookup(self, code: str):
+        """按券码查询, 返回 Row 或 None; 过滤器判定不存在时不查询数据库"""
+        if not self.might_exist(code):
+            return None
+        self.counters["db_lookups"] += 1
+        with self.db.engine.connect() as conn:
+            row = conn.execute(select(*Coupon.__table__.columns).where(Coupon.code == normalize_code(code))).first()
+        if row is None:
+            self.counters["db_misses"] += 1
+        return row
+
+    def redeem(self, conn, code: str, name: str, total: float) -> Optional[float]:
+        """在调用方的事务中核销一次, 返回优惠后的总价; 券码不可用于这笔订单时返回 None"""
+        code = normalize_code(code)
+        if conn.execute(REDEEM_COUPON, {"b_code": code, "b_now": beijing_now(), "b_name": name,
+                                        "b_total": total}).rowcount != 1:
+            self.counters["redeem_failed"] += 1
+            return None
+        self.counters["redeemed"] += 1
+        return apply_discount(total, *conn.execute(SELECT_DISCOUNT, {"b_code": code}).one())
+
+    def retake(self, conn, code: str) -> bool:
+        """在调用方的事务中重新扣减一次, 用于已归还次数的过期订单又支付; 次数已用完时返回 False"""
+        if conn.execute(RETAKE_COUPON, {"b_code": code}).rowcount != 1:
+            self.counters["retake_failed"] += 1
+            return False
+        self.counters["redeemed"] += 1
+        return True
+
+    def release(self, conn, codes: dict):
+        """在调用方的事务中归还使用次数 {券码: 次数}, 用于待支付订单过期"""
+        if codes:
+            conn.execute(RELEASE_COUPON, [{"b_code": code, "b_count": count} for code, count in codes.items()])
+            self.counters["released"] += sum(codes.values())
+
+    def _add_codes(self, codes):
+        with self._lock:
+            for code in codes:
+                self._filter.add(code)
+
+    def create(self, code: str, **terms) -> str:
+        """新建单个券码, terms 为 Coupon 的其它列; 券码已存在时抛出 ValueError"""
+        code = normalize_code(code)
+        if not CODE_PATTERN.match(code):
+            raise ValueError("券码应为 4~32 位字母、数字、- 或 _")
+        try:
+            with self.db.engine.begin() as conn:
+                conn.execute(INSERT_COUPON, [{**terms, "code": code}])
+        except IntegrityError:
+            raise ValueError("券码已存在")
+        self._add_codes([code])
+        return code
+
+    def generate(self, count: int, batch: Optional[str] = None, length=12, chunk_size=5000, **terms) -> dict:
+        """随机生成 count 个不重复的券码, 每 chunk_size 个一个事务, 返回 {"batch": 批次, "created": 个数}"""
+        batch = batch or f"B{beijing_now():%Y%m%d%H%M%S}{secrets.token_hex(2).upper()}"
+        created = 0
+        while created < count:
+            codes = set()
+            while len(codes) < min(chunk_size, count - created):
+                codes.add(''.join(secrets.choice(CODE_ALPHABET) for _ in range(length)))
+            try:
+                with self.db.engine.begin() as conn:
+                    conn.execute(INSERT_COUPON, [{**terms, "code": code, "batch": batch} for code in codes])
+            except IntegrityError:
+                # 和已有券码重复: 剔除已有的再插入这一批, 不足的下一轮补
+                with self.db.engine.connect() as conn:
+                    codes -= set(conn.execute(select(Coupon.code).where(Coupon.code.in_(codes))).scalars())
+                with self.db.engine.begin() as conn:
+                    conn.execute(INSERT_COUPON, [{**terms, "code": code, "batch": batch} for code in codes])
+            self._add_codes(codes)
+            created += len(codes)
+        self.counters["generated"] += created
+        return {"batch": batch, "created": created}
+
+    def stats(self):
+        return {**self.counters, "filter_codes": self._filter.count, "filter_capacity": self._filter.capacity,
+                "filter_bytes": len(self._filter.bits)}
+
+
+def benchmark_coupons(total=100_000, attempts=100_000, concurrency=16, uses=100):
+    """批量生成 total 个券码的耗时; attempts 次随机猜券码有多少查询了数据库; concurrency 个线程同时核销一个可用 uses 次的券码"""
+    import os
+    import tempfile
+    import tracemalloc
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy import func
+    from utils.databaseManager import Database
+
+    db = Database(f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}', echo=False)
+    db.create_tables()
+    coupons = CouponManager(db)
+    tracemalloc.start()
+    begin = time.perf_counter()
+    result = coupons.generate(total, discount_type='amount', discount=1)
+    elapsed = time.perf_counter() - begin
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    with db.engine.connect() as conn:
+        distinct = conn.execute(select(func.count(Coupon.code.distinct()))).scalar()
+    print(f"生成 {result['created']} 个券码 {elapsed:.2f}s, 内存峰值 {peak / 1024 / 1024:.1f}MB, 不重复 {distinct} 个, "
+          f"过滤器 {len(coupons._filter.bits) / 1024:.0f}KB")
+
+    # 另一个进程: 从数据库加载过滤器
+    other = CouponManager(db)
+    begin = time.perf_counter()
+    loaded = other.refresh()
+    print(f"新进程加载 {loaded} 个券码到过滤器 {time.perf_counter() - begin:.2f}s")
+
+    guesses = [''.join(secrets.choice(CODE_ALPHABET) for _ in range(12)) for _ in range(attempts)]
+    begin = time.perf_counter()
+    found = sum(1 for code in guesses if other.lookup(code) is not None)
+    guessed = (time.perf_counter() - begin) / attempts * 1e6
+    with db.engine.connect() as conn:
+        real = conn.execute(select(Coupon.code).limit(1)).scalar()
+    print(f"{attempts} 次随机猜券码: 每次 {guessed:.1f}us, 命中 {found}, 查询数据库 {other.counters['db_lookups']} 次; "
+          f"真实券码查询到: {other.lookup(real) is not None}")
+
+    coupons.create('BENCH-CONCURRENT', discount_type='percent', discount=10, remaining=uses)
+
+    def redeem(_):
+        with db.engine.begin() as conn:
+            return coupons.redeem(conn, 'BENCH-CONCURRENT', '任意商品', 100.0)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(redeem, range(uses * 3)))
+    with db.engine.connect() as conn:
+        remaining, used = conn.execute(select(Coupon.remaining, Coupon.used)
+                                       .where(Coupon.code == 'BENCH-CONCURRENT')).one()
+    print(f"{concurrency} 个线程核销 {uses * 3} 次: 成功 {sum(r is not None for r in results)} 次 "
+          f"(优惠后 {set(r for r in results if r is not None)}), 剩余 {remaining}, 已用 {used}")
+
+
+if __name__ == '__main__':
+    benchmark_coupons()
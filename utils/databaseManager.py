@@ -1,23 +1,36 @@
+import ast
+import asyncio
+import json
+import threading
+import time
 from typing import TypeVar, List
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, Float
+from sqlalchemy import create_engine, event, update, Column, Integer, String, DateTime, Text, Boolean, Float, Index, UniqueConstraint, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 from sqlalchemy.future import select
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import func, desc, inspect
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError
+from sqlalchemy import func, inspect, or_, exists, tuple_, bindparam
 from contextlib import contextmanager
 from utils.usersManager import User
+from utils.readReplica import ReplicaSet, pin_primary, is_disconnect
 
 T = TypeVar('T', bound=DeclarativeMeta)
 Base = declarative_base()
 
 
+def beijing_now():
+    """当前北京时间, 作为时间列的默认值在每次插入时调用"""
+    return datetime.utcnow() + timedelta(hours=8)
+
+
 class LoginLog(Base):
     __tablename__ = 'login_log'  # 登录日志
     id = Column(Integer, primary_key=True, autoincrement=True)
     ip = Column(String(100), nullable=False)
-    updatetime = Column(DateTime, nullable=True, default=datetime.utcnow() + timedelta(hours=8))  # 存储变更时间
+    updatetime = Column(DateTime, nullable=True, default=beijing_now, index=True)  # 存储变更时间
+    user_id = Column(String(36), nullable=True)  # 用户ID
+    event = Column(String(20), nullable=True, default='login')  # 事件 login/register
 
 
 class Payment(Base):
@@ -42,14 +55,17 @@ class ProdCag(Base):
 class ProdInfo(Base):
     __tablename__ = 'prod_info'  # 产品信息
     __mapper_args__ = {'confirm_deleted_rows': False}
+    __table_args__ = (Index('ix_prod_info_cag_state', 'prod_cag_id', 'state'), Index('ix_prod_info_sales', 'prod_sales'))
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(150), nullable=False, unique=True)  # 商品名称
+    prod_cag_id = Column(Integer, ForeignKey('prod_cag.id', ondelete='SET NULL'), nullable=True)  # 所属分类ID, 由 prod_cag_name 自动关联
     prod_cag_name = Column(String(50))  # 所属分类
     prod_info = Column(String(150), nullable=True)  # 产品一句话描述
     prod_img_url = Column(String(150), nullable=True)  # 主图
     prod_discription = Column(Text, nullable=True)  # 完整描述
     prod_price = Column(Float, nullable=False, default=888)  # 价格
-    prod_price_wholesale = Column(String(150), nullable=True)  # 批发价格
+    prod_price_wholesale = Column(String(150), nullable=True)  # 批发价格, 前台展示的文字
+    prod_price_tiers = Column(Text, nullable=True)  # 批发阶梯价 JSON [[起购数量, 单价], ...], 见 utils/pricing.py
     prod_sales = Column(Integer, nullable=True, default=0)  # 销量
     # iswholesale = Column(Text, nullable=False,default=False)  #是否启用折扣
     prod_tag = Column(String(50), nullable=True, default='优惠折扣')  # 产品标签
@@ -62,24 +78,59 @@ class ProdInfo(Base):
 class Order(Base):
     __tablename__ = 'order'  # 订单信息
     __mapper_args__ = {'confirm_deleted_rows': False}
+    __table_args__ = (Index('ix_order_state_updatetime', 'state', 'updatetime'),)
     id = Column(Integer, primary_key=True, autoincrement=True)
-    status = Column(Boolean, nullable=True, default=True)  # 订单状态
-    out_order_id = Column(String(50), nullable=False)  # 订单ID
+    status = Column(Boolean, nullable=True, default=True)  # 订单状态 已支付为1
+    state = Column(String(20), nullable=True, default='pending')  # 订单流程 pending/paid/delivered/expired
+    out_order_id = Column(String(50), nullable=False, unique=True)  # 订单ID
     name = Column(String(50), nullable=False)  # 商品名
     payment = Column(String(50), nullable=False)  # 支付渠道
     num = Column(Integer, nullable=False)  # 数量
     price = Column(Float, nullable=False)  # 价格
-    # coupon = Column(String(50), nullable=True)  # TODO 优惠券
+    coupon = Column(String(32), nullable=True)  # 使用的优惠券码
     total_price = Column(Float, nullable=False)  # 总价
     contact_txt = Column(Text, nullable=True)  # 附加信息
-    updatetime = Column(DateTime, nullable=False, default=datetime.utcnow() + timedelta(hours=8))  # 存储当前时间
+    updatetime = Column(DateTime, nullable=False, default=beijing_now)  # 存储当前时间
     contact = Column(String(50))  # 联系方式
     card = Column(Text, nullable=True)  # 卡密
+    user_id = Column(String(36), nullable=True)  # 下单用户ID, 游客下单为空
+    sales_counted = Column(Boolean, nullable=True, default=False, index=True)  # 是否已计入商品销量, 见 utils/salesCounter.py
+
+
+# 个人订单历史: 按 用户/联系方式 等值定位, 再沿 (updatetime, id) 倒序范围扫描
+Index('ix_order_user_updatetime', Order.user_id, Order.updatetime.desc(), Order.id.desc())
+Index('ix_order_contact_updatetime', Order.contact, Order.updatetime.desc(), Order.id.desc())
+
+
+class OrderRollup(Base):
+    __tablename__ = 'order_rollup'  # 已归档订单按天、商品汇总, 仪表盘的累计数据 = 订单表 + 本表
+    __table_args__ = (UniqueConstraint('day', 'name', name='uq_order_rollup_day_name'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    day = Column(String(10), nullable=False)  # 下单日期 YYYY-MM-DD
+    name = Column(String(50), nullable=False)  # 商品名
+    orders = Column(Integer, nullable=False, default=0)  # 订单数
+    paid_orders = Column(Integer, nullable=False, default=0)  # 成交订单数 status 为 1
+    revenue = Column(Float, nullable=False, default=0)  # 订单总价合计
+
+
+class PaymentCallback(Base):
+    __tablename__ = 'payment_callback'  # 支付回调幂等记录
+    __mapper_args__ = {'confirm_deleted_rows': False}
+    __table_args__ = (UniqueConstraint('out_order_id', 'trade_no', name='uq_payment_callback_order_trade'),
+                      Index('ix_payment_callback_state', 'state'))
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    payment = Column(String(50), nullable=False)  # 支付渠道
+    out_order_id = Column(String(50), nullable=False)  # 订单ID
+    trade_no = Column(String(100), nullable=False)  # 支付平台交易号
+    amount = Column(Float, nullable=True)  # 实付金额
+    state = Column(String(20), nullable=False, default='received')  # received/fulfilled/rejected
+    updatetime = Column(DateTime, nullable=False, default=beijing_now)  # 首次收到时间
 
 
 class Card(Base):
     __tablename__ = 'card'  # 卡密
     __mapper_args__ = {'confirm_deleted_rows': False}
+    __table_args__ = (Index('ix_card_prod_name_reuse_isused', 'prod_name', 'reuse', 'isused'),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     prod_name = Column(String(50), nullable=False)  # 商品ID
     card = Column(Text, nullable=False)  # 卡密
@@ -87,6 +138,19 @@ class Card(Base):
     isused = Column(Boolean, nullable=True, default=False)  # 是否已用
 
 
+class ImageInfo(Base):
+    __tablename__ = 'image_info'  # 图床图像索引
+    __mapper_args__ = {'confirm_deleted_rows': False}
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(100), nullable=False, unique=True)  # 文件名
+    hash = Column(String(64), nullable=False, index=True)  # 内容sha256
+    size = Column(Integer, nullable=False)  # 字节数
+    mime = Column(String(50), nullable=True)  # 类型
+    width = Column(Integer, nullable=True)  # 宽
+    height = Column(Integer, nullable=True)  # 高
+    updatetime = Column(DateTime, nullable=False, default=beijing_now, index=True)  # 上传时间
+
+
 class Config(Base):
     __tablename__ = 'config'  # 系统配置
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -94,7 +158,7 @@ class Config(Base):
     info = Column(Text, nullable=True)  # 值
     description = Column(Text, nullable=False)  # 描述
     isshow = Column(Boolean, nullable=False, default=False)  # 描述
-    updatetime = Column(DateTime, nullable=True, default=datetime.utcnow() + timedelta(hours=8))  # 交易时间
+    updatetime = Column(DateTime, nullable=True, default=beijing_now)  # 交易时间
 
 
 class Plugin(Base):
@@ -116,6 +180,74 @@ class Notice(Base):
     user_switch = Column(Boolean, nullable=True, default=False)  # 用户开关
 
 
+class Coupon(Base):
+    __tablename__ = 'coupon'  # 优惠券, 见 utils/couponManager.py
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    code = Column(String(32), nullable=False, unique=True)  # 券码, 唯一索引用于按券码查找
+    batch = Column(String(50), nullable=True, index=True)  # 生成批次, 批量生成的券码同一批次
+    discount_type = Column(String(10), nullable=False, default='amount')  # amount 立减金额 / percent 折扣百分比
+    discount = Column(Float, nullable=False)  # 立减金额, 或减去总价的百分比 (10 即 9 折)
+    min_amount = Column(Float, nullable=False, default=0)  # 订单总价满多少可用
+    prod_name = Column(String(150), nullable=True)  # 限定商品, 为空时全部商品可用
+    remaining = Column(Integer, nullable=False, default=1)  # 剩余可用次数
+    used = Column(Integer, nullable=False, default=0)  # 已使用次数
+    expires = Column(DateTime, nullable=True)  # 过期时间, 为空时长期有效
+    state = Column(Boolean, nullable=False, default=True)  # 启用为1
+    updatetime = Column(DateTime, nullable=False, default=beijing_now)  # 创建时间
+
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migration'  # 已执行的数据库结构迁移, 见 utils/schemaMigrations.py
+    id = Column(Integer, primary_key=True, autoincrement=False)  # 迁移版本号
+    name = Column(String(100), nullable=False)  # 迁移名称
+    seconds = Column(Float, nullable=True)  # 执行耗时
+    updatetime = Column(DateTime, nullable=False, default=beijing_now)  # 完成时间
+
+
+class SchedulerLease(Base):
+    __tablename__ = 'scheduler_lease'  # 定时任务的主节点租约, 见 utils/scheduler.py
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(50), nullable=False, unique=True)  # 租约名称
+    owner = Column(String(100), nullable=False)  # 持有者 主机名:进程号:随机串
+    expires = Column(DateTime, nullable=False)  # 到期时间, 过期后其它进程可以接手
+
+
+# 商品按 prod_cag_id 关联分类, prod_cag_name 保留为分类名称的冗余副本, 接口仍然按名称读写;
+# 以下 ORM 事件让两者保持一致, 旧数据库升级时 ALTER TABLE 加上的列没有外键约束, 改名和删除的级联也在这里完成
+@event.listens_for(ProdInfo, 'before_insert')
+@event.listens_for(ProdInfo, 'before_update')
+def link_prod_cag(mapper, connection, target):
+    """新增商品或修改了分类名称时, 按名称查出分类ID, 找不到分类时为空"""
+    if target.prod_cag_id is not None and not inspect(target).attrs.prod_cag_name.history.has_changes():
+        return
+    target.prod_cag_id = connection.execute(select(ProdCag.id).where(ProdCag.name == target.prod_cag_name)).scalar() \
+        if target.prod_cag_name else None
+
+
+@event.listens_for(ProdCag, 'after_update')
+def rename_prod_cag(mapper, connection, target):
+    if inspect(target).attrs.name.history.has_changes():
+        connection.execute(update(ProdInfo).where(ProdInfo.prod_cag_id == target.id).values(prod_cag_name=target.name))
+
+
+@event.listens_for(ProdCag, 'before_delete')
+def unlink_prod_cag(mapper, connection, target):
+    """删除分类时商品变为未分类, 不会留下指向已删除分类的名称"""
+    connection.execute(update(ProdInfo).where(ProdInfo.prod_cag_id == target.id).values(prod_cag_id=None,
+                                                                                         prod_cag_name=None))
+# 存放 JSON 配置的表, 旧版本中以 Python 字面量字符串保存
+CONFIG_MODELS = (Payment, Notice, Plugin)
+
+
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """SQLite 开启 WAL, 读写互不阻塞, 提交时不必每次 fsync"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
 """
 代码说明：
 基础配置：
@@ -124,6 +256,37 @@ User 是一个示例模型，用于演示数据库操作。
 """
 
 
+class ReadSession(Session):
+    """read_scope 的会话: 从副本读取时语句因连接断开失败, 调用 fallback 标记副本不可用并换成主库连接, 重试这一条语句"""
+
+    def __init__(self, *args, fallback=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._fallback = fallback
+
+    def execute(self, *args, **kwargs):
+        try:
+            return super().execute(*args, **kwargs)
+        except DBAPIError as e:
+            if self._fallback is None or not is_disconnect(e):
+                raise
+            fallback, self._fallback = self._fallback, None
+            self.rollback()
+            self.bind = fallback(e)
+            return super().execute(*args, **kwargs)
+
+
+class DatabaseSwitching(Exception):
+    """数据库切换期间在事件循环线程中访问数据库; 不在事件循环里等待, 由 app.py 返回 503 让客户端稍后重试"""
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
 class Database:
     """__init__ 方法初始化数据库连接。
        create_tables 方法创建数据库表。
@@ -136,7 +299,10 @@ class Database:
        delete_data 方法删除记录。
        get_all_records 方法获取所有记录。
        clear_table 方法清空表。
-       switch_database 方法切换数据库。
+       switch_database 方法切换数据库, 切换时等待进行中的事务结束, 不会换掉正在使用的引擎;
+       切换期间线程中的数据库访问等待切换完成, 事件循环线程中的访问立即抛出 DatabaseSwitching, 不阻塞事件循环。
+       read_scope 提供一个只读事务范围, 配置了只读副本 (replica_urls) 时从副本读取, read_* / search_* 方法都使用它。
+       列表查询(read_datas / search_filter / search_filter_page_turning 等)只取表的各列, 结果是 Row(具名元组)而不是 ORM 对象。
        使用方法：
        实例化 Database 类并传入数据库 URL。
        调用 create_tables 方法创建表。
@@ -144,20 +310,51 @@ class Database:
        使用 switch_database 方法切换到其他数据库。
     """
 
-    def __init__(self, db_url='sqlite:///database/database.db'):
+    def __init__(self, db_url='sqlite:///database/database.db', echo=True, replica_urls=()):
         self.db_url = db_url
-        self.engine = self._create_engine(db_url)
-        self.Session = sessionmaker(bind=self.engine)
-
-    def _create_engine(self, db_url):
+        self.echo = echo
+        self._serving = threading.Event()  # 切换数据库期间清除, 新的数据库访问等待切换完成
+        self._serving.set()
+        self._engine = self._create_engine(db_url)
+        self._Session = self._sessionmaker(self._engine)
+        self.replicas = ReplicaSet([(url, self._create_engine(url, readonly=True)) for url in replica_urls])
+
+    def _wait_serving(self):
+        if not self._serving.is_set():
+            if _on_event_loop():
+                raise DatabaseSwitching("数据库切换中, 请稍后重试")
+            self._serving.wait()
+
+    @property
+    def engine(self):
+        self._wait_serving()
+        return self._engine
+
+    @property
+    def Session(self):
+        self._wait_serving()
+        return self._Session
+
+    def _create_engine(self, db_url, readonly=False):
         if 'sqlite' in db_url:
-            return create_engine(db_url, echo=True,
-                                 # pool_size=5,
-                                 # max_overflow=10,
-                                 # connect_args={'check_same_thread': False, 'timeout': 10}
-                                 )
+            engine = create_engine(db_url, echo=self.echo,
+                                   # pool_size=5,
+                                   # max_overflow=10,
+                                   # connect_args={'check_same_thread': False, 'timeout': 10}
+                                   )
+            if not readonly:  # 只读打开的副本不能切换日志模式
+                event.listen(engine, 'connect', set_sqlite_pragma)
+            return engine
         else:
-            return create_engine(db_url, echo=True, pool_size=20, max_overflow=0)
+            return create_engine(db_url, echo=self.echo, pool_size=20, max_overflow=0)
+
+    @staticmethod
+    def _sessionmaker(engine):
+        # 会话都是用完即关的短会话, 提交后不必让对象过期: 返回的对象在会话关闭后仍可读取属性, 不会再去查询
+        Session = sessionmaker(bind=engine, expire_on_commit=False)
+        # 读己之写: ORM 写入过主库之后, 当前请求余下的读取都走主库
+        event.listen(Session, 'after_flush', lambda session, flush_context: pin_primary())
+        return Session
 
     def table_names(self):
         inspector = inspect(self.engine)  # 使用inspect来检查数据库中的表
@@ -168,6 +365,51 @@ class Database:
         """创建数据库表"""
         Base.metadata.create_all(self.engine)
 
+    def migrate_config_json(self):
+        """把 Python 字面量格式的 config 转换为 JSON, 已经是 JSON 的跳过, 返回转换条数"""
+        converted = 0
+        for model in CONFIG_MODELS:
+            with self.engine.begin() as conn:
+                for uid, config in conn.execute(select(model.id, model.config)).all():
+                    if config is None:
+                        continue
+                    try:
+                        json.loads(config)
+                        continue
+                    except ValueError:
+                        pass
+                    try:
+                        value = ast.literal_eval(config)
+                    except (ValueError, SyntaxError) as e:
+                        print(f"数据库升级: {model.__tablename__}.{uid} 配置无法解析 {e}")
+                        continue
+                    conn.execute(update(model).where(model.id == uid).values(config=json.dumps(value, ensure_ascii=False)))
+                    converted += 1
+        if converted:
+            print(f"数据库升级: {converted} 条配置转换为 JSON")
+        return converted
+
+    def migrate_other_optional_json(self):
+        """把旧版本以 Python 字面量保存的综合设置 other_optional 转换为 JSON, 已经是 JSON 的跳过, 返回是否转换"""
+        with self.engine.begin() as conn:
+            info = conn.execute(select(Config.info).where(Config.name == 'other_optional')).scalar()
+            if not info:
+                return False
+            try:
+                json.loads(info)
+                return False
+            except ValueError:
+                pass
+            try:
+                value = ast.literal_eval(info)
+            except (ValueError, SyntaxError) as e:
+                print(f"数据库升级: 综合设置无法解析 {e}")
+                return False
+            conn.execute(update(Config).where(Config.name == 'other_optional')
+                         .values(info=json.dumps(value, ensure_ascii=False)))
+        print("数据库升级: 综合设置转换为 JSON")
+        return True
+
     def drop_tables(self):
         """删除数据库表"""
         Base.metadata.drop_all(self.engine)
@@ -177,11 +419,35 @@ class Database:
         with self.session_scope() as session:
             session.query(model).delete()
 
-    def switch_database(self, new_db_url):
-        """切换数据库"""
-        self.db_url = new_db_url
-        self.engine = self._create_engine(new_db_url)
-        self.Session = sessionmaker(bind=self.engine)
+    def switch_database(self, new_db_url, drain_timeout=10, before_swap=None, engine=None):
+        """切换数据库: 暂停新的数据库访问, 等待旧连接池中借出的连接都归还, 一次换上新的引擎后恢复, 最后释放旧连接池
+           before_swap 在暂停期间、换引擎之前调用(如迁移时同步最后的写入), 抛出异常时不切换;
+           有 before_swap 时旧连接在 drain_timeout 秒内没有全部归还会抛出 TimeoutError, 不切换
+           engine 为调用方已经建好的新引擎, 不传时按 new_db_url 新建
+        """
+        new_engine = engine if engine is not None else self._create_engine(new_db_url)
+        old_engine = self._engine
+        self._serving.clear()
+        try:
+            deadline = time.monotonic() + drain_timeout
+            while old_engine.pool.checkedout() and time.monotonic() < deadline:
+                time.sleep(0.005)
+            if old_engine.pool.checkedout():
+                if before_swap is not None:
+                    raise TimeoutError(f"{drain_timeout} 秒内仍有 {old_engine.pool.checkedout()} 个连接未归还")
+                print(f"切换数据库: 仍有 {old_engine.pool.checkedout()} 个连接未归还, 它们归还后关闭")
+            if before_swap is not None:
+                before_swap()
+            self._engine, self._Session = new_engine, self._sessionmaker(new_engine)
+            self.db_url = new_db_url
+            self.replicas = ReplicaSet()  # 原来的副本属于旧库, 不再使用
+        except Exception:
+            if engine is None:
+                new_engine.dispose()
+            raise
+        finally:
+            self._serving.set()
+        old_engine.dispose()
 
     def create_example_data(self):
         """创建示例数据"""
@@ -190,29 +456,29 @@ class Database:
         # self.create_data(Smtp('demo@qq.com', '卡密发卡网', 'smtp.qq.com', '465', 'xxxxxxxxx', True))
 
         # 支付渠道
-        self.create_data(Payment(name='支付宝当面付', icon='支付宝', config="{'APPID':'2016091800537528','alipay_public_key':'MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA4AHTfGleo8WI3qb+mSWOjJRyn6Vh8XvO6YsQmJjPnNKhvACHTHcU+PCUWUKZ54fSVhMkFZEQWMtAGeOt3lGy3pMBS96anh841gxJc2NUljU14ESXnDn4QdVe4bosmYvfko46wfA0fGClHdpO8UUiJGLj1W5alv10CwiCrYRDtx93SLIuQgwJn4yBC1/kE/KENOaWaA45dXIQvKh2P0lTbm0AvwYMVvYB+eB1GtOGQbuFJXUxWaMa0byTo9wSllhgyiIkOH+HJ9oOZIweGlsrezeUUdr3EEX97k25LdnUt/oQK8FIfthexfWZpTDDlHqmI7p6gCtRVDJenU4sxwpEyQIDAQAB','app_private_key':'MIIEvAIBADANBgkqhkiG9w0BAQEFAASCBKYwggSiAgEAAoIBAQCqWmxsyPLwRmZHwoLYlUJXMF7PATKtvp7BrJfwLbxwrz6I48G11HpPPyAoNynwAMG7DCXjVX76NCbmfvvPqnbk09rNRULqGju8G6NkQTbLfDjhJs+CE8kdIs89btxqDG70ebePiZTGpQngPLfrziKDOhRfXkA5qRPImbC+PUXiXq9qvkp9Yu/8IYjyxUpNBNjZuTK+fTjSI0RCt7eE+wR0KqpNIzot1q/ds1KTIYmJQM5tEFie4BK0pDtGiIs/VrUG8PTPqLyzEyIMy1N75olUWAiGrk0USqiieP3TYj0PdlQDX2T14DOwMkl5Rjvt7Knc+WGdolPIBssUX1wTE+J7AgMBAAECggEAWpRP+Jv0yRu1wMxFRKJArxmSH+GUL9wej/6Un2nCO+yChMkNtAAxtLdtAtUqIGpWmH2CG9nW9XULhh3ZCPer1kprmiAMz2t5fbD4dRNT7miz2cwIJDMfCbX7mb+7xUutJ6Mcnl7aU7FnierfJKvrn/ke4gK8haxIT66g0tbDtPQhYnGPawyM+gqFulaMBcuqH0naAIq5ZBWHkKuuwJ1SD6yGrWgHdq3Kt2pE8b9yjfdUl15IeW0rszXG6fTika9WX6qaulyoGAAZdjiXED+mbRyqZA3jq7RI38qBP9+/jAb+fdwE8EwqnpPvfGHMBdkREOXK0kzRU8rpd9GbH7INaQKBgQDwpuW+bK/qxKx3BSAXL98f0J2I7YVuk0EFCStGoxnzWRv0yvL0QEDwN+QPiVMmcVQcr79mW5zTBkd4vmr3ud+v1f/X6UPI82kQhZlVWry8LEnisPlZuE0E/EaJrLgF7z4l3ItzCVi8IfpgizPcCYSz/vY49a5W34eKjXHWUB1jDwKBgQC1N8PgGKI2LRDaJeqt5Ef6yyYSMOgVe0WSqAlgyMECb1pjmMBjcNG1AFE/FfgNu4thOaXIogElGVoQFvA5GuJQY48HOJNgx3Ua2SxiowcXkAN0gIm4FY+ozkp7xhizvLVfsmX+MKqPtl6nggiWETJJyvMQnjMgKLmSvhsopMwZ1QKBgGV36az2BOK3VITGq3Y7YBf5DUN76uPpwOOPryiUgs+hhfEcVX55TSg8WLPYUjAGXtHNpKVTAXfU0PPvTgjv3Yo1cC+okkU7pNQrkLB1lti8z9Z+ilSzKf5tJIzOP7V437p1GHNDwJ9qsDhe2VnwxXxjh4wSwxSsIWlhJFuZ4hovAoGAFgm8Fmqof3InlH/79D3IyyUdciTkdIhTQ6yPx2dioYstMOOIsg8sUZjCSKvBSNo/7wj1slqRTROyMja37Bnq39/bqwMkWSaohSVYEn7FBAaNhQOEvBBTMjI0OK00n9cZL5QgdzMv6t5A0JottSJOPU8jFChJC2Yoe0IHR4ATGikCgYB2smi7/ptKiGdwmiuUHsF/U3jfjpHyHwLrXjoSU+mwV+GjqcdbtkSP1suGjN8tcdbFvLSCRX/IRdFHYJeuPUXQtZtiC431+upasbEiJ1xZ2KcK3lKf0mOn10kPD5QC7mmsfmjz4cw9cSrBjmcWGXeIwIXPLhOAAIzpHqy8oP/F/g=='}", info='alipay.com 官方接口0.38~0.6%', isactive=True))
-        self.create_data(Payment(name='微信官方接口', icon='微信支付', config="{'APPID':'XXXXXXXX','MCH_ID':'XXXXXX','APP_SECRET':'XXXXXX'}", info='pay.weixin.qq.com 微信官方0.38%需要营业执照', isactive=False))
-        self.create_data(Payment(name='QQ钱包', icon='QQ支付', config="{'mch_id':'XXXXXXXX','key':'YYYYY'}", info='mp.qpay.tenpay.com QQ官方0.6%需要营业执照', isactive=False))
-        self.create_data(Payment(name='虎皮椒支付宝', icon='支付宝', config="{'API':'api.vrmrgame.com','appid':'XXXXXX','AppSecret':'YYYYY'}", info='xunhupay.com 个人接口0.38%+1~2%', isactive=False))
-        self.create_data(Payment(name='虎皮椒微信', icon='微信支付', config="{'API':'api.vrmrgame.com','appid':'XXXXXX','AppSecret':'YYYYY'}", info='xunhupay.com 个人接口0.38~0.6%+1~2%', isactive=False))
-        self.create_data(Payment(name='PAYJS支付宝', icon='支付宝', config="{'payjs_key':'XXXXXX','mchid':'YYYYY','mchid':'ZZZZZZZ'}", info='payjs.cn 个人接口2.38%', isactive=False))
-        self.create_data(Payment(name='PAYJS微信', icon='微信支付', config="{'payjs_key':'XXXXXX','mchid':'YYYYY','mchid':'ZZZZZZZ'}", info='payjs.cn 个人接口2.38%', isactive=False))
-        self.create_data(Payment(name='迅虎微信', icon='微信支付', config="{'ID':'XXXXXX','Key':'YYYYY',}", info='pay.xunhuweb.com 个人接口0.38~0.6%+1~2%', isactive=False))   # https://admin.xunhuweb.com/pay/payment 返回系统异常错误
-        self.create_data(Payment(name='码支付支付宝', icon='支付宝', config="{'codepay_id':'58027','codepay_key':'fgl454542WSDJHEJHDJZpTRrmbn','token':'jljCGU3pRvXXXXXXXXXXXb1iq'}", info='codepay.fateqq.com[不可用]', isactive=False))
-        self.create_data(Payment(name='码支付微信', icon='微信支付', config="{'codepay_id':'58027','codepay_key':'fgl454542WSDJHEJHDJZpTRrmbn','token':'jljCGU3pRvXXXXXXXXXXXb1iq'}", info='codepay.fateqq.com[不可用]', isactive=False))
-        self.create_data(Payment(name='码支付QQ', icon='QQ支付', config="{'codepay_id':'58027','codepay_key':'fgl454542WSDJHEJHDJZpTRrmbn','token':'jljCGU3pRvXXXXXXXXXXXb1iq'}", info='codepay.fateqq.com[不可用]', isactive=False))
-        self.create_data(Payment(name='V免签支付宝', icon='支付宝', config="{'API':'http://google.com','KEY':'YYYYYYYY'}", info='0费率实时到账', isactive=False))
-        self.create_data(Payment(name='V免签微信', icon='微信', config="{'API':'http://google.com','KEY':'YYYYYYYY'}", info='0费率实时到账', isactive=False))
-        self.create_data(Payment(name='云免签支付宝', icon='支付宝', config="{'APP_ID':'XXXX','KEY':'YYYYYYYY'}", info='云端监控yunmianqian.com', isactive=False))
-        self.create_data(Payment(name='云免签微信', icon='微信', config="{'APP_ID':'XXXX','KEY':'YYYYYYYY'}", info='云端监控yunmianqian.com', isactive=False))
-        self.create_data(Payment(name='易支付QQ', icon='QQ支付', config="{'API':'http://google.com','ID':'XXXXX','KEY':'YYYYYYYY'}", info='任意一家易支付 高费率不稳定', isactive=False))
-        self.create_data(Payment(name='易支付支付宝', icon='支付宝', config="{'API':'http://google.com','ID':'XXXXX','KEY':'YYYYYYYY'}", info='任意一家易支付高费率不稳定', isactive=False))
-        self.create_data(Payment(name='易支付微信', icon='微信', config="{'API':'http://google.com','ID':'XXXXX','KEY':'YYYYYYYY'}", info='任意一家易支付 高费率不稳定', isactive=False))
-        self.create_data(Payment(name='YunGouOS', icon='微信或支付宝支付', config="{'mch_id':'xxxxxx','pay_secret':'yyyyyyy'}", info='yungouos.com 微信或支付宝个体1+0.38%', isactive=False))
-        self.create_data(Payment(name='YunGouOS_WXPAY', icon='微信支付', config="{'mch_id':'xxxxxx','pay_secret':'yyyyyyy'}", info='yungouos.com 微信个体1+0.38~0.6%', isactive=False))
-        self.create_data(Payment(name='Mugglepay', icon='Mugglepay', config="{'TOKEN':'xxxxxx','Currency':'CNY'}", info='mugglepay.com全球综合收款系统(已修复)', isactive=False))
-        self.create_data(Payment(name='Stripe支付宝', icon='支付宝', config="{'key':'sk_xxx','currency':'cny'}", info='stripe.com综合收款系统(已完成逻辑，但未实测,缺少反馈)', isactive=False))
-        self.create_data(Payment(name='Stripe微信', icon='微信支付', config="{'key':'sk_xxx','currency':'usd'}", info='stripe.com综合收款系统(aud, cad, eur, gbp, hkd, jpy, sgd, usd)', isactive=False))
+        self.create_data(Payment(name='支付宝当面付', icon='支付宝', config='{"APPID": "2016091800537528", "alipay_public_key": "MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA4AHTfGleo8WI3qb+mSWOjJRyn6Vh8XvO6YsQmJjPnNKhvACHTHcU+PCUWUKZ54fSVhMkFZEQWMtAGeOt3lGy3pMBS96anh841gxJc2NUljU14ESXnDn4QdVe4bosmYvfko46wfA0fGClHdpO8UUiJGLj1W5alv10CwiCrYRDtx93SLIuQgwJn4yBC1/kE/KENOaWaA45dXIQvKh2P0lTbm0AvwYMVvYB+eB1GtOGQbuFJXUxWaMa0byTo9wSllhgyiIkOH+HJ9oOZIweGlsrezeUUdr3EEX97k25LdnUt/oQK8FIfthexfWZpTDDlHqmI7p6gCtRVDJenU4sxwpEyQIDAQAB", "app_private_key": "MIIEvAIBADANBgkqhkiG9w0BAQEFAASCBKYwggSiAgEAAoIBAQCqWmxsyPLwRmZHwoLYlUJXMF7PATKtvp7BrJfwLbxwrz6I48G11HpPPyAoNynwAMG7DCXjVX76NCbmfvvPqnbk09rNRULqGju8G6NkQTbLfDjhJs+CE8kdIs89btxqDG70ebePiZTGpQngPLfrziKDOhRfXkA5qRPImbC+PUXiXq9qvkp9Yu/8IYjyxUpNBNjZuTK+fTjSI0RCt7eE+wR0KqpNIzot1q/ds1KTIYmJQM5tEFie4BK0pDtGiIs/VrUG8PTPqLyzEyIMy1N75olUWAiGrk0USqiieP3TYj0PdlQDX2T14DOwMkl5Rjvt7Knc+WGdolPIBssUX1wTE+J7AgMBAAECggEAWpRP+Jv0yRu1wMxFRKJArxmSH+GUL9wej/6Un2nCO+yChMkNtAAxtLdtAtUqIGpWmH2CG9nW9XULhh3ZCPer1kprmiAMz2t5fbD4dRNT7miz2cwIJDMfCbX7mb+7xUutJ6Mcnl7aU7FnierfJKvrn/ke4gK8haxIT66g0tbDtPQhYnGPawyM+gqFulaMBcuqH0naAIq5ZBWHkKuuwJ1SD6yGrWgHdq3Kt2pE8b9yjfdUl15IeW0rszXG6fTika9WX6qaulyoGAAZdjiXED+mbRyqZA3jq7RI38qBP9+/jAb+fdwE8EwqnpPvfGHMBdkREOXK0kzRU8rpd9GbH7INaQKBgQDwpuW+bK/qxKx3BSAXL98f0J2I7YVuk0EFCStGoxnzWRv0yvL0QEDwN+QPiVMmcVQcr79mW5zTBkd4vmr3ud+v1f/X6UPI82kQhZlVWry8LEnisPlZuE0E/EaJrLgF7z4l3ItzCVi8IfpgizPcCYSz/vY49a5W34eKjXHWUB1jDwKBgQC1N8PgGKI2LRDaJeqt5Ef6yyYSMOgVe0WSqAlgyMECb1pjmMBjcNG1AFE/FfgNu4thOaXIogElGVoQFvA5GuJQY48HOJNgx3Ua2SxiowcXkAN0gIm4FY+ozkp7xhizvLVfsmX+MKqPtl6nggiWETJJyvMQnjMgKLmSvhsopMwZ1QKBgGV36az2BOK3VITGq3Y7YBf5DUN76uPpwOOPryiUgs+hhfEcVX55TSg8WLPYUjAGXtHNpKVTAXfU0PPvTgjv3Yo1cC+okkU7pNQrkLB1lti8z9Z+ilSzKf5tJIzOP7V437p1GHNDwJ9qsDhe2VnwxXxjh4wSwxSsIWlhJFuZ4hovAoGAFgm8Fmqof3InlH/79D3IyyUdciTkdIhTQ6yPx2dioYstMOOIsg8sUZjCSKvBSNo/7wj1slqRTROyMja37Bnq39/bqwMkWSaohSVYEn7FBAaNhQOEvBBTMjI0OK00n9cZL5QgdzMv6t5A0JottSJOPU8jFChJC2Yoe0IHR4ATGikCgYB2smi7/ptKiGdwmiuUHsF/U3jfjpHyHwLrXjoSU+mwV+GjqcdbtkSP1suGjN8tcdbFvLSCRX/IRdFHYJeuPUXQtZtiC431+upasbEiJ1xZ2KcK3lKf0mOn10kPD5QC7mmsfmjz4cw9cSrBjmcWGXeIwIXPLhOAAIzpHqy8oP/F/g=="}', info='alipay.com 官方接口0.38~0.6%', isactive=True))
+        self.create_data(Payment(name='微信官方接口', icon='微信支付', config='{"APPID": "XXXXXXXX", "MCH_ID": "XXXXXX", "APP_SECRET": "XXXXXX"}', info='pay.weixin.qq.com 微信官方0.38%需要营业执照', isactive=False))
+        self.create_data(Payment(name='QQ钱包', icon='QQ支付', config='{"mch_id": "XXXXXXXX", "key": "YYYYY"}', info='mp.qpay.tenpay.com QQ官方0.6%需要营业执照', isactive=False))
+        self.create_data(Payment(name='虎皮椒支付宝', icon='支付宝', config='{"API": "api.vrmrgame.com", "appid": "XXXXXX", "AppSecret": "YYYYY"}', info='xunhupay.com 个人接口0.38%+1~2%', isactive=False))
+        self.create_data(Payment(name='虎皮椒微信', icon='微信支付', config='{"API": "api.vrmrgame.com", "appid": "XXXXXX", "AppSecret": "YYYYY"}', info='xunhupay.com 个人接口0.38~0.6%+1~2%', isactive=False))
+        self.create_data(Payment(name='PAYJS支付宝', icon='支付宝', config='{"payjs_key": "XXXXXX", "mchid": "ZZZZZZZ"}', info='payjs.cn 个人接口2.38%', isactive=False))
+        self.create_data(Payment(name='PAYJS微信', icon='微信支付', config='{"payjs_key": "XXXXXX", "mchid": "ZZZZZZZ"}', info='payjs.cn 个人接口2.38%', isactive=False))
+        self.create_data(Payment(name='迅虎微信', icon='微信支付', config='{"ID": "XXXXXX", "Key": "YYYYY"}', info='pay.xunhuweb.com 个人接口0.38~0.6%+1~2%', isactive=False))   # https://admin.xunhuweb.com/pay/payment 返回系统异常错误
+        self.create_data(Payment(name='码支付支付宝', icon='支付宝', config='{"codepay_id": "58027", "codepay_key": "fgl454542WSDJHEJHDJZpTRrmbn", "token": "jljCGU3pRvXXXXXXXXXXXb1iq"}', info='codepay.fateqq.com[不可用]', isactive=False))
+        self.create_data(Payment(name='码支付微信', icon='微信支付', config='{"codepay_id": "58027", "codepay_key": "fgl454542WSDJHEJHDJZpTRrmbn", "token": "jljCGU3pRvXXXXXXXXXXXb1iq"}', info='codepay.fateqq.com[不可用]', isactive=False))
+        self.create_data(Payment(name='码支付QQ', icon='QQ支付', config='{"codepay_id": "58027", "codepay_key": "fgl454542WSDJHEJHDJZpTRrmbn", "token": "jljCGU3pRvXXXXXXXXXXXb1iq"}', info='codepay.fateqq.com[不可用]', isactive=False))
+        self.create_data(Payment(name='V免签支付宝', icon='支付宝', config='{"API": "http://google.com", "KEY": "YYYYYYYY"}', info='0费率实时到账', isactive=False))
+        self.create_data(Payment(name='V免签微信', icon='微信', config='{"API": "http://google.com", "KEY": "YYYYYYYY"}', info='0费率实时到账', isactive=False))
+        self.create_data(Payment(name='云免签支付宝', icon='支付宝', config='{"APP_ID": "XXXX", "KEY": "YYYYYYYY"}', info='云端监控yunmianqian.com', isactive=False))
+        self.create_data(Payment(name='云免签微信', icon='微信', config='{"APP_ID": "XXXX", "KEY": "YYYYYYYY"}', info='云端监控yunmianqian.com', isactive=False))
+        self.create_data(Payment(name='易支付QQ', icon='QQ支付', config='{"API": "http://google.com", "ID": "XXXXX", "KEY": "YYYYYYYY"}', info='任意一家易支付 高费率不稳定', isactive=False))
+        self.create_data(Payment(name='易支付支付宝', icon='支付宝', config='{"API": "http://google.com", "ID": "XXXXX", "KEY": "YYYYYYYY"}', info='任意一家易支付高费率不稳定', isactive=False))
+        self.create_data(Payment(name='易支付微信', icon='微信', config='{"API": "http://google.com", "ID": "XXXXX", "KEY": "YYYYYYYY"}', info='任意一家易支付 高费率不稳定', isactive=False))
+        self.create_data(Payment(name='YunGouOS', icon='微信或支付宝支付', config='{"mch_id": "xxxxxx", "pay_secret": "yyyyyyy"}', info='yungouos.com 微信或支付宝个体1+0.38%', isactive=False))
+        self.create_data(Payment(name='YunGouOS_WXPAY', icon='微信支付', config='{"mch_id": "xxxxxx", "pay_secret": "yyyyyyy"}', info='yungouos.com 微信个体1+0.38~0.6%', isactive=False))
+        self.create_data(Payment(name='Mugglepay', icon='Mugglepay', config='{"TOKEN": "xxxxxx", "Currency": "CNY"}', info='mugglepay.com全球综合收款系统(已修复)', isactive=False))
+        self.create_data(Payment(name='Stripe支付宝', icon='支付宝', config='{"key": "sk_xxx", "currency": "cny"}', info='stripe.com综合收款系统(已完成逻辑，但未实测,缺少反馈)', isactive=False))
+        self.create_data(Payment(name='Stripe微信', icon='微信支付', config='{"key": "sk_xxx", "currency": "usd"}', info='stripe.com综合收款系统(aud, cad, eur, gbp, hkd, jpy, sgd, usd)', isactive=False))
 
         # 商品分类
         self.create_data(ProdCag(name='账户ID', state=True, sort='100'))
@@ -222,7 +488,7 @@ class Database:
         # 商品
         self.create_data(ProdInfo(name='普通商品演示', prod_cag_name="账户ID", prod_info='商品简述信息演示XXXX', prod_img_url="prod_img_url", prod_discription="示例：卡密格式：账号------密码-----", prod_price=9.99, prod_price_wholesale=None, prod_sales=0, prod_tag="限时优惠", auto=True, sort='100', state=True))
         self.create_data(ProdInfo(name='普通商品演示', prod_cag_name="账户ID", prod_info='商品简述信息演示XXXX', prod_img_url="prod_img_url", prod_discription="示例：卡密格式：账号------密码-----", prod_price=9.99, prod_price_wholesale=None, prod_sales=0, prod_tag="限时优惠", auto=True, sort='100', state=True))
-        self.create_data(ProdInfo(name='批发商品演示', prod_cag_name="账户ID", prod_info='商品简述信息演示XXXX', prod_img_url="images/null.png", prod_discription="示例：卡密格式：账号------密码-----", prod_price=9.99, prod_price_wholesale=None, prod_sales=0, prod_tag="限时优惠", auto=True, sort='100', state=True))
+        self.create_data(ProdInfo(name='批发商品演示', prod_cag_name="账户ID", prod_info='商品简述信息演示XXXX', prod_img_url="images/null.png", prod_discription="示例：卡密格式：账号------密码-----", prod_price=9.99, prod_price_wholesale="10件起每件8.99, 50件起每件7.99", prod_price_tiers='[[10, 8.99], [50, 7.99]]', prod_sales=0, prod_tag="限时优惠", auto=True, sort='100', state=True))
         self.create_data(ProdInfo(name='普通商品DD', prod_cag_name="账户ID", prod_info='商品简述信息演示XXXX', prod_img_url="images/null.png", prod_discription="示例：卡密格式：账号------密码-----", prod_price=9.99, prod_price_wholesale=None, prod_sales=0, prod_tag="限时优惠", auto=False, sort='100', state=False))
         self.create_data(ProdInfo(name='重复卡密演示', prod_cag_name="激活码", prod_info='商品简述信息演示XXXX', prod_img_url="images/null.png", prod_discription="示例：卡密格式：账号------密码-----", prod_price=9.99, prod_price_wholesale=None, prod_sales=0, prod_tag="限时优惠", auto=True, sort='100', state=True))
         self.create_data(ProdInfo(name='普通商品CC', prod_cag_name="激活码", prod_info='商品简述信息演示XXXX', prod_img_url="images/null.png", prod_discription="示例：卡密格式：账号------密码-----", prod_price=9.99, prod_price_wholesale=None, prod_sales=0, prod_tag="限时优惠", auto=True, sort='100', state=True))
@@ -253,11 +519,11 @@ class Database:
         self.create_data(Config(name='store_v', info='0.1.0', description='Github项目地址，用于手动检测新版', isshow=False))
 
         # 通知渠道 ：名称；对管理员开关；对用户开关；对管理员需要管理员账号；用户无；名称+config+管理员+admin_switch+user_switch
-        self.create_data(Notice(name='邮箱通知', config="{'sendname':'no_replay','sendmail':'demo@gmail.com','smtp_address':'smtp.163.com','smtp_port':'465','smtp_pwd':'ZZZZZZZ'}", admin_account='demo@qq.com', admin_switch=False, user_switch=False))
-        self.create_data(Notice(name='微信通知', config="{'token':'AT_nvlYDjev89gV96hBAvUX5HR3idWQwLlA'}", admin_account='xxxxxxxxxxxxxxxx', admin_switch=False, user_switch=False))
-        self.create_data(Notice(name='TG通知', config="{'TG_TOKEN':'1290570937:AAHaXA2uOvDoGKbGeY4xVIi5kR7K55saXhs'}", admin_account='445545444', admin_switch=False, user_switch=False))
-        self.create_data(Notice(name='短信通知', config="{'username':'XXXXXX','password':'YYYYY','tokenYZM':'必填','templateid':'必填'}", admin_account='15347875415', admin_switch=False, user_switch=False))
-        self.create_data(Notice(name='QQ通知', config="{'Key':'null'}", admin_account='格式：您的KEY@已添加的QQ号,示例：abc@123', admin_switch=False, user_switch=False))
+        self.create_data(Notice(name='邮箱通知', config='{"sendname": "no_replay", "sendmail": "demo@gmail.com", "smtp_address": "smtp.163.com", "smtp_port": "465", "smtp_pwd": "ZZZZZZZ"}', admin_account='demo@qq.com', admin_switch=False, user_switch=False))
+        self.create_data(Notice(name='微信通知', config='{"token": "AT_nvlYDjev89gV96hBAvUX5HR3idWQwLlA"}', admin_account='xxxxxxxxxxxxxxxx', admin_switch=False, user_switch=False))
+        self.create_data(Notice(name='TG通知', config='{"TG_TOKEN": "1290570937:AAHaXA2uOvDoGKbGeY4xVIi5kR7K55saXhs"}', admin_account='445545444', admin_switch=False, user_switch=False))
+        self.create_data(Notice(name='短信通知', config='{"username": "XXXXXX", "password": "YYYYY", "tokenYZM": "必填", "templateid": "必填"}', admin_account='15347875415', admin_switch=False, user_switch=False))
+        self.create_data(Notice(name='QQ通知', config='{"Key": "null"}', admin_account='格式：您的KEY@已添加的QQ号,示例：abc@123', admin_switch=False, user_switch=False))
 
         # 订单信息【测试环境】
         self.create_data(Order(out_order_id='演示订单可删除', name='普通商品演示', payment='支付宝当面付', contact='472835979', contact_txt='请求尽快发货', price=9.99, num=1, total_price=0.9, card='账号：xxxxx；密码：xxxx', status=None))
@@ -266,12 +532,12 @@ class Database:
         self.create_data(Order(out_order_id='演示订单4457', name='普通商品演示', payment='虎皮椒支付宝', contact='472835979', contact_txt='不错', price=9.99, num=1, total_price=1.9, card='TG卡密DEMO', status=None))
 
         # 插件配置信息
-        self.create_data(Plugin(name='TG发卡', config="{'TG_TOKEN':'1488086653:AAHihuO0JuvmiDNZtsYcDBpUhL1rTDO6o1C'}", about='### 示例 \n请在管理后台--》Telegram里设置，支持HTML格式', switch=False))
-        self.create_data(Plugin(name='微信公众号', config="{'PID':'xxxxxxxxxxxx'}", about='<p>示例，请在管理后台>>Telegram里设置，支持HTML格式</p>', switch=False))
+        self.create_data(Plugin(name='TG发卡', config='{"TG_TOKEN": "1488086653:AAHihuO0JuvmiDNZtsYcDBpUhL1rTDO6o1C"}', about='### 示例 \n请在管理后台--》Telegram里设置，支持HTML格式', switch=False))
+        self.create_data(Plugin(name='微信公众号', config='{"PID": "xxxxxxxxxxxx"}', about='<p>示例，请在管理后台>>Telegram里设置，支持HTML格式</p>', switch=False))
 
     @contextmanager
-    def session_scope(self):
-        """提供一个事务范围"""
+    def session_scope(self, reraise=False):
+        """提供一个事务范围, reraise 为 True 时回滚后继续抛出异常"""
         session = self.Session()
         try:
             yield session
@@ -279,9 +545,66 @@ class Database:
         except SQLAlchemyError as e:
             session.rollback()
             print(f"Error occurred: {e}")
+            if reraise:
+                raise
         finally:
             session.close()
 
+    @contextmanager
+    def _read_connection(self):
+        """只读连接: 优先从健康的副本取, 副本连不上时标记不可用并改用主库"""
+        replica = self.replicas.choose()
+        if replica is not None:
+            try:
+                conn = replica.engine.connect()
+            except SQLAlchemyError as e:
+                self.replicas.mark_down(replica, e)
+                replica = None
+        if replica is None:
+            conn = self.engine.connect()
+        try:
+            yield conn
+        except SQLAlchemyError as e:
+            if replica is not None and is_disconnect(e):
+                self.replicas.mark_down(replica, e)
+            raise
+        finally:
+            conn.close()
+
+    @contextmanager
+    def read_scope(self):
+        """提供一个只读事务范围, 出错时和 session_scope 一样打印错误后返回
+           会话不自动 flush, 结束时直接关闭(回滚)而不提交; 配置了副本时从副本读取,
+           副本在查询中途断开时标记不可用, 出错的语句和这次读取余下的语句改从主库读
+        """
+        replica, connections = self.replicas.choose(), []
+
+        def fallback(error):
+            self.replicas.mark_down(replica, error)
+            connections.append(self.engine.connect())
+            return connections[-1]
+
+        try:
+            if replica is not None:
+                try:
+                    connections.append(replica.engine.connect())
+                except SQLAlchemyError as e:
+                    self.replicas.mark_down(replica, e)
+                    replica = None
+            if replica is None:
+                connections.append(self.engine.connect())
+            session = ReadSession(bind=connections[0], autoflush=False, expire_on_commit=False,
+                                  fallback=fallback if replica is not None else None)
+            try:
+                yield session
+            finally:
+                session.close()
+        except SQLAlchemyError as e:
+            print(f"Error occurred: {e}")
+        finally:
+            for conn in connections:
+                conn.close()
+
     def create_data(self, record):
         """添加记录"""
         with self.session_scope() as session:
@@ -289,17 +612,27 @@ class Database:
 
     def read_data(self, model, uid: int):
         """获取单条记录"""
-        with self.session_scope() as session:
+        with self.read_scope() as session:
             return session.query(model).filter(model.id == uid).first()
 
-    def read_datas(self, input_model, output_model, skip=0, limit=10):
-        """获取所有记录"""
-        with self.session_scope() as session:
+    @staticmethod
+    def plain_select(model):
+        """只查询表的各列: 结果为 Row(具名元组, 可按属性名读取, output_model.from_orm 可直接使用),
+           不创建 ORM 对象, 不进入会话的 identity map, 会话关闭后照常使用
+        """
+        return select(*model.__table__.columns)
+
+    def read_datas(self, input_model, output_model, skip=0, limit=10, order_by=None, filter_params=None):
+        """获取所有记录, filter_params 为可选的过滤条件列表"""
+        filter_params = filter_params or []
+        with self.read_scope() as session:
             # 获取总记录数
-            total_elements = session.execute(select(func.count(input_model.id))).scalar()
+            total_elements = session.execute(select(func.count(input_model.id)).where(*filter_params)).scalar()
             # 获取记录
-            result = session.execute(select(input_model).offset(skip).limit(limit))
-            infos = result.scalars().all()
+            query = self.plain_select(input_model).where(*filter_params)
+            if order_by is not None:
+                query = query.order_by(*order_by)
+            infos = session.execute(query.offset(skip).limit(limit)).all()
             # 计算总页数
             total_pages = (total_elements + limit - 1) // limit
             current_page = (skip // limit) + 1
@@ -328,6 +661,37 @@ class Database:
                 return record
             return None
 
+    def update_batch_data(self, model, values: dict, filter_params=(), ids=None, chunk_size=500):
+        """批量更新记录: 符合条件的记录统一改为 values, 一条 UPDATE ... WHERE 完成, 返回修改条数
+           ids 为 ID 列表时每 chunk_size 个一条语句, 避免超出数据库的参数个数上限; 全部在一个事务内, 只提交一次
+        """
+        with self.engine.begin() as conn:
+            if ids is None:
+                return conn.execute(update(model).where(*filter_params).values(values)).rowcount
+            updated = 0
+            for offset in range(0, len(ids), chunk_size):
+                updated += conn.execute(update(model).where(model.id.in_(ids[offset:offset + chunk_size]), *filter_params)
+                                        .values(values)).rowcount
+            return updated
+
+    def update_batch_rows(self, model, rows: List[dict]):
+        """批量更新记录: 每条记录各自的新值 [{"id": ..., 列名: 新值}], 值为 None 的列不修改, 返回修改条数
+           修改的列相同的记录为一组, 每组一条 UPDATE ... WHERE id = ? 以 executemany 执行, 全部在一个事务内
+        """
+        groups = {}
+        for row in rows:
+            values = {key: value for key, value in row.items() if key != 'id' and value is not None}
+            if values:
+                groups.setdefault(tuple(sorted(values)), []).append({"b_id": row["id"],
+                                                                    **{f"b_{key}": value for key, value in values.items()}})
+        updated = 0
+        with self.engine.begin() as conn:
+            for columns, params in groups.items():
+                statement = update(model.__table__).where(model.__table__.c.id == bindparam('b_id')) \
+                    .values({column: bindparam(f"b_{column}") for column in columns})
+                updated += conn.execute(statement, params).rowcount
+        return updated
+
     def delete_data(self, model, uid):
         """删除记录"""
         with self.session_scope() as session:
@@ -355,9 +719,9 @@ class Database:
             distinct_card_ids = {card.id for card in distinct_cards}  # 获取所有卡片的 ID
             session.query(Card).filter(Card.id.notin_(distinct_card_ids)).delete(synchronize_session='fetch')  # 删除重复的卡片
 
-    def search_dashboard(self):
-        """获取所有记录"""
-        with self.session_scope() as session:
+    def search_dashboard(self, top_5_products=None):
+        """获取所有记录; top_5_products 为调用方已有的热销榜(如自动统计的商品销量), 传入时不再按订单表汇总"""
+        with self.read_scope() as session:
             # 获取当前时间
             now = datetime.now()
             # 今日开始时间
@@ -371,10 +735,13 @@ class Database:
             start_of_last_month = (start_of_month - timedelta(days=1)).replace(day=1)
             end_of_last_month = start_of_month - timedelta(days=1)
 
+            # 已归档订单的汇总
+            archived_orders, archived_revenue = session.query(func.coalesce(func.sum(OrderRollup.paid_orders), 0),
+                                                              func.coalesce(func.sum(OrderRollup.revenue), 0)).one()
             # 成交订单数
-            total_orders = session.query(func.count(Order.id)).filter(Order.status == True).scalar()
+            total_orders = session.query(func.count(Order.id)).filter(Order.status == True).scalar() + archived_orders
             # 总收益
-            total_revenue = session.query(func.sum(Order.total_price)).scalar()
+            total_revenue = (session.query(func.sum(Order.total_price)).scalar() or 0) + archived_revenue
             # 总用户
             total_users = session.query(func.count(User.id)).scalar()
             # 剩余库存
@@ -451,11 +818,12 @@ class Database:
                                 "year": monthly_sum_dict,
                                 "year_money": sum(monthly_sum_dict.values())}
 
-            # 热销榜单 前五销量名称 及 销售数量
-            top_5_products = session.query(Order.name,
-                                           func.count(Order.id).label('sales_count')).filter(Order.status == True
-                                          ).group_by(Order.name).order_by(desc('sales_count')).limit(5).all()
-            top_5_products = {product: count for product, count in top_5_products}
+            # 热销榜单 前五销量名称 及 销售数量, 合并已归档的销量
+            if top_5_products is None:
+                sales = dict(session.query(OrderRollup.name, func.sum(OrderRollup.paid_orders)).group_by(OrderRollup.name).all())
+                for product, count in session.query(Order.name, func.count(Order.id)).filter(Order.status == True).group_by(Order.name):
+                    sales[product] = sales.get(product, 0) + count
+                top_5_products = dict(sorted(sales.items(), key=lambda item: item[1], reverse=True)[:5])
 
             # 今日订单数
             today_orders = session.query(func.count(Order.id)).filter(Order.status==True, Order.updatetime.between(today, now)).scalar()
@@ -481,22 +849,22 @@ class Database:
 
     def search_data(self, model, output_model, filter_params):
         """查询记录"""
-        with self.session_scope() as session:
-            record = session.query(model).filter(*filter_params).first()
+        with self.read_scope() as session:
+            record = session.execute(self.plain_select(model).where(*filter_params).limit(1)).first()
             return output_model.from_orm(record)
 
     def search_filter(self, model, output_model, filter_params):
         """查询记录"""
-        with self.session_scope() as session:
-            records = session.query(model).filter(*filter_params).all()
+        with self.read_scope() as session:
+            records = session.execute(self.plain_select(model).where(*filter_params)).all()
             return [output_model.from_orm(record) for record in records]
 
     def search_filter_page_turning(self, model, output_model, filter_params, page: int, page_size: int):
         """查询记录"""
-        with self.session_scope() as session:
-            query = session.query(model).filter(*filter_params)
-            total_elements = query.count()
-            records = query.offset((page - 1) * page_size).limit(page_size).all()
+        with self.read_scope() as session:
+            total_elements = session.execute(select(func.count()).select_from(model).where(*filter_params)).scalar()
+            records = session.execute(self.plain_select(model).where(*filter_params)
+                                      .offset((page - 1) * page_size).limit(page_size)).all()
             # 计算总页数和当前页
             total_pages = (total_elements + page_size - 1) // page_size
             current_page = page
@@ -509,10 +877,135 @@ class Database:
             exists = session.query(session.query(model).filter(*filter_params).exists()).scalar()
             return exists
 
-    def get_all_records(self, model):
-        """获取所有记录"""
+    def search_image_products(self, names, primary=False):
+        """定制: 查询引用了指定图像的商品, 返回 {图像名称: [商品名称, ...]}; primary 为 True 时读主库, 删除前检查用"""
+        refs = {name: [] for name in names}
+        if not names:
+            return refs
+        with (self.session_scope() if primary else self.read_scope()) as session:
+            conditions = [ProdInfo.prod_img_url.in_(names)] + [ProdInfo.prod_img_url.like(f"%/{name}") for name in names]
+            for prod_name, img_url in session.query(ProdInfo.name, ProdInfo.prod_img_url).filter(or_(*conditions)):
+                refs[img_url.rsplit('/', 1)[-1]].append(prod_name)
+        return refs
+
+    def search_orphan_images(self, output_model, skip=0, limit=10, before=None):
+        """定制: 查询没有被任何商品引用的图像, before 只返回该时间之前上传的图像"""
+        with self.read_scope() as session:
+            referenced = exists().where(or_(ProdInfo.prod_img_url == ImageInfo.name,
+                                            ProdInfo.prod_img_url.like('%/' + ImageInfo.name)))
+            conditions = [~referenced] if before is None else [~referenced, ImageInfo.updatetime < before]
+            total_elements = session.execute(select(func.count()).select_from(ImageInfo).where(*conditions)).scalar()
+            records = session.execute(self.plain_select(ImageInfo).where(*conditions)
+                                      .order_by(ImageInfo.updatetime).offset(skip).limit(limit)).all()
+            data = [output_model.from_orm(record) for record in records]
+            return {"records": data, "pager": {"page": (skip // limit) + 1, "pageSize": (total_elements + limit - 1) // limit, "total": total_elements}}
+
+    def scan_images(self, output_model, after_id=0, limit=100, before=None):
+        """定制: 从主库按 id 顺序读取 id 大于 after_id 的 limit 张图像, before 只返回该时间之前上传的图像; 清理时按 id 游标翻页"""
         with self.session_scope() as session:
-            return session.query(model).all()
+            query = self.plain_select(ImageInfo).where(ImageInfo.id > after_id)
+            if before is not None:
+                query = query.where(ImageInfo.updatetime < before)
+            records = session.execute(query.order_by(ImageInfo.id).limit(limit)).all()
+            return [output_model.from_orm(record) for record in records]
+
+    def search_order_history(self, output_model, owner_filter, limit=10, after=None):
+        """定制: 键集分页查询某个用户的订单, 按 (updatetime, id) 倒序, after 为上一页最后一条的 (updatetime, id)
+           返回 {"records": [...], "next": 下一页的起点 (updatetime, id), 没有更多时为 None}
+        """
+        with self.read_scope() as session:
+            query = self.plain_select(Order).where(owner_filter)
+            if after is not None:
+                query = query.where(tuple_(Order.updatetime, Order.id) < tuple_(*after))
+            records = session.execute(query.order_by(Order.updatetime.desc(), Order.id.desc()).limit(limit + 1)).all()
+            more = len(records) > limit
+            records = records[:limit]
+            data = [output_model.from_orm(record) for record in records]
+            return {"records": data, "next": (records[-1].updatetime, records[-1].id) if more else None}
+
+    def search_category_nav(self):
+        """定制: 启用的分类及其上架商品数和库存(未使用卡密数, 可重复使用的卡密计 1), 一次连接查询
+           沿 分类 -> (prod_cag_id, state) 索引 -> (prod_name, reuse, isused) 索引 逐层连接, 不扫描商品表和卡密表
+        """
+        with self.read_scope() as session:
+            rows = session.execute(
+                select(ProdCag.id, ProdCag.name, ProdCag.sort,
+                       func.count(ProdInfo.id.distinct()).label('products'),
+                       func.count(Card.id).label('stock'))
+                .select_from(ProdCag)
+                .outerjoin(ProdInfo, (ProdInfo.prod_cag_id == ProdCag.id) & (ProdInfo.state == True))
+                .outerjoin(Card, (Card.prod_name == ProdInfo.name) & (Card.isused == False))
+                .where(ProdCag.state == True)
+                .group_by(ProdCag.id, ProdCag.name, ProdCag.sort)
+                .order_by(ProdCag.sort, ProdCag.id)).mappings().all()
+            return [dict(row) for row in rows]
+
+    def stream_partitions(self, statement, batch_size=1000):
+        """定制: 服务端游标逐批读取 statement 的结果, 每次生成一批 Row, 内存中只保留一批
+           生成器结束或被关闭时归还连接; 导出全表时按主键顺序读取, 不要 ORDER BY 无索引的列
+        """
+        with self._read_connection() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(statement)
+            for partition in result.partitions():
+                yield partition
+
+    def get_all_records(self, model):
+        """获取所有记录, 结果为 Row, 见 plain_select"""
+        with self.read_scope() as session:
+            return session.execute(self.plain_select(model)).all()
+
+
+def benchmark_read_path(rows=20_000, page_size=1000, repeat=20):
+    """列表查询每页 page_size 条: 查 ORM 对象(旧做法)和只查表的各列(plain_select)的耗时和每次请求的内存峰值;
+       以及 update_data 返回的对象在会话关闭后读取属性是否还会查询数据库
+       python -c "from utils.databaseManager import benchmark_read_path; benchmark_read_path()"
+    """
+    import os
+    import tempfile
+    import tracemalloc
+    from sqlalchemy import insert
+    from utils.databaseSchemas import OrderResponse
+
+    db = Database(f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}', echo=False)
+    db.create_tables()
+    now = beijing_now()
+    with db.engine.begin() as conn:
+        conn.execute(insert(Order), [
+            {"out_order_id": f"BENCH{i:012d}", "state": 'delivered', "status": True, "name": f"商品{i % 50}",
+             "payment": "alipay", "contact": f"user{i}@qq.com", "contact_txt": "-", "num": 1, "price": 1,
+             "total_price": 1, "card": f"card-{i}", "updatetime": now - timedelta(minutes=i)} for i in range(rows)])
+
+    def orm_page():
+        with db.read_scope() as session:
+            infos = session.execute(select(Order).offset(0).limit(page_size)).scalars().all()
+            return [OrderResponse.from_orm(info) for info in infos]
+
+    def plain_page():
+        return db.read_datas(Order, OrderResponse, 0, page_size)["records"]
+
+    def measure(fn):
+        fn()  # 预热, 编译缓存等不计入
+        begin = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        elapsed = (time.perf_counter() - begin) / repeat * 1000
+        tracemalloc.start()
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return elapsed, peak / 1024, result
+
+    orm_ms, orm_peak, orm_result = measure(orm_page)
+    plain_ms, plain_peak, plain_result = measure(plain_page)
+    print(f"每页 {page_size} 条订单: ORM 对象 {orm_ms:.1f}ms, 峰值 {orm_peak:.0f}KB; "
+          f"plain_select {plain_ms:.1f}ms, 峰值 {plain_peak:.0f}KB; 结果一致: {orm_result == plain_result}")
+
+    statements = []
+    event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    record = db.update_data(Order, {"id": 1, "contact_txt": "已修改"})
+    issued = len(statements)
+    print(f"update_data 返回后读取属性: contact_txt={record.contact_txt!r}, out_order_id={record.out_order_id}, "
+          f"会话关闭后额外查询 {len(statements) - issued} 次")
 
 
 # 示例用法
@@ -1,8 +1,7 @@
 from fastapi import Body
 from datetime import datetime
-import ast
 from pydantic import BaseModel, Field
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 
 
 """
@@ -72,6 +71,7 @@ class ProdInfoCreate(ProdInfoBase):
     prod_discription: Optional[str] = Body(description="【可选】卡密使用教程")
     prod_price: float = Body(default=99.99, description="【必填】产品价格")
     prod_price_wholesale: Optional[str] = Body(description="【可选】产品批发价格显示str")
+    prod_price_tiers: Optional[str] = Body(default=None, description="【可选】批发阶梯价 JSON [[起购数量, 单价], ...], 例 [[10, 8.5], [50, 8]]")
     prod_sales: Optional[int] = Body(description="【可选】产品销量")
     prod_tag: Optional[str] = Body(description="【可选】产品标签，例限时优惠")
     auto: bool = Body(default=False, description="【必填】是否自动发货")
@@ -88,6 +88,7 @@ class ProdInfoUpdate(ProdInfoBase):
     prod_discription: Optional[str] = Body(description="【可选】卡密使用教程")
     prod_price: Optional[float] = Body(description="【可选】产品价格")
     prod_price_wholesale: Optional[str] = Body(description="【可选】产品批发价格显示str")
+    prod_price_tiers: Optional[str] = Body(default=None, description="【可选】批发阶梯价 JSON [[起购数量, 单价], ...], 例 [[10, 8.5], [50, 8]]")
     prod_sales: Optional[int] = Body(description="【可选】产品销量")
     prod_tag: Optional[str] = Body(description="【可选】产品标签，例限时优惠")
     auto: Optional[bool] = Body(description="【可选】是否自动发货")
@@ -95,7 +96,31 @@ class ProdInfoUpdate(ProdInfoBase):
     state: Optional[bool] = Body(description="【可选】是否展示该商品")
 
 
+class ProdInfoBatchFilter(ProdInfoBase):
+    ids: Optional[List[int]] = Body(default=None, description="【可选】商品ID列表")
+    prod_cag_name: Optional[str] = Body(default=None, description="【可选】分类名称, 该分类下的全部商品")
+    state: Optional[bool] = Body(default=None, description="【可选】只修改已上架或未上架的商品")
+
+
+class ProdInfoBatchValues(ProdInfoBase):
+    prod_price: Optional[float] = Body(default=None, description="【可选】新的价格")
+    state: Optional[bool] = Body(default=None, description="【可选】是否上架")
+    sort: Optional[int] = Body(default=None, description="【可选】排序优先级")
+    prod_tag: Optional[str] = Body(default=None, description="【可选】商品标签")
+
+
+class ProdInfoBatchItem(ProdInfoBatchValues):
+    id: int = Body(description="【必填】商品ID")
+
+
+class ProdInfoBatchUpdate(ProdInfoBase):
+    where: Optional[ProdInfoBatchFilter] = Body(default=None, description="【可选】筛选条件, 条件之间取交集, 与 values 一起使用")
+    values: Optional[ProdInfoBatchValues] = Body(default=None, description="【可选】筛选出的商品统一改为这些值, 不填的字段不修改")
+    items: Optional[List[ProdInfoBatchItem]] = Body(default=None, description="【可选】逐个商品指定新值, 如按 ID 分别改价")
+
+
 class ProdInfoResponse(ProdInfoUpdate):
+    prod_cag_id: Optional[int] = None
 
     class Config:
         orm_mode = True
@@ -137,6 +162,85 @@ class CardFilterDelete(CardBase):
     isused: Optional[bool] = Body(description="【可选】是否已使用")
 
 
+class CardBatchFilter(CardBase):
+    ids: Optional[List[int]] = Body(default=None, description="【可选】卡密ID列表")
+    prod_name: Optional[str] = Body(default=None, description="【可选】商品名称")
+    reuse: Optional[bool] = Body(default=None, description="【可选】是否允许重复使用")
+    isused: Optional[bool] = Body(default=None, description="【可选】是否已使用")
+
+
+class CardBatchValues(CardBase):
+    prod_name: Optional[str] = Body(default=None, description="【可选】改为属于这个商品")
+    reuse: Optional[bool] = Body(default=None, description="【可选】是否允许重复使用")
+    isused: Optional[bool] = Body(default=None, description="【可选】是否已使用")
+
+
+class CardBatchUpdate(CardBase):
+    where: CardBatchFilter = Body(description="【必填】筛选条件, 条件之间取交集, 至少填一个")
+    values: CardBatchValues = Body(description="【必填】筛选出的卡密统一改为这些值, 不填的字段不修改")
+
+
+"""
+========================================
+优惠券
+========================================
+"""
+
+
+class CouponBase(BaseModel):
+    pass
+
+
+class CouponTerms(CouponBase):
+    discount_type: str = Body(default='amount', pattern="^(amount|percent)$",
+                              description="【默认 amount】amount 立减金额, percent 按百分比减")
+    discount: float = Body(gt=0, description="【必填】立减的金额, 或减去的百分比(10 即打 9 折)")
+    min_amount: float = Body(default=0, ge=0, description="【默认 0】订单原价满多少可用")
+    prod_name: Optional[str] = Body(default=None, description="【可选】限定商品名称, 不填时全部商品可用")
+    remaining: int = Body(default=1, ge=1, description="【默认 1】每个券码可使用的次数")
+    expires: Optional[datetime] = Body(default=None, description="【可选】过期时间, 不填时不过期")
+
+
+class CouponCreate(CouponTerms):
+    code: Optional[str] = Body(default=None, description="【可选】自定义券码, 4~32 位字母、数字、- 或 _; 不填时随机生成 count 个")
+    count: int = Body(default=1, ge=1, le=100000, description="【默认 1】随机生成的券码个数, 最多 100000")
+    batch: Optional[str] = Body(default=None, description="【可选】批次名称, 不填时自动生成")
+
+
+class CouponUpdate(CouponBase):
+    id: int = Body(description="【必填】优惠券ID")
+    discount_type: Optional[str] = Body(default=None, pattern="^(amount|percent)$", description="【可选】amount 或 percent")
+    discount: Optional[float] = Body(default=None, gt=0, description="【可选】立减的金额或减去的百分比")
+    min_amount: Optional[float] = Body(default=None, ge=0, description="【可选】订单原价满多少可用")
+    prod_name: Optional[str] = Body(default=None, description="【可选】限定商品名称")
+    remaining: Optional[int] = Body(default=None, ge=0, description="【可选】剩余可使用次数")
+    expires: Optional[datetime] = Body(default=None, description="【可选】过期时间")
+
+
+class CouponSwitch(CouponBase):
+    id: int = Body(description="【必填】优惠券ID")
+    state: bool = Body(description="【必填】是否启用")
+
+
+class CouponResponse(CouponBase):
+    id: int
+    code: Optional[str] = None
+    batch: Optional[str] = None
+    discount_type: Optional[str] = None
+    discount: Optional[float] = None
+    min_amount: Optional[float] = None
+    prod_name: Optional[str] = None
+    remaining: Optional[int] = None
+    used: Optional[int] = None
+    expires: Optional[datetime] = None
+    state: Optional[bool] = None
+    updatetime: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+        from_attributes = True
+
+
 """
 ========================================
 订单信息
@@ -148,6 +252,15 @@ class OrderBase(BaseModel):
     pass
 
 
+class OrderCreate(OrderBase):
+    name: str = Body(description="【必填】商品名称")
+    num: int = Body(default=1, ge=1, description="【必填】购买数量")
+    payment: str = Body(description="【必填】支付方式名称")
+    contact: str = Body(description="【必填】联系方式, 用于查询订单和接收卡密")
+    contact_txt: Optional[str] = Body(default=None, description="【可选】附加信息")
+    coupon: Optional[str] = Body(default=None, description="【可选】优惠券码")
+
+
 class OrderSearch(OrderBase):
     out_order_id: Optional[str] = Body(description="【可选】订单号")
     contact: Optional[str] = Body(description="【可选】用户联系方式")
@@ -157,6 +270,7 @@ class OrderSearch(OrderBase):
 class OrderResponse(OrderBase):
     id: int
     status: Optional[bool] = None
+    state: Optional[str] = None  # pending/paid/delivered/expired
     out_order_id: Optional[str] = None  # 订单ID 必填
     name: Optional[str] = None  # 商品名 必填
     payment: Optional[str] = None  # 支付渠道 必填
@@ -166,6 +280,7 @@ class OrderResponse(OrderBase):
     contact_txt: Optional[str] = None
     contact: Optional[str] = None
     card: Optional[str] = None
+    coupon: Optional[str] = None
     updatetime: Optional[datetime] = None
 
     class Config:
@@ -177,6 +292,32 @@ class OrderDelete(OrderBase):
     id: int = Body(description="【必填】订单ID")
 
 
+"""
+========================================
+图床图像
+========================================
+"""
+
+
+class ImageInfoBase(BaseModel):
+    pass
+
+
+class ImageInfoResponse(ImageInfoBase):
+    id: int
+    name: str
+    hash: str
+    size: int
+    mime: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    updatetime: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+        from_attributes = True
+
+
 """
 ========================================
 综合设置
@@ -223,29 +364,21 @@ class PyaId(PayBase):
     id: int
 
 
-class PayUpdate(PyaId):
-    config: Optional[Dict] = Body(description="【可选】支付接口配置")
-    isactive: Optional[bool] = Body(description="【可选】是否激活该支付方式")
-
-
-class PayResponse(PyaId):
+class PayConfig(PyaId):
+    """解析后的支付接口设置, 由支付注册表缓存, 只读"""
     name: str
     icon: str
-    config: str
-    info: str
+    config: Dict
+    info: Optional[str] = None
     isactive: bool
 
-    def dict(self, *args, **kwargs):
-        data = super().dict(*args, **kwargs)
-        try:
-            data['config'] = ast.literal_eval(data['config'])
-        except Exception:
-            raise ValueError("config field must be a valid JSON string")
-        return data
-
     class Config:
-        orm_mode = True
-        from_attributes = True
+        frozen = True
+
+
+class PayUpdate(PyaId):
+    config: Optional[Dict] = Body(description="【可选】支付接口配置")
+    isactive: Optional[bool] = Body(description="【可选】是否激活该支付方式")
 
 
 """
@@ -270,3 +403,22 @@ class NoticeResponse(NoticeBase):
     class Config:
         orm_mode = True
         from_attributes = True
+
+
+"""
+========================================
+慢请求采样分析
+========================================
+"""
+
+
+class ProfilerBase(BaseModel):
+    pass
+
+
+class ProfilerConfig(ProfilerBase):
+    enabled: bool = Body(description="【必填】是否开启采样")
+    threshold_ms: Optional[int] = Body(default=500, ge=1, description="【可选】耗时达到该毫秒数的请求保存采样结果, 为空时只按 sample_every 抽样")
+    sample_every: Optional[int] = Body(default=0, ge=0, description="【可选】每个路径前缀每 N 个请求固定保存一个, 0 为不抽样")
+    paths: Optional[List[str]] = Body(default=None, description="【可选】只采样这些路径前缀, 例如 [\"/api/backend/dashboard\"], 为空时采样全部请求")
+    interval_ms: Optional[float] = Body(default=None, ge=1, le=100, description="【可选】采样间隔毫秒数, 默认 5")
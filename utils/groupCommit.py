@@ -0,0 +1,232 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+from typing import Callable
+
+
+"""
+代码说明：
+合并提交(group commit)写入器，可选使用。SQLite 同一时刻只有一个写事务，每次提交都要拿写锁、写 WAL、按 synchronous 设置刷盘，
+下单高峰时大量很小的写事务排队等锁，大部分时间花在事务本身而不是写数据上。
+1. 调用方把写操作包装成 unit(conn) 函数提交，独立的写入线程取出排队的写操作，最多等待 max_delay 秒凑成一批，
+   在一个事务里依次执行后只提交一次，再逐个把结果或异常交给各自调用方的 Future。
+2. 同批中某个写操作出错时，回滚整批，再让每个写操作在自己的 SAVEPOINT 里重做一遍：出错的只回滚它自己，其余照常提交；
+   提交本身失败时整批都收到这个异常。没有出错时不设 SAVEPOINT，它在 SQLite 上的开销和一次提交差不多。
+3. Future 在事务提交之后才完成，调用方拿到结果时数据已经写入。unit 只能使用传入的 conn，可能被重做，不能有数据库以外的副作用；
+   它在写入线程中执行，不能再向写入器提交。
+4. SQLite 下事务以 BEGIN IMMEDIATE 开始，一开始就拿到写锁；pysqlite 默认不会在 SAVEPOINT 前开启事务，
+   不先 BEGIN 的话第一个 SAVEPOINT 释放时就会把整个事务提交掉。
+"""
+
+
+class _WriteUnit:
+    __slots__ = ('fn', 'future')
+
+    def __init__(self, fn, future):
+        self.fn = fn
+        self.future = future
+
+
+class GroupCommitWriter:
+    """submit 方法提交一个写操作返回 Future, run 方法同步等待结果, execute 方法在协程中等待结果。
+       写入线程在第一次提交时启动, close 方法处理完已提交的写操作后停止; stats 方法返回批次数和平均每批写操作数。
+    """
+
+    def __init__(self, db, max_delay=0.002, max_batch=256):
+        self.db = db
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closing = False
+        self.counters = {"units": 0, "failed": 0, "batches": 0, "replays": 0, "commit_errors": 0, "largest_batch": 0}
+
+    def submit(self, fn: Callable) -> Future:
+        """提交写操作 fn(conn), 返回的 Future 在所在批次提交后得到 fn 的返回值或异常"""
+        if self._closing:
+            raise RuntimeError("写入器已关闭")
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                    self._thread.start()
+        future = Future()
+        self._queue.put(_WriteUnit(fn, future))
+        return future
+
+    def run(self, fn: Callable):
+        """同步提交并等待结果, 在写入线程之外的线程中调用"""
+        return self.submit(fn).result()
+
+    async def execute(self, fn: Callable):
+        """在协程中提交并等待结果, 等待期间不阻塞事件循环"""
+        return await asyncio.wrap_future(self.submit(fn))
+
+    def _collect(self, first) -> list:
+        """从第一个写操作开始, 最多等待 max_delay 秒或凑满 max_batch 个"""
+        batch = [first]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                unit = self._queue.get_nowait()
+            except Empty:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    unit = self._queue.get(timeout=remaining)
+                except Empty:
+                    break
+            if unit is None:
+                self._queue.put(None)  # 留给 _run 退出
+                break
+            batch.append(unit)
+        return batch
+
+    def _attempt(self, batch: list, isolated: bool):
+        """在一个事务中依次执行整批写操作, 返回 [(写操作, 结果, 异常)]
+           isolated 为 False 时不设 SAVEPOINT, 有写操作出错就回滚整个事务并返回 None
+        """
+        results = []
+        with self.db.engine.connect() as conn:
+            transaction = conn.begin()
+            if conn.dialect.name == 'sqlite':
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+            for unit in batch:
+                savepoint = conn.begin_nested() if isolated else None
+                try:
+                    result = unit.fn(conn)
+                except Exception as e:
+                    if savepoint is None:
+                        transaction.rollback()
+                        if len(batch) > 1:
+                            return None
+                    else:
+                        savepoint.rollback()
+                    results.append((unit, None, e))
+                    continue
+                if savepoint is not None:
+                    savepoint.commit()
+                results.append((unit, result, None))
+            if transaction.is_active:
+                transaction.commit()
+        return results
+
+    def _commit(self, batch: list):
+        try:
+            results = self._attempt(batch, isolated=False)
+            if results is None:
+                # 先不设 SAVEPOINT 整批执行(每个 SAVEPOINT 的开销和一次提交相当), 有写操作出错时再逐个隔离重做一遍
+                self.counters["replays"] += 1
+                results = self._attempt(batch, isolated=True)
+        except Exception as e:
+            # 拿不到写锁或提交失败: 整批都没有写入
+            self.counters["commit_errors"] += 1
+            self.counters["failed"] += len(batch)
+            for unit in batch:
+                unit.future.set_exception(e)
+            return
+        for unit, result, error in results:
+            if error is None:
+                unit.future.set_result(result)
+            else:
+                self.counters["failed"] += 1
+                unit.future.set_exception(error)
+
+    def _run(self):
+        while True:
+            unit = self._queue.get()
+            if unit is None:
+                break
+            batch = self._collect(unit)
+            self._commit(batch)
+            self.counters["units"] += len(batch)
+            self.counters["batches"] += 1
+            self.counters["largest_batch"] = max(self.counters["largest_batch"], len(batch))
+
+    def close(self, timeout=5):
+        """不再接受新的写操作, 等待已提交的写完成后停止写入线程"""
+        self._closing = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def stats(self):
+        batches = self.counters["batches"]
+        return {**self.counters, "avg_batch": round(self.counters["units"] / batches, 2) if batches else 0.0}
+
+
+def benchmark_group_commit(total=5000, concurrency=64):
+    """同样的下单负载, 每单各自提交和合并提交的吞吐对比: 多线程同步下单, 以及 concurrency 个协程并发下单;
+       另外检查同批中失败的写操作只回滚自己
+    """
+    import os
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy import select, func, insert
+    from utils.databaseManager import Database, ProdInfo, Payment, Card, Order
+    from utils.orderManager import OrderManager
+
+    def setup(synchronous):
+        db = Database(f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}', echo=False)
+        db.create_tables()
+        db.create_data(ProdInfo(name='压测商品', prod_cag_name='压测', prod_price=9.9, auto=True, state=True))
+        db.create_data(Payment(name='压测支付', icon='-', config='{}', info='-', isactive=True))
+        db.create_batch_data([Card(prod_name='压测商品', card=f'card-{i}') for i in range(total * 3)])
+        db.engine.pool.dispose()
+        from sqlalchemy import event
+
+        @event.listens_for(db.engine, 'connect')
+        def set_synchronous(dbapi_connection, connection_record):
+            dbapi_connection.execute(f"PRAGMA synchronous={synchronous}")
+        return db
+
+    for synchronous in ('NORMAL', 'FULL'):
+        for mode in ('每单提交', '合并提交'):
+            db = setup(synchronous)
+            writer = GroupCommitWriter(db) if mode == '合并提交' else None
+            manager = OrderManager(db, writer=writer)
+            begin = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                list(executor.map(lambda i: manager.checkout('压测商品', 1, '压测支付', f'user{i}@qq.com'), range(total)))
+            threaded = total / (time.perf_counter() - begin)
+
+            async def place_all():
+                semaphore = asyncio.Semaphore(concurrency)
+
+                async def place(i):
+                    async with semaphore:
+                        await manager.checkout_async('压测商品', 1, '压测支付', f'user{i}@qq.com')
+                await asyncio.gather(*(place(i) for i in range(total)))
+            begin = time.perf_counter()
+            asyncio.run(place_all())
+            concurrent = total / (time.perf_counter() - begin)
+            with db.engine.connect() as conn:
+                orders = conn.execute(select(func.count(Order.id))).scalar()
+            print(f"synchronous={synchronous} {mode}: 16 线程 {threaded:.0f} 单/秒, {concurrency} 协程 {concurrent:.0f} 单/秒, "
+                  f"订单 {orders}" + (f", {writer.stats()}" if writer else ''))
+            if writer:
+                writer.close()
+
+    # 失败隔离: 同一批里每 5 个有 1 个订单号和前一个重复, 插入失败, 其余照常写入
+    db = setup('NORMAL')
+    writer = GroupCommitWriter(db, max_delay=0.05)
+    values = {"name": '压测商品', "payment": '压测支付', "num": 1, "price": 1.0, "total_price": 1.0, "contact": '-'}
+
+    def insert_unit(out_order_id):
+        return lambda conn: conn.execute(insert(Order), [{**values, "out_order_id": out_order_id}]).rowcount
+    futures = [writer.submit(insert_unit(f"DUP{i - 1 if i % 5 == 4 else i}")) for i in range(20)]
+    outcomes = ['ok' if future.exception() is None else type(future.exception()).__name__ for future in futures]
+    with db.engine.connect() as conn:
+        written = conn.execute(select(func.count(Order.id)).where(Order.out_order_id.like('DUP%'))).scalar()
+    print(f"失败隔离: {outcomes.count('ok')} 个成功, {len(outcomes) - outcomes.count('ok')} 个失败 "
+          f"({set(outcomes) - {'ok'}}), 实际写入 {written} 条, {writer.stats()}")
+    writer.close()
+
+
+if __name__ == '__main__':
+    benchmark_group_commit()
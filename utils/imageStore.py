@@ -0,0 +1,223 @@
+import asyncio
+import hashlib
+import os
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+try:
+    from PIL import Image
+except ImportError:  # 未安装 Pillow 时不生成缩略图, 直接返回原图
+    Image = None
+
+
+"""
+代码说明：
+内容寻址图床，文件名为图片内容的 sha256，相同图片只保存一份。
+上传时分块读取、校验大小和文件头，写盘放到线程中执行，不占用事件循环。
+缩略图和 WebP 版本在线程池中预先生成，存放在 variants 目录，缺失时回退到原图；
+回退的响应只短时间缓存且不带 ETag，变体生成后浏览器和 CDN 很快换成变体，不会把原图当作缩略图缓存一年。
+扫描目录发现的旧图片没有预先生成变体，第一次按变体访问时补生成。
+"""
+
+# 文件头 -> 扩展名
+MIME_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'gif': 'image/gif', 'webp': 'image/webp',
+              'bmp': 'image/bmp', 'ico': 'image/x-icon'}
+# 变体名称 -> 最长边像素, None 表示保持原尺寸
+VARIANTS = {'thumb': 320, 'webp': None}
+HASH_NAME = re.compile(r'^[0-9a-f]{64}\.[a-z]+$')
+
+
+class ImageStoreError(ValueError):
+    """上传的文件不符合要求"""
+
+    def __init__(self, code: int, msg: str):
+        super().__init__(msg)
+        self.code = code
+        self.msg = msg
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """根据文件头判断图片类型"""
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head.startswith(b'BM'):
+        return 'bmp'
+    if head.startswith(b'\x00\x00\x01\x00'):
+        return 'ico'
+    return None
+
+
+def render_variant(source: Path, target: Path, max_side: Optional[int]):
+    """生成 WebP 变体, 在线程池中执行"""
+    with Image.open(source) as image:
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or image.mode == 'P' else 'RGB')
+        if max_side:
+            image.thumbnail((max_side, max_side))
+        temp = target.with_name(f".{target.name}.{uuid.uuid4().hex}")
+        image.save(temp, 'WEBP', quality=80)
+    os.replace(temp, target)
+
+
+def image_size(path: Path):
+    """只读取文件头获取宽高, 无法识别时返回 (None, None)"""
+    if Image is None:
+        return None, None
+    try:
+        with Image.open(path) as image:
+            return image.size
+    except Exception:
+        return None, None
+
+
+def file_info(path: Path) -> dict:
+    """计算已有文件的图像信息, 用于补建索引"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        head = f.read(64 * 1024)
+        chunk = head
+        while chunk:
+            sha256.update(chunk)
+            chunk = f.read(64 * 1024)
+    extension = sniff_image_type(head)
+    width, height = image_size(path)
+    return {"filename": path.name, "hash": sha256.hexdigest(), "size": path.stat().st_size,
+            "mime": MIME_TYPES.get(extension), "width": width, "height": height}
+
+
+class ImageStore:
+    """save 方法保存上传文件并返回图片信息, 重复图片直接返回已有文件。
+       scan 方法列出目录中尚未建立索引的图片信息。
+       resolve 方法返回要发送的文件路径和缓存头。
+       delete 方法删除原图和所有变体。
+    """
+
+    def __init__(self, root='drawingbed', max_size=10 * 1024 * 1024, chunk_size=64 * 1024, workers=2):
+        self.root = Path(root)
+        self.variant_dir = self.root / 'variants'
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.variant_dir.mkdir(parents=True, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image')
+        self._scheduled = set()  # 已提交生成变体的文件名, 缺失变体时只补生成一次
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def path(self, filename: str) -> Optional[Path]:
+        """原图路径, 文件名非法时返回 None"""
+        if not filename or Path(filename).name != filename or filename.startswith('.'):
+            return None
+        return self.root / filename
+
+    def variant_path(self, filename: str, variant: str) -> Path:
+        return self.variant_dir / f"{Path(filename).stem}_{variant}.webp"
+
+    async def save(self, upload) -> dict:
+        """分块保存上传文件, 返回 {"filename", "hash", "size", "mime", "width", "height", "created"}"""
+        temp = self.root / f".upload-{uuid.uuid4().hex}"
+        sha256 = hashlib.sha256()
+        size = 0
+        extension = None
+        f = await asyncio.to_thread(open, temp, 'wb')
+        try:
+            while True:
+                chunk = await upload.read(self.chunk_size)
+                if not chunk:
+                    break
+                if extension is None:
+                    extension = sniff_image_type(chunk)
+                    if extension is None:
+                        raise ImageStoreError(400, "不支持的图片格式")
+                size += len(chunk)
+                if size > self.max_size:
+                    raise ImageStoreError(413, f"图片不能超过 {self.max_size // 1024 // 1024}MB")
+                sha256.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            await asyncio.to_thread(f.close)
+            temp.unlink(missing_ok=True)
+            raise
+        await asyncio.to_thread(f.close)
+        if extension is None:
+            temp.unlink(missing_ok=True)
+            raise ImageStoreError(400, "上传文件为空")
+
+        digest = sha256.hexdigest()
+        filename = f"{digest}.{extension}"
+        target = self.root / filename
+        created = not target.exists()
+        if created:
+            os.replace(temp, target)
+            self.schedule_variants(filename)
+        else:
+            temp.unlink(missing_ok=True)
+        width, height = await asyncio.get_running_loop().run_in_executor(self._executor, image_size, target)
+        return {"filename": filename, "hash": digest, "size": size, "mime": MIME_TYPES[extension],
+                "width": width, "height": height, "created": created}
+
+    def scan(self, known_names) -> list:
+        """列出目录中不在 known_names 里的图片信息, 在线程中执行"""
+        known_names = set(known_names)
+        return [file_info(path) for path in self.root.iterdir()
+                if path.is_file() and not path.name.startswith('.') and path.name not in known_names]
+
+    def schedule_variants(self, filename: str):
+        """在线程池中生成所有变体, 不等待结果"""
+        if Image is None or filename in self._scheduled:
+            return
+        self._scheduled.add(filename)
+        source = self.root / filename
+        for variant, max_side in VARIANTS.items():
+            future = self._executor.submit(render_variant, source, self.variant_path(filename, variant), max_side)
+            future.add_done_callback(lambda fut, name=filename: fut.exception() and print(f"图片变体生成失败 {name}: {fut.exception()!r}"))
+
+    def resolve(self, filename: str, variant: Optional[str] = None):
+        """返回 (文件路径, headers), 文件不存在时返回 (None, None)
+           内容寻址的文件永不变化, 使用强 ETag 和 immutable 缓存; 旧文件名只缓存一小时;
+           变体还没生成时回退到原图, 只缓存一分钟且不带 ETag, 并补生成变体。
+        """
+        source = self.path(filename)
+        if source is None or not source.is_file():
+            return None, None
+        target = source
+        if variant in VARIANTS:
+            candidate = self.variant_path(filename, variant)
+            if not candidate.is_file():
+                self.schedule_variants(filename)
+                return source, {"cache-control": "public, max-age=60"}
+            target = candidate
+        if HASH_NAME.match(filename):
+            tag = Path(filename).stem if target == source else f"{Path(filename).stem}-{variant}"
+            headers = {"etag": f'"{tag}"', "cache-control": "public, max-age=31536000, immutable"}
+        else:
+            headers = {"cache-control": "public, max-age=3600"}
+        return target, headers
+
+    def delete(self, filename: str) -> bool:
+        """删除原图和变体"""
+        source = self.path(filename)
+        if source is None or not source.is_file():
+            return False
+        source.unlink()
+        self._scheduled.discard(filename)
+        for variant in VARIANTS:
+            self.variant_path(filename, variant).unlink(missing_ok=True)
+        return True
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """判断 If-None-Match 是否命中"""
+    if not if_none_match or not etag:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or f"W/{etag}" in candidates
@@ -0,0 +1,355 @@
+import asyncio
+import json
+import time
+import urllib.parse
+import urllib.request
+from typing import Dict, Optional
+from utils.databaseManager import Notice
+from utils.databaseSchemas import NoticeResponse
+from utils.rateLimiter import TokenBucket
+from utils.utils import EmailManager
+
+
+"""
+代码说明：
+通知分发器，读取 Notice 表中启用的渠道（缓存一次），把订单事件并发推送到各个渠道。
+每个渠道独立限速、独立熔断，事件先进入内存队列，由后台协程消费，不会阻塞下单流程。
+新渠道继承 NoticeChannel 实现 send，再用 NoticeDispatcher.register 按 Notice.name 注册即可。
+没有实现的渠道(如短信通知，暂无统一服务商)不能开启：message_switch 接口返回 400，数据库中已开启的在 stats 的 unsupported 中列出。
+"""
+
+
+class CircuitBreaker:
+    """熔断器: 连续失败 failure_threshold 次后断开, reset_timeout 秒后放行一次试探请求"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.half_open = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.half_open else "open"
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if not self.half_open and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.half_open = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.half_open = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.half_open = False
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+def _http_post(url: str, data: Optional[dict] = None, json_body: Optional[dict] = None, timeout: float = 10):
+    """同步 HTTP POST, 由渠道放到线程中执行"""
+    if json_body is not None:
+        body = json.dumps(json_body).encode()
+        headers = {"Content-Type": "application/json"}
+    else:
+        body = urllib.parse.urlencode(data or {}).encode()
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read()
+
+
+class NoticeChannel:
+    """通知渠道基类
+       rate/capacity 为该渠道的令牌桶参数，timeout 为单次发送超时秒数。
+    """
+    rate = 1.0
+    capacity = 5
+    timeout = 10
+
+    def __init__(self, config: dict):
+        self.config = config
+
+    def accepts(self, account: str) -> bool:
+        """判断该渠道能否发送给指定账号"""
+        return bool(account)
+
+    async def send(self, account: str, subject: str, content: str):
+        raise NotImplementedError
+
+
+class EmailChannel(NoticeChannel):
+    """邮箱通知"""
+    rate = 2.0
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.email_manager = EmailManager(smtp_address=config['smtp_address'],
+                                          sendmail=config['sendmail'],
+                                          send_name=config.get('sendname', config['sendmail']),
+                                          smtp_pwd=config['smtp_pwd'],
+                                          smtp_port=config['smtp_port'])
+
+    def accepts(self, account: str) -> bool:
+        return bool(account) and '@' in account
+
+    async def send(self, account: str, subject: str, content: str):
+        await asyncio.to_thread(self.email_manager.send_email, account, subject, content)
+
+
+class TelegramChannel(NoticeChannel):
+    """TG通知, account 为 chat_id"""
+    rate = 20.0
+    capacity = 20
+
+    async def send(self, account: str, subject: str, content: str):
+        url = f"https://api.telegram.org/bot{self.config['TG_TOKEN']}/sendMessage"
+        await asyncio.to_thread(_http_post, url, {"chat_id": account, "text": f"{subject}\n{content}"}, None, self.timeout)
+
+
+class WxPusherChannel(NoticeChannel):
+    """微信通知(WxPusher), account 为 UID"""
+
+    async def send(self, account: str, subject: str, content: str):
+        body = {"appToken": self.config['token'], "summary": subject, "content": content, "contentType": 1, "uids": [account]}
+        await asyncio.to_thread(_http_post, "https://wxpusher.zjiecode.com/api/send/message", None, body, self.timeout)
+
+
+class QmsgChannel(NoticeChannel):
+    """QQ通知(Qmsg酱), account 格式为 KEY@QQ号"""
+
+    def accepts(self, account: str) -> bool:
+        return bool(account) and '@' in account
+
+    async def send(self, account: str, subject: str, content: str):
+        key, qq = account.split('@', 1)
+        await asyncio.to_thread(_http_post, f"https://qmsg.zendee.cn/send/{key}", {"msg": f"{subject}\n{content}", "qq": qq}, None, self.timeout)
+
+
+class FakeChannel(NoticeChannel):
+    """本地假渠道，只记录消息，用于测试；delay 模拟网络耗时，fail 为 True 时每次发送都抛错"""
+    rate = 1000.0
+    capacity = 1000
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.delay = config.get('delay', 0)
+        self.fail = config.get('fail', False)
+        self.sent = []
+
+    async def send(self, account: str, subject: str, content: str):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError("fake channel failure")
+        self.sent.append((account, subject, content))
+
+
+# Notice.name -> 渠道实现；短信通知暂无统一服务商，不在其中，需要时实现后 register
+CHANNELS = {
+    '邮箱通知': EmailChannel,
+    '微信通知': WxPusherChannel,
+    'TG通知': TelegramChannel,
+    'QQ通知': QmsgChannel,
+}
+
+
+class _ChannelState:
+    """单个已启用渠道的运行时状态"""
+
+    def __init__(self, channel: NoticeChannel, notice: NoticeResponse):
+        self.channel = channel
+        self.admin_account = notice.admin_account
+        self.admin_switch = notice.admin_switch
+        self.user_switch = notice.user_switch
+        self.bucket = TokenBucket(channel.rate, channel.capacity)
+        self.breaker = CircuitBreaker()
+        self.sent = 0
+        self.failed = 0
+
+
+class NoticeDispatcher:
+    """通知分发器
+       load_channels 方法读取并缓存已启用的渠道; supports 方法返回渠道是否有实现, 没有实现的渠道不能开启。
+       invalidate 方法在通知设置修改后清除缓存。
+       notify / notify_order 方法把事件放入队列，立即返回，队列满时丢弃并计数。
+       start / stop 方法启动和停止后台消费协程，stop 时会尽量把队列发送完。
+    """
+
+    def __init__(self, db, queue_size=1000, workers=2, channels: Optional[Dict[str, type]] = None):
+        self.db = db
+        self.queue_size = queue_size
+        self.workers = workers
+        self.registry = dict(CHANNELS if channels is None else channels)
+        self._states = None
+        self._unsupported = []  # 已开启但没有实现的渠道
+        self._queue = None
+        self._loop = None
+        self._tasks = []
+        self.dropped = 0
+
+    def register(self, name: str, channel_cls: type):
+        """注册渠道实现"""
+        self.registry[name] = channel_cls
+        self.invalidate()
+
+    def supports(self, name: str) -> bool:
+        return name in self.registry
+
+    def invalidate(self):
+        """清除渠道缓存，下次分发时重新读取 Notice 表"""
+        self._states = None
+
+    def load_channels(self):
+        """读取启用的渠道，结果缓存到 invalidate 为止"""
+        if self._states is None:
+            states, unsupported = {}, []
+            for notice in self.db.search_filter(Notice, NoticeResponse, []):
+                if not (notice.admin_switch or notice.user_switch):
+                    continue
+                channel_cls = self.registry.get(notice.name)
+                if channel_cls is None:
+                    print(f"通知渠道 {notice.name} 没有实现, 已开启也不会发送")
+                    unsupported.append(notice.name)
+                    continue
+                try:
+                    states[notice.name] = _ChannelState(channel_cls(json.loads(notice.config)), notice)
+                except Exception as e:
+                    print(f"通知渠道 {notice.name} 配置错误: {e}")
+            self._unsupported = unsupported
+            self._states = states
+        return self._states
+
+    def notify(self, subject: str, content: str, user_account: Optional[str] = None) -> bool:
+        """投递一条通知，不等待发送结果；可以在工作线程中调用(如支付回调的发货)，
+           此时交给事件循环入队，队列满时在入队时丢弃并计数，返回值只表示已经交出
+        """
+        loop = self._loop
+        if self._queue is None or loop is None:
+            self.dropped += 1
+            return False
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not loop:
+            loop.call_soon_threadsafe(self._put, (subject, content, user_account))
+            return True
+        return self._put((subject, content, user_account))
+
+    def _put(self, item) -> bool:
+        """在事件循环中入队, 队列满或已停止时丢弃并计数"""
+        if self._queue is None:
+            self.dropped += 1
+            return False
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    def notify_order(self, event: str, order) -> bool:
+        """投递订单事件，order 需要有 out_order_id/name/num/total_price/contact/card 属性"""
+        subject = f"订单{event}: {order.out_order_id}"
+        content = f"商品: {order.name}\n数量: {order.num}\n总价: {order.total_price}"
+        if getattr(order, 'card', None):
+            content += f"\n卡密: {order.card}"
+        return self.notify(subject, content, order.contact)
+
+    async def _deliver(self, state: _ChannelState, account: str, subject: str, content: str):
+        if not state.breaker.allow():
+            state.failed += 1
+            return
+        await state.bucket.acquire()
+        try:
+            await asyncio.wait_for(state.channel.send(account, subject, content), state.channel.timeout)
+            state.breaker.record_success()
+            state.sent += 1
+        except Exception as e:
+            state.breaker.record_failure()
+            state.failed += 1
+            print(f"通知发送失败 {type(state.channel).__name__} -> {account}: {e!r}")
+
+    async def dispatch(self, subject: str, content: str, user_account: Optional[str] = None):
+        """并发发送到所有启用的渠道"""
+        deliveries = []
+        for state in self.load_channels().values():
+            if state.admin_switch and state.channel.accepts(state.admin_account):
+                deliveries.append(self._deliver(state, state.admin_account, subject, content))
+            if state.user_switch and state.channel.accepts(user_account):
+                deliveries.append(self._deliver(state, user_account, subject, content))
+        if deliveries:
+            await asyncio.gather(*deliveries)
+
+    async def _worker(self):
+        while True:
+            subject, content, user_account = await self._queue.get()
+            try:
+                await self.dispatch(subject, content, user_account)
+            except Exception as e:
+                print(f"通知分发异常: {e!r}")
+            finally:
+                self._queue.task_done()
+
+    async def start(self):
+        """启动后台消费协程"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._loop = asyncio.get_running_loop()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=5):
+        """停止后台协程，最多等待 timeout 秒发送剩余通知"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"通知队列未发送完毕，丢弃 {self._queue.qsize()} 条")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._loop = None
+
+    def stats(self):
+        """渠道运行状态"""
+        channels = {name: {"sent": state.sent, "failed": state.failed, "breaker": state.breaker.state}
+                    for name, state in (self._states or {}).items()}
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return {"channels": channels, "unsupported": list(self._unsupported), "queued": queued, "dropped": self.dropped}
+
+
+async def benchmark_dispatcher():
+    """使用假渠道压测分发: 慢渠道不阻塞投递，失败渠道熔断，已开启的短信通知没有实现，列在 unsupported"""
+
+    class _FakeDb:
+        def search_filter(self, model, output_model, filter_params):
+            return [NoticeResponse(id=1, name='慢渠道', config='{"delay": 0.05}', admin_account='admin', admin_switch=True, user_switch=True),
+                    NoticeResponse(id=2, name='坏渠道', config='{"fail": true}', admin_account='admin', admin_switch=True, user_switch=False),
+                    NoticeResponse(id=3, name='短信通知', config='{}', admin_account='13800000000', admin_switch=True, user_switch=False)]
+
+    dispatcher = NoticeDispatcher(_FakeDb(), channels={'慢渠道': FakeChannel, '坏渠道': FakeChannel})
+    await dispatcher.start()
+    begin = time.perf_counter()
+    for i in range(20):
+        dispatcher.notify(f"订单{i}", "内容", "user@qq.com")
+    print(f"投递 20 条耗时 {(time.perf_counter() - begin) * 1000:.2f}ms")
+    await dispatcher.stop()
+    print(dispatcher.stats())
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark_dispatcher())
@@ -0,0 +1,193 @@
+import time
+from datetime import timedelta
+from typing import Optional
+from sqlalchemy import select, delete, func, case
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from utils.databaseManager import Database, Order, OrderRollup, beijing_now
+from utils.schemaMigrations import SchemaMigrator, ARCHIVE_MIGRATIONS
+
+
+"""
+代码说明：
+订单归档，把 horizon_days 天以前已经结束(已发货/已过期)的订单搬到单独的归档库 (默认 database/archive.db)，
+订单表只保留近期订单，常用的查询和索引都能留在页缓存里。
+1. 归档库使用同一个 Order 模型和表名，Database 已有的查询方法可以直接用在归档库上；归档库在第一次用到时才建立连接。
+2. 每批先写入归档库并提交，再在主库的一个事务里删除这批订单并累加到 OrderRollup；中途失败重跑时，
+   归档库按主键覆盖写入，不会重复，主库的删除和汇总要么都做、要么都不做。
+3. 仪表盘的累计订单数、总收入和热销榜 = 订单表 + OrderRollup；仪表盘按时间段的统计最多回看约 13 个月，
+   所以 horizon_days 不小于 MIN_HORIZON_DAYS，这些统计只查订单表也不会缺数据。
+4. 订单搜索、个人订单历史和导出可以选择同时查询归档库，结果与只查订单表的格式一致。
+"""
+
+ARCHIVABLE_STATES = ('delivered', 'expired')
+MIN_HORIZON_DAYS = 400
+
+
+class OrderArchive:
+    """archive_once 方法归档一次, 返回归档条数, 在线程中执行, 由定时任务每天低峰时段调用。
+       search / history / find 方法查询订单时合并归档库的结果。
+    """
+
+    def __init__(self, db, archive_url='sqlite:///database/archive.db', horizon_days=MIN_HORIZON_DAYS,
+                 batch_size=1000):
+        if horizon_days < MIN_HORIZON_DAYS:
+            raise ValueError(f"归档期限不能小于 {MIN_HORIZON_DAYS} 天, 否则仪表盘按时间段的统计会缺少数据")
+        self.db = db
+        self.archive_url = archive_url
+        self.horizon_days = horizon_days
+        self.batch_size = batch_size
+        self._archive = None
+        self.counters = {"archived": 0, "batches": 0, "runs": 0, "last_run": None, "last_seconds": 0.0}
+
+    @property
+    def archive(self) -> Database:
+        """归档库, 第一次访问时建立连接, 建表或补齐订单表新增的列"""
+        if self._archive is None:
+            archive = Database(self.archive_url, echo=False)
+            SchemaMigrator(archive, ARCHIVE_MIGRATIONS).upgrade()
+            self._archive = archive
+        return self._archive
+
+    def _archive_batch(self, cutoff, after_id: int, newest_id: int):
+        """归档 after_id 之后的一批订单, 返回 (归档条数, 本批最后一个编号), 没有可归档的订单时编号为 None"""
+        with self.db.engine.connect() as conn:
+            # 沿主键顺序扫描; state || '' 让 SQLite 不走 (state, updatetime) 索引, 否则每批都要把剩余的旧订单重新排序一遍
+            rows = conn.execute(select(Order.__table__)
+                                .where(Order.id > after_id, Order.id < newest_id, Order.updatetime < cutoff,
+                                       Order.state.concat('').in_(ARCHIVABLE_STATES))
+                                .order_by(Order.id).limit(self.batch_size)).mappings().all()
+        if not rows:
+            return 0, None
+        ids = [row['id'] for row in rows]
+        with self.archive.engine.begin() as conn:
+            conn.execute(sqlite_insert(Order).prefix_with('OR REPLACE'), [dict(row) for row in rows])
+
+        # 条件和读取时相同, 两步之间被修改过的订单不会被删除
+        moved = (Order.id.in_(ids), Order.updatetime < cutoff, Order.state.in_(ARCHIVABLE_STATES))
+        with self.db.engine.begin() as conn:
+            day = func.strftime('%Y-%m-%d', Order.updatetime)
+            rollups = conn.execute(select(day.label('day'), Order.name, func.count(Order.id).label('orders'),
+                                          func.sum(case((Order.status == True, 1), else_=0)).label('paid_orders'),
+                                          func.coalesce(func.sum(Order.total_price), 0).label('revenue'))
+                                   .where(*moved).group_by(day, Order.name)).mappings().all()
+            if rollups:
+                statement = sqlite_insert(OrderRollup)
+                conn.execute(statement.on_conflict_do_update(
+                    index_elements=['day', 'name'],
+                    set_={"orders": OrderRollup.orders + statement.excluded.orders,
+                          "paid_orders": OrderRollup.paid_orders + statement.excluded.paid_orders,
+                          "revenue": OrderRollup.revenue + statement.excluded.revenue}), [dict(row) for row in rollups])
+            deleted = conn.execute(delete(Order).where(*moved)).rowcount
+        if deleted < len(ids):
+            # 个别订单在两步之间状态变了, 仍留在订单表, 把它们从归档库撤回
+            with self.db.engine.connect() as conn:
+                kept = conn.execute(select(Order.id).where(Order.id.in_(ids))).scalars().all()
+            with self.archive.engine.begin() as conn:
+                conn.execute(delete(Order).where(Order.id.in_(kept)))
+        return deleted, ids[-1]
+
+    def archive_once(self, horizon_days: Optional[int] = None) -> int:
+        """归档早于 horizon_days 天的已结束订单, 每批一个短事务, 返回归档条数"""
+        horizon_days = horizon_days or self.horizon_days
+        if horizon_days < MIN_HORIZON_DAYS:
+            raise ValueError(f"归档期限不能小于 {MIN_HORIZON_DAYS} 天")
+        cutoff = beijing_now() - timedelta(days=horizon_days)
+        begin = time.perf_counter()
+        with self.db.engine.connect() as conn:
+            newest_id = conn.execute(select(func.max(Order.id))).scalar()
+        total, after_id = 0, 0
+        # 不归档编号最大的订单, 订单表永远不会被清空, 新订单的编号不会和归档库重复
+        while newest_id is not None:
+            moved, after_id = self._archive_batch(cutoff, after_id, newest_id)
+            if after_id is None:
+                break
+            total += moved
+            self.counters["batches"] += 1
+        if total:
+            with self.db.engine.connect() as conn:
+                conn.exec_driver_sql("PRAGMA optimize")
+        self.counters["archived"] += total
+        self.counters["runs"] += 1
+        self.counters["last_run"] = beijing_now().strftime('%Y-%m-%d %H:%M:%S')
+        self.counters["last_seconds"] = round(time.perf_counter() - begin, 3)
+        return total
+
+    def search(self, output_model, filter_params, page: int, page_size: int):
+        """订单表在前、归档库在后, 分页方式和返回格式同 Database.search_filter_page_turning"""
+        records, total = [], 0
+        skip = max(0, (page - 1) * page_size)
+        for database in (self.db, self.archive):
+            with database.read_scope() as session:
+                count = session.execute(select(func.count()).select_from(Order).where(*filter_params)).scalar()
+                offset = max(0, skip - total)
+                if offset < count and len(records) < page_size:
+                    rows = session.execute(database.plain_select(Order).where(*filter_params)
+                                           .offset(offset).limit(page_size - len(records))).all()
+                    records.extend(output_model.from_orm(row) for row in rows)
+                total += count
+        return {"records": records, "pager": {"page": page, "pageSize": (total + page_size - 1) // page_size,
+                                              "total": total}}
+
+    def history(self, output_model, owner_filter, limit=10, after=None):
+        """同 Database.search_order_history, 两个库各取一页后按 (updatetime, id) 倒序合并"""
+        hot = self.db.search_order_history(output_model, owner_filter, limit, after)
+        cold = self.archive.search_order_history(output_model, owner_filter, limit, after)
+        records = sorted(hot['records'] + cold['records'], key=lambda order: (order.updatetime, order.id), reverse=True)
+        more = len(records) > limit or hot['next'] is not None or cold['next'] is not None
+        records = records[:limit]
+        return {"records": records, "next": (records[-1].updatetime, records[-1].id) if more and records else None}
+
+    def find(self, output_model, filter_params):
+        """在归档库中查找一条订单, filter_params 为订单号及归属条件; 找不到返回 None"""
+        with self.archive.session_scope() as session:
+            record = session.query(Order).filter(*filter_params).first()
+            return output_model.from_orm(record) if record is not None else None
+
+    def stats(self):
+        return {**self.counters, "horizon_days": self.horizon_days}
+
+
+def benchmark_archive(rows=300_000, recent=20_000):
+    """rows 条订单中只有 recent 条是近期的: 归档前后查询近期订单统计的耗时, 以及归档后仪表盘累计数据是否不变"""
+    import os
+    import tempfile
+    from sqlalchemy import insert
+    from utils.usersManager import User
+
+    folder = tempfile.mkdtemp()
+    db = Database(f'sqlite:///{os.path.join(folder, "bench.db")}', echo=False)
+    db.create_tables()
+    User.__table__.create(db.engine)
+    now = beijing_now()
+    with db.engine.begin() as conn:
+        for offset in range(0, rows, 50000):
+            conn.execute(insert(Order), [
+                {"out_order_id": f"BENCH{i:012d}", "state": 'delivered', "status": i % 10 != 0, "name": f"商品{i % 7}",
+                 "payment": "alipay", "num": 1, "price": 9.99, "total_price": 9.99, "contact": f"user{i % 5000}@qq.com",
+                 "card": "卡密内容" * 8,
+                 "updatetime": now - timedelta(days=(rows - i) * 1000 / rows if i < rows - recent else 1)}
+                for i in range(offset, min(rows, offset + 50000))])
+
+    def measure():
+        begin = time.perf_counter()
+        for _ in range(5):
+            with db.engine.connect() as conn:
+                conn.execute(select(Order.name, func.count(Order.id), func.sum(Order.total_price))
+                             .where(Order.status == True).group_by(Order.name)).all()
+        return (time.perf_counter() - begin) / 5
+
+    before = db.search_dashboard()
+    print(f"归档前: 订单表 {rows} 行, 按商品汇总 {measure() * 1000:.1f}ms")
+    archive = OrderArchive(db, f'sqlite:///{os.path.join(folder, "archive.db")}')
+    begin = time.perf_counter()
+    archived = archive.archive_once()
+    print(f"归档 {archived} 行耗时 {time.perf_counter() - begin:.2f}s, {archive.stats()}")
+    print(f"归档后: 订单表 {rows - archived} 行, 按商品汇总 {measure() * 1000:.1f}ms")
+    after = db.search_dashboard()
+    for key in ('total_orders', 'total_revenue', 'top_5_products'):
+        print(f"  {key}: 归档前 {before[key]}, 归档后 {after[key]}")
+    print(f"重复归档: {archive.archive_once()} 行")
+
+
+if __name__ == '__main__':
+    benchmark_archive()
@@ -0,0 +1,401 @@
+import asyncio
+import random
+import string
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from typing import Optional
+from functools import lru_cache
+from sqlalchemy import select, insert, update, bindparam
+from utils.databaseManager import Order, Card, ProdInfo, Payment, beijing_now
+from utils.paymentManager import PaymentRegistry
+from utils.pricing import PriceTable
+from utils.couponManager import normalize_code
+
+
+"""
+代码说明：
+订单流程引擎，订单状态 pending(待支付) -> paid(已支付) -> delivered(已发货)，待支付超时 -> expired(已过期)。
+过期后仍收到支付回调的订单照常转为已支付，避免用户付了款却拿不到货。
+状态变更全部是带前置状态条件的 UPDATE，并发重复调用只有一次生效。
+订单号在进程内生成，不需要查询数据库；商品、价格表(含批发阶梯价)和支付方式缓存在内存中，下单只有一次库存查询和一次插入。
+商品修改后本进程立即清除缓存，其它 worker 进程的缓存最多 catalog_ttl 秒后重新加载，期间仍按旧的上架状态和价格下单。
+使用优惠券的订单先用布隆过滤器拒绝无效券码，再在插入订单的同一个事务里核销(utils/couponManager.py)，待支付订单过期时归还使用次数。
+下单和状态变更是热点路径, 直接在连接上执行 Core 语句, 不经过 ORM Session 的对象跟踪。
+下单、状态变更和领取卡密都是一个写操作 unit(conn)，传入 GroupCommitWriter 时交给它和其它写操作合并提交。
+"""
+
+TRANSITIONS = {
+    'pending': {'paid', 'expired'},
+    'paid': {'delivered'},
+    'delivered': set(),
+    'expired': {'paid'},
+}
+BASE36 = string.digits + string.ascii_lowercase
+
+# 热点语句预先构造, 每次执行只绑定参数, 省去 SQLAlchemy 构造和计算缓存键的开销
+INSERT_ORDER = insert(Order)
+SELECT_REUSE_CARD = select(Card.card).where(Card.prod_name == bindparam('name'), Card.reuse == True).limit(1)
+SELECT_UNUSED_CARDS = select(Card.id).where(Card.prod_name == bindparam('name'), Card.reuse == False,
+                                            Card.isused == False).limit(bindparam('num'))
+SELECT_PAID_ORDER = select(Order.name, Order.num, Order.total_price, Order.contact).where(
+    Order.out_order_id == bindparam('out_order_id'), Order.state == 'paid')
+
+
+@lru_cache(maxsize=None)
+def transition_statement(to_state: str, columns: tuple, from_state: Optional[str] = None):
+    """状态变更语句: 只更新当前状态允许切换到 to_state 的订单; from_state 不为 None 时只从这个状态切换"""
+    sources = [state for state, targets in TRANSITIONS.items() if to_state in targets and from_state in (None, state)]
+    return update(Order).where(Order.out_order_id == bindparam('b_out_order_id'), Order.state.in_(sources)
+                               ).values({column: bindparam(f'new_{column}') for column in columns})
+
+
+class OrderError(Exception):
+    """下单或订单状态变更失败, code/msg 直接用于 ResponseModel"""
+
+    def __init__(self, code: int, msg: str):
+        super().__init__(msg)
+        self.code = code
+        self.msg = msg
+
+
+class OrderIdGenerator:
+    """生成 Order_ + 13位毫秒时间戳 + 8位后缀 的订单号
+       后缀 = 进程随机前缀4位 + 毫秒内序号4位(base36)，同一进程内严格递增不重复，多进程依靠随机前缀区分。
+    """
+
+    def __init__(self):
+        self._node = ''.join(random.choices(BASE36, k=4))
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._seq = 0
+
+    def __call__(self) -> str:
+        with self._lock:
+            ms = int(time.time() * 1000)
+            if ms <= self._last_ms:
+                ms = self._last_ms
+                self._seq += 1
+                if self._seq >= 36 ** 4:  # 同一毫秒序号用完, 借用下一毫秒
+                    ms += 1
+                    self._seq = 0
+            else:
+                self._seq = 0
+            self._last_ms = ms
+            seq = self._seq
+        suffix = ''
+        for _ in range(4):
+            seq, digit = divmod(seq, 36)
+            suffix = BASE36[digit] + suffix
+        return f"Order_{ms}{self._node}{suffix}"
+
+
+@lru_cache(maxsize=None)
+def claim_statement(dialect_name: str):
+    """领取卡密: 选出未使用卡密并标记已用, 返回卡密内容; 非 SQLite 数据库跳过被其它事务锁定的行"""
+    candidates = SELECT_UNUSED_CARDS if dialect_name == 'sqlite' else SELECT_UNUSED_CARDS.with_for_update(skip_locked=True)
+    return update(Card).where(Card.id.in_(candidates.scalar_subquery()), Card.isused == False
+                              ).values(isused=True).returning(Card.card)
+
+
+class OrderManager:
+    """checkout 方法创建待支付订单, checkout_async 方法在协程中下单。
+       pay / deliver / expire_orders 方法推进订单状态。
+       quote 方法按批发阶梯价计算单价和总价; invalidate 方法在商品修改后清除商品和价格表缓存, 缓存另外每 catalog_ttl 秒过期一次;
+       支付方式从支付注册表读取。
+       expire_orders 由定时任务(utils/scheduler.py)定期调用, 把超时未支付的订单置为过期。
+    """
+
+    def __init__(self, db, notice_dispatcher=None, pay_timeout=15, payments: Optional[PaymentRegistry] = None,
+                 writer=None, coupons=None, catalog_ttl=5):
+        self.db = db
+        self.writer = writer  # GroupCommitWriter, 为 None 时每个写操作各自提交
+        self.coupons = coupons  # CouponManager, 为 None 时不能使用优惠券
+        self.notice_dispatcher = notice_dispatcher
+        self.pay_timeout = pay_timeout  # 分钟
+        self.payments = payments if payments is not None else PaymentRegistry(db)
+        self.new_order_id = OrderIdGenerator()
+        self.catalog_ttl = catalog_ttl  # 秒, 其它进程修改商品后本进程缓存的最长滞后时间
+        self._catalog = None  # ({商品名称: (是否上架, 是否自动发货)}, 价格表), 一起加载一起失效
+        self._catalog_expires = 0.0
+
+    def invalidate(self):
+        """清除商品缓存和价格表"""
+        self._catalog = None
+
+    def _load_products(self) -> tuple:
+        catalog = self._catalog
+        if catalog is None or time.monotonic() >= self._catalog_expires:
+            self._catalog_expires = time.monotonic() + self.catalog_ttl
+            with self.db.engine.connect() as conn:
+                rows = conn.execute(select(ProdInfo.name, ProdInfo.prod_price, ProdInfo.prod_price_tiers,
+                                           ProdInfo.state, ProdInfo.auto)).all()
+            catalog = self._catalog = ({name: (state, auto) for name, _, _, state, auto in rows},
+                                       PriceTable.compile((name, price, tiers) for name, price, tiers, _, _ in rows))
+        return catalog
+
+    def price_table(self) -> PriceTable:
+        return self._load_products()[1]
+
+    def quote(self, name: str, num: int) -> tuple:
+        """按阶梯价计算 (单价, 总价)"""
+        return self.price_table().quote(name, num)
+
+    def _write(self, unit):
+        """在一个事务中执行 unit(conn), unit 抛出异常时回滚; 有合并提交写入器时交给写入器, 和其它写操作一起提交"""
+        if self.writer is not None:
+            return self.writer.run(unit)
+        with self.db.engine.begin() as conn:
+            return unit(conn)
+
+    def checkout(self, name: str, num: int, payment: str, contact: str, contact_txt: Optional[str] = None,
+                 user_id: Optional[str] = None, coupon: Optional[str] = None) -> dict:
+        """创建待支付订单, 返回订单信息; user_id 为下单用户, 游客为 None; coupon 为优惠券码"""
+        values, unit = self._new_order(name, num, payment, contact, contact_txt, user_id, coupon)
+        self._write(unit)
+        return values
+
+    async def checkout_async(self, name: str, num: int, payment: str, contact: str, contact_txt: Optional[str] = None,
+                             user_id: Optional[str] = None, coupon: Optional[str] = None) -> dict:
+        """同 checkout, 不阻塞事件循环: 有合并提交写入器时在协程中等待提交, 没有时整个下单在线程中执行;
+           商品缓存过期时先在线程中重新加载, 校验下单参数时不读数据库
+        """
+        if self.writer is None:
+            return await asyncio.to_thread(self.checkout, name, num, payment, contact, contact_txt, user_id, coupon)
+        if self._catalog is None or time.monotonic() >= self._catalog_expires:
+            await asyncio.to_thread(self._load_products)
+        values, unit = self._new_order(name, num, payment, contact, contact_txt, user_id, coupon)
+        await self.writer.execute(unit)
+        return values
+
+    def _new_order(self, name, num, payment, contact, contact_txt, user_id, coupon=None):
+        """校验下单参数, 返回 (订单信息, 检查库存并插入订单的写操作)"""
+        products, prices = self._load_products()
+        if name not in products or not products[name][0]:
+            raise OrderError(404, "商品不存在或已下架")
+        entry = self.payments.get(payment)
+        if entry is None or not entry.isactive:
+            raise OrderError(400, "支付方式不可用")
+        if num < 1:
+            raise OrderError(400, "购买数量必须大于0")
+        if coupon is not None and (self.coupons is None or not self.coupons.might_exist(coupon)):
+            raise OrderError(400, "优惠券不可用")
+        auto = products[name][1]
+        price, total_price = prices.quote(name, num)
+        values = {"out_order_id": self.new_order_id(), "name": name, "payment": payment, "num": num, "price": price,
+                  "total_price": total_price, "contact": contact, "contact_txt": contact_txt,
+                  "state": 'pending', "status": False, "updatetime": beijing_now(), "user_id": user_id}
+
+        def unit(conn):
+            if auto and not self._in_stock(conn, name, num):
+                raise OrderError(409, "库存不足")
+            if coupon is not None:
+                # 按原价核销, 合并提交失败重放 unit 时结果不变
+                discounted = self.coupons.redeem(conn, coupon, name, total_price)
+                if discounted is None:
+                    raise OrderError(400, "优惠券不可用")
+                values.update(total_price=discounted, coupon=normalize_code(coupon))
+            conn.execute(INSERT_ORDER, [values])
+        return values, unit
+
+    @staticmethod
+    def _in_stock(conn, name: str, num: int) -> bool:
+        """有可重复使用的卡密, 或未使用卡密不少于 num 张; 两次查询都只走 (prod_name, reuse, isused) 索引"""
+        if conn.execute(SELECT_REUSE_CARD, {"name": name}).first():
+            return True
+        return len(conn.execute(SELECT_UNUSED_CARDS, {"name": name, "num": num}).all()) >= num
+
+    def transition(self, out_order_id: str, to_state: str, conn=None, from_state: Optional[str] = None, **values) -> bool:
+        """把订单切换到 to_state, 只有当前状态允许时才生效; from_state 不为 None 时只从这个状态切换"""
+        values.update(state=to_state, status=to_state in ('paid', 'delivered'))
+        statement = transition_statement(to_state, tuple(sorted(values)), from_state)
+        params = {f'new_{column}': value for column, value in values.items()}
+        params['b_out_order_id'] = out_order_id
+        if conn is not None:
+            return conn.execute(statement, params).rowcount == 1
+        return self._write(lambda conn: conn.execute(statement, params).rowcount == 1)
+
+    def pay(self, out_order_id: str) -> bool:
+        """标记订单已支付, 自动发货商品随即发货; 重复调用返回 False
+           过期订单用过的优惠券已归还次数, 支付时重新扣减, 次数已用完时不接受支付, 订单保持过期等待人工处理
+        """
+        def unit(conn):
+            if self.transition(out_order_id, 'paid', conn, from_state='pending'):
+                return True
+            coupon = conn.execute(select(Order.coupon).where(Order.out_order_id == out_order_id)).scalar()
+            if not self.transition(out_order_id, 'paid', conn, from_state='expired'):
+                return False
+            if coupon is not None and (self.coupons is None or not self.coupons.retake(conn, coupon)):
+                raise OrderError(409, "优惠券次数已用完")
+            return True
+
+        try:
+            if not self._write(unit):
+                return False
+        except OrderError as e:
+            print(f"订单 {out_order_id} 过期后支付未生效: {e.msg}, 等待人工处理")
+            return False
+        with self.db.engine.connect() as conn:
+            order = conn.execute(SELECT_PAID_ORDER, {"out_order_id": out_order_id}).first()
+        self.deliver(out_order_id, order=order)
+        return True
+
+    def deliver(self, out_order_id: str, card: Optional[str] = None, order=None) -> Optional[dict]:
+        """发货: 传入 card 为手工发货, 否则从卡密库中领取; 卡密不足或订单不是已支付状态时返回 None
+           order 为调用方已读出的 SELECT_PAID_ORDER 结果, 省去再查一次
+        """
+        if order is None:
+            with self.db.engine.connect() as conn:
+                order = conn.execute(SELECT_PAID_ORDER, {"out_order_id": out_order_id}).first()
+        if order is None or (card is None and not self.products_auto(order.name)):
+            return None
+
+        def unit(conn):
+            claimed = card
+            if claimed is None:
+                claimed = self._claim_cards(conn, order.name, order.num)
+                if claimed is None:
+                    raise OrderError(409, "卡密不足")
+            if not self.transition(out_order_id, 'delivered', conn, card=claimed):
+                raise OrderError(409, "订单不是已支付状态")
+            return claimed
+
+        try:
+            card = self._write(unit)
+        except OrderError as e:
+            if card is None and e.msg == "卡密不足":
+                print(f"订单 {out_order_id} 卡密不足, 等待手工发货")
+            return None
+        result = {"out_order_id": out_order_id, "name": order.name, "num": order.num,
+                  "total_price": order.total_price, "contact": order.contact, "card": card}
+        if self.notice_dispatcher is not None:
+            self.notice_dispatcher.notify_order('已发货', _OrderEvent(result))
+        return result
+
+    def products_auto(self, name: str) -> bool:
+        products = self._load_products()[0]
+        return name in products and products[name][1]
+
+    @staticmethod
+    def _claim_cards(conn, name: str, num: int) -> Optional[str]:
+        """领取 num 张未使用卡密并标记已用, 可重复使用的卡密优先; 卡密不足时返回 None, 调用方需回滚"""
+        reuse = conn.execute(SELECT_REUSE_CARD, {"name": name}).first()
+        if reuse is not None:
+            return reuse.card
+        params = {"name": name, "num": num}
+        if conn.dialect.update_returning:
+            # 一条 UPDATE 完成挑选和标记, 并发订单不会领到同一张卡
+            cards = conn.execute(claim_statement(conn.dialect.name), params).scalars().all()
+        else:
+            rows = conn.execute(SELECT_UNUSED_CARDS.with_for_update(skip_locked=True), params).all()
+            ids = [row.id for row in rows]
+            claimed = conn.execute(update(Card).where(Card.id.in_(ids), Card.isused == False).values(isused=True)).rowcount
+            cards = conn.execute(select(Card.card).where(Card.id.in_(ids))).scalars().all() if claimed == len(ids) else []
+        if len(cards) < num:
+            return None
+        return '\n'.join(cards)
+
+    def expire_orders(self) -> int:
+        """把超时未支付的订单置为过期, 返回过期数量; 过期订单用过的优惠券在同一个事务中归还使用次数"""
+        deadline = beijing_now() - timedelta(minutes=self.pay_timeout)
+        expire = update(Order).where(Order.state == 'pending', Order.updatetime < deadline).values(state='expired', status=False)
+        with self.db.engine.begin() as conn:
+            if self.coupons is None:
+                return conn.execute(expire).rowcount
+            if conn.dialect.update_returning:
+                codes = conn.execute(expire.returning(Order.coupon)).scalars().all()
+            else:
+                codes = conn.execute(select(Order.coupon).where(Order.state == 'pending', Order.updatetime < deadline)
+                                     .with_for_update()).scalars().all()
+                conn.execute(expire)
+            self.coupons.release(conn, Counter(code for code in codes if code is not None))
+            return len(codes)
+
+
+class _OrderEvent:
+    """把订单字典包装成通知需要的属性访问形式"""
+
+    def __init__(self, values: dict):
+        self.__dict__.update(values)
+
+
+def benchmark_checkout(total=5000, threads=4):
+    """在临时 SQLite WAL 数据库上压测下单吞吐"""
+    import os
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from utils.databaseManager import Database
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    db = Database(f'sqlite:///{path}', echo=False)
+    db.create_tables()
+    db.create_data(ProdInfo(name='压测商品', prod_cag_name='压测', prod_price=9.9, auto=True, state=True))
+    db.create_data(Payment(name='压测支付', icon='-', config='{}', info='-', isactive=True))
+    db.create_batch_data([Card(prod_name='压测商品', card=f'card-{i}') for i in range(total)])
+    manager = OrderManager(db)
+
+    def place(i):
+        order = manager.checkout('压测商品', 1, '压测支付', f'user{i}@qq.com')
+        return order['out_order_id']
+
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        ids = list(executor.map(place, range(total)))
+    elapsed = time.perf_counter() - begin
+    print(f"下单 {total} 个, {threads} 线程, 耗时 {elapsed:.2f}s, {total / elapsed:.0f} 单/秒, 订单号唯一: {len(set(ids)) == total}")
+
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        paid = sum(executor.map(manager.pay, ids + ids[:total // 10]))
+    elapsed = time.perf_counter() - begin
+    print(f"支付发货 {paid} 个(含 {total // 10} 个重复支付), 耗时 {elapsed:.2f}s, {paid / elapsed:.0f} 单/秒")
+    with db.engine.connect() as conn:
+        delivered = conn.execute(select(Order.card).where(Order.state == 'delivered')).scalars().all()
+    print(f"已发货 {len(delivered)} 个, 卡密无重复: {len(set(delivered)) == len(delivered)}")
+
+
+def benchmark_history(rows=1_000_000, user_orders=5000, pages=50):
+    """在百万级订单表上压测个人订单历史的游标分页"""
+    import os
+    import tempfile
+    from datetime import datetime
+    from utils.databaseManager import Database
+    from utils.databaseSchemas import OrderResponse
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    db = Database(f'sqlite:///{path}', echo=False)
+    db.create_tables()
+    begin = time.perf_counter()
+    start = datetime(2024, 1, 1)
+    with db.engine.begin() as conn:
+        for offset in range(0, rows, 50000):
+            conn.execute(INSERT_ORDER, [{
+                "out_order_id": f"Order_{i}", "name": '压测商品', "payment": '压测支付', "num": 1, "price": 1.0,
+                "total_price": 1.0, "contact": f"user{i % 100000}@qq.com", "state": 'delivered', "status": True,
+                "updatetime": start + timedelta(seconds=i), "user_id": 'hot-user' if i % (rows // user_orders) == 0 else f"user-{i % 100000}"}
+                for i in range(offset, min(offset + 50000, rows))])
+    print(f"写入 {rows} 条订单耗时 {time.perf_counter() - begin:.1f}s")
+
+    owner = Order.user_id == 'hot-user'
+    with db.engine.connect() as conn:
+        statement = select(Order).where(owner).order_by(Order.updatetime.desc(), Order.id.desc()).limit(20)
+        plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(statement.compile(db.engine, compile_kwargs={"literal_binds": True}))).all()
+    print("查询计划:", [row[-1] for row in plan])
+
+    begin = time.perf_counter()
+    after, fetched = None, 0
+    for _ in range(pages):
+        result = db.search_order_history(OrderResponse, owner, 20, after)
+        fetched += len(result['records'])
+        after = result['next']
+    elapsed = time.perf_counter() - begin
+    print(f"用户 {user_orders} 单中连续翻 {pages} 页, 共 {fetched} 条, 平均每页 {elapsed / pages * 1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['history']:
+        benchmark_history()
+    else:
+        benchmark_checkout()
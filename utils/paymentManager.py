@@ -0,0 +1,448 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+from sqlalchemy import select, insert, update, bindparam
+from sqlalchemy.exc import IntegrityError
+from utils.databaseManager import Order, Payment, PaymentCallback
+from utils.databaseSchemas import PayConfig
+
+
+"""
+代码说明：
+支付回调处理，各支付渠道的异步通知统一进入 PaymentGateway.handle。
+0. PaymentRegistry 把 Payment 表整表解析为只读的 PayConfig 缓存，下单、后台读取和回调都从这里取配置，支付设置修改后 invalidate。
+1. 按渠道验签，渠道实现随注册表版本重建。
+2. 以 订单号 + 支付平台交易号 为幂等键写入 PaymentCallback 表，重复或重试的通知直接应答成功。
+3. 同一幂等键的并发通知在进程内合并为一次处理(single-flight)。
+4. 记录落库后立即应答支付平台，发货放到后台队列；进程重启后未完成的记录会重新入队。
+订单状态变更本身也带前置状态条件，即使多个进程同时处理同一笔支付也只会发货一次。
+"""
+
+SELECT_ORDER_AMOUNT = select(Order.total_price).where(Order.out_order_id == bindparam('out_order_id'))
+SELECT_CALLBACK_STATE = select(PaymentCallback.state).where(PaymentCallback.out_order_id == bindparam('out_order_id'),
+                                                            PaymentCallback.trade_no == bindparam('trade_no'))
+SELECT_RECEIVED = select(PaymentCallback.out_order_id, PaymentCallback.trade_no).where(PaymentCallback.state == 'received')
+INSERT_CALLBACK = insert(PaymentCallback)
+MARK_FULFILLED = update(PaymentCallback).where(PaymentCallback.out_order_id == bindparam('b_out_order_id'),
+                                               PaymentCallback.trade_no == bindparam('b_trade_no'),
+                                               PaymentCallback.state == 'received').values(state='fulfilled')
+
+
+class PaymentNotification(NamedTuple):
+    """验签通过的支付通知"""
+    out_order_id: str
+    trade_no: str
+    amount: Optional[float]
+    paid: bool
+
+
+def md5_sign(params: dict, suffix: str, exclude=('sign', 'sign_type')) -> str:
+    """常见的签名方式: 去掉空值和签名字段, 按参数名排序拼接 k=v&k=v, 末尾追加密钥后取 md5"""
+    query = '&'.join(f"{key}={params[key]}" for key in sorted(params) if key not in exclude and params[key] not in ('', None))
+    return hashlib.md5((query + suffix).encode()).hexdigest()
+
+
+def _to_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class PaymentProvider:
+    """支付渠道基类
+       verify 验签并解析通知, 签名错误返回 None。
+       ack_success / ack_fail 为应答支付平台的文本。
+    """
+    ack_success = 'success'
+    ack_fail = 'fail'
+
+    def __init__(self, config: dict):
+        self.config = config
+
+    def verify(self, params: dict) -> Optional[PaymentNotification]:
+        raise NotImplementedError
+
+    @staticmethod
+    def signature_equal(expected: str, actual) -> bool:
+        return isinstance(actual, str) and hmac.compare_digest(expected.lower(), actual.lower())
+
+
+class EpayProvider(PaymentProvider):
+    """易支付"""
+
+    def sign(self, params: dict) -> str:
+        return md5_sign(params, self.config['KEY'])
+
+    def verify(self, params):
+        if not self.signature_equal(self.sign(params), params.get('sign')):
+            return None
+        return PaymentNotification(params.get('out_trade_no'), params.get('trade_no'), _to_float(params.get('money')),
+                                   params.get('trade_status') == 'TRADE_SUCCESS')
+
+
+class CodepayProvider(PaymentProvider):
+    """码支付, 只在支付成功时通知"""
+    ack_success = 'ok'
+
+    def verify(self, params):
+        if not self.signature_equal(md5_sign(params, self.config['codepay_key']), params.get('sign')):
+            return None
+        return PaymentNotification(params.get('pay_id'), params.get('pay_no'), _to_float(params.get('money')), True)
+
+
+class PayjsProvider(PaymentProvider):
+    """PAYJS, 金额单位为分"""
+
+    def verify(self, params):
+        if not self.signature_equal(md5_sign(params, f"&key={self.config['payjs_key']}"), params.get('sign')):
+            return None
+        amount = _to_float(params.get('total_fee'))
+        return PaymentNotification(params.get('out_trade_no'), params.get('payjs_order_id'),
+                                   None if amount is None else amount / 100, str(params.get('return_code')) == '1')
+
+
+class XunhupayProvider(PaymentProvider):
+    """虎皮椒, 签名字段为 hash"""
+
+    def verify(self, params):
+        if not self.signature_equal(md5_sign(params, self.config['AppSecret'], exclude=('hash',)), params.get('hash')):
+            return None
+        return PaymentNotification(params.get('trade_order_id'), params.get('open_order_id') or params.get('transaction_id'),
+                                   _to_float(params.get('total_fee')), params.get('status') == 'OD')
+
+
+class VmqProvider(PaymentProvider):
+    """V免签, 没有平台交易号, 以订单号作为交易号"""
+
+    def verify(self, params):
+        fields = [params.get(key, '') for key in ('payId', 'param', 'type', 'price', 'reallyPrice')]
+        expected = hashlib.md5((''.join(fields) + self.config['KEY']).encode()).hexdigest()
+        if not self.signature_equal(expected, params.get('sign')):
+            return None
+        return PaymentNotification(params.get('payId'), f"vmq-{params.get('payId')}", _to_float(params.get('price')), True)
+
+
+class YunGouOSProvider(PaymentProvider):
+    """YunGouOS, 只有固定的几个字段参与签名"""
+    ack_success = 'SUCCESS'
+
+    def verify(self, params):
+        signed = {key: params.get(key) for key in ('code', 'orderNo', 'outTradeNo', 'payNo', 'money', 'mchId')}
+        expected = md5_sign(signed, f"&key={self.config['pay_secret']}")
+        if not self.signature_equal(expected, params.get('sign')):
+            return None
+        return PaymentNotification(params.get('outTradeNo'), params.get('orderNo'), _to_float(params.get('money')),
+                                   str(params.get('code')) == '1')
+
+
+# Payment.name -> 渠道实现; 支付宝当面付/微信官方/QQ钱包/云免签/Mugglepay/Stripe 暂未接入异步通知
+PROVIDERS = {
+    '虎皮椒支付宝': XunhupayProvider,
+    '虎皮椒微信': XunhupayProvider,
+    'PAYJS支付宝': PayjsProvider,
+    'PAYJS微信': PayjsProvider,
+    '码支付支付宝': CodepayProvider,
+    '码支付微信': CodepayProvider,
+    '码支付QQ': CodepayProvider,
+    'V免签支付宝': VmqProvider,
+    'V免签微信': VmqProvider,
+    '易支付QQ': EpayProvider,
+    '易支付支付宝': EpayProvider,
+    '易支付微信': EpayProvider,
+    'YunGouOS': YunGouOSProvider,
+    'YunGouOS_WXPAY': YunGouOSProvider,
+}
+
+
+class PaymentRegistry:
+    """支付方式注册表
+       entries / get / active 方法返回解析后的 PayConfig, 配置 JSON 只在加载时解析一次。
+       invalidate 方法在支付设置修改后清除缓存, version 递增, 依赖方据此重建自己的缓存。
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.version = 0
+        self._entries = None
+        self._by_name = None
+
+    def invalidate(self):
+        self._entries = None
+        self.version += 1
+
+    def _load(self):
+        with self.db.engine.connect() as conn:
+            rows = conn.execute(select(Payment.id, Payment.name, Payment.icon, Payment.config, Payment.info,
+                                       Payment.isactive).order_by(Payment.id)).all()
+        entries = []
+        for row in rows:
+            try:
+                config = json.loads(row.config) if row.config else {}
+            except ValueError as e:
+                print(f"支付渠道 {row.name} 配置不是有效的 JSON: {e}")
+                config = {}
+            entries.append(PayConfig(id=row.id, name=row.name, icon=row.icon, config=config, info=row.info,
+                                     isactive=row.isactive))
+        return tuple(entries)
+
+    def entries(self):
+        """全部支付方式, 按 id 排序"""
+        entries = self._entries
+        if entries is None:
+            entries = self._load()
+            self._by_name = {entry.name: entry for entry in entries}
+            self._entries = entries
+        return entries
+
+    def get(self, name: str) -> Optional[PayConfig]:
+        self.entries()
+        return self._by_name.get(name)
+
+    def active(self):
+        return tuple(entry for entry in self.entries() if entry.isactive)
+
+
+class PaymentGateway:
+    """支付回调网关
+       load_providers 方法返回已启用支付方式的渠道实现, 随支付注册表更新。
+       handle 方法处理一条回调通知, 返回 (是否成功, 应答文本)。
+       start / stop 方法启动和停止后台发货协程, start 时会把未完成的回调重新入队。
+    """
+
+    def __init__(self, db, order_manager, queue_size=10000, workers=4, recover_interval=60,
+                 providers: Optional[Dict[str, type]] = None):
+        self.db = db
+        self.order_manager = order_manager
+        self.payments = order_manager.payments
+        self.queue_size = queue_size
+        self.workers = workers
+        self.recover_interval = recover_interval
+        self.registry = dict(PROVIDERS if providers is None else providers)
+        self._providers = None
+        self._providers_version = None
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._queue = None
+        self._queued = set()
+        self._loop = None
+        self._tasks = []
+        self.counters = {"accepted": 0, "duplicate": 0, "coalesced": 0, "rejected": 0, "fulfilled": 0, "failed": 0}
+
+    def load_providers(self):
+        """已启用支付方式的渠道实现, 支付注册表变化后重建"""
+        if self._providers is None or self._providers_version != self.payments.version:
+            version = self.payments.version
+            providers = {}
+            for entry in self.payments.active():
+                provider_cls = self.registry.get(entry.name)
+                if provider_cls is None:
+                    continue
+                try:
+                    providers[entry.name] = provider_cls(entry.config)
+                except Exception as e:
+                    print(f"支付渠道 {entry.name} 配置错误: {e}")
+            self._providers, self._providers_version = providers, version
+        return self._providers
+
+    async def handle(self, name: str, params: dict) -> Tuple[bool, str]:
+        """处理回调: 验签 -> 幂等落库 -> 发货入队 -> 应答"""
+        provider = self.load_providers().get(name)
+        if provider is None:
+            return False, 'unsupported'
+        try:
+            notification = provider.verify(params)
+        except Exception as e:
+            print(f"支付回调解析失败 {name}: {e!r}")
+            notification = None
+        if notification is None or not notification.out_order_id or not notification.trade_no:
+            self.counters["rejected"] += 1
+            return False, provider.ack_fail
+        if not notification.paid:
+            return True, provider.ack_success
+
+        key = (notification.out_order_id, notification.trade_no)
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self.counters["coalesced"] += 1
+            accepted = await asyncio.shield(flight)
+        else:
+            flight = asyncio.get_running_loop().create_future()
+            self._inflight[key] = flight
+            try:
+                accepted = await asyncio.to_thread(self._accept, name, notification)
+            except Exception as e:
+                print(f"支付回调记录失败 {key}: {e!r}")
+                accepted = False
+            finally:
+                del self._inflight[key]
+            flight.set_result(accepted)
+        return (True, provider.ack_success) if accepted else (False, provider.ack_fail)
+
+    def _accept(self, name: str, notification: PaymentNotification) -> bool:
+        """写入幂等记录, 新记录入队发货; 返回是否应答成功"""
+        key = {"out_order_id": notification.out_order_id, "trade_no": notification.trade_no}
+        try:
+            with self.db.engine.begin() as conn:
+                total_price = conn.execute(SELECT_ORDER_AMOUNT, key).scalar()
+                if total_price is None:
+                    self.counters["rejected"] += 1
+                    return False
+                valid = notification.amount is None or abs(notification.amount - total_price) < 0.01
+                conn.execute(INSERT_CALLBACK, {**key, "payment": name, "amount": notification.amount,
+                                               "state": 'received' if valid else 'rejected'})
+        except IntegrityError:
+            self.counters["duplicate"] += 1
+            with self.db.engine.connect() as conn:
+                return conn.execute(SELECT_CALLBACK_STATE, key).scalar() != 'rejected'
+        if not valid:
+            self.counters["rejected"] += 1
+            print(f"支付回调金额不符 {notification.out_order_id}: 实付 {notification.amount}, 应付 {total_price}")
+            return False
+        self.counters["accepted"] += 1
+        self._enqueue(notification.out_order_id, notification.trade_no)
+        return True
+
+    def _enqueue(self, out_order_id: str, trade_no: str):
+        """从工作线程放入发货队列; 未启动时留在表中, 由启动时的恢复处理"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._put, (out_order_id, trade_no))
+
+    def _put(self, key):
+        """在事件循环中入队, 已在队列中的跳过; 队列满时留给下一次恢复"""
+        if self._queue is None or key in self._queued:
+            return
+        try:
+            self._queue.put_nowait(key)
+            self._queued.add(key)
+        except asyncio.QueueFull:
+            pass
+
+    def _fulfill(self, out_order_id: str, trade_no: str):
+        """支付并发货, 订单已支付过时 pay 直接返回 False"""
+        self.order_manager.pay(out_order_id)
+        with self.db.engine.begin() as conn:
+            conn.execute(MARK_FULFILLED, {"b_out_order_id": out_order_id, "b_trade_no": trade_no})
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            try:
+                await asyncio.to_thread(self._fulfill, *key)
+                self.counters["fulfilled"] += 1
+            except Exception as e:
+                self.counters["failed"] += 1
+                print(f"支付回调发货失败 {key[0]}: {e!r}")
+            finally:
+                self._queued.discard(key)
+                self._queue.task_done()
+
+    def recover(self) -> int:
+        """把已落库但未完成发货的回调重新入队, 在线程中执行"""
+        with self.db.engine.connect() as conn:
+            rows = conn.execute(SELECT_RECEIVED).all()
+        for out_order_id, trade_no in rows:
+            self._enqueue(out_order_id, trade_no)
+        return len(rows)
+
+    async def _recover_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.recover)
+            except Exception as e:
+                print(f"支付回调恢复失败: {e!r}")
+            await asyncio.sleep(self.recover_interval)
+
+    async def start(self):
+        """启动后台发货协程和定期恢复"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._loop = asyncio.get_running_loop()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._recover_loop()))
+
+    async def stop(self, timeout=5):
+        """停止后台协程, 最多等待 timeout 秒完成已入队的发货"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"支付回调队列未处理完毕, {self._queue.qsize()} 条将在下次启动时恢复")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._queued.clear()
+        self._loop = None
+
+    def stats(self):
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return {**self.counters, "queued": queued, "inflight": len(self._inflight)}
+
+
+class FakeProvider(EpayProvider):
+    """本地假渠道, 使用易支付签名方式, build 方法生成带签名的回调参数"""
+
+    def build(self, out_order_id: str, trade_no: str, money: float, status='TRADE_SUCCESS') -> dict:
+        params = {"pid": "1", "out_trade_no": out_order_id, "trade_no": trade_no, "money": f"{money:.2f}",
+                  "trade_status": status, "type": "alipay"}
+        params["sign"] = self.sign(params)
+        params["sign_type"] = "MD5"
+        return params
+
+
+async def benchmark_callbacks(total=2000, duplicates=3, concurrency=200):
+    """在临时数据库上用假渠道压测回调: 每笔支付重复通知 duplicates 次, 检查只发货一次"""
+    import os
+    import tempfile
+    from utils.databaseManager import Database, ProdInfo, Card
+    from utils.orderManager import OrderManager
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    db = Database(f'sqlite:///{path}', echo=False)
+    db.create_tables()
+    db.create_data(ProdInfo(name='压测商品', prod_cag_name='压测', prod_price=9.9, auto=True, state=True))
+    db.create_data(Payment(name='压测支付', icon='-', config='{"KEY": "fake-key"}', info='-', isactive=True))
+    db.create_batch_data([Card(prod_name='压测商品', card=f'card-{i}') for i in range(total)])
+    gateway = PaymentGateway(db, OrderManager(db), providers={'压测支付': FakeProvider})
+    provider = gateway.load_providers()['压测支付']
+    orders = [db_order['out_order_id'] for db_order in
+              [gateway.order_manager.checkout('压测商品', 1, '压测支付', f'user{i}@qq.com') for i in range(total)]]
+    callbacks = [provider.build(out_order_id, f"T{i}", 9.9) for i, out_order_id in enumerate(orders) for _ in range(duplicates)]
+    forged = provider.build(orders[0], 'T-forged', 9.9)
+    forged['money'] = '0.01'
+
+    await gateway.start()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def send(params):
+        async with semaphore:
+            begin = time.perf_counter()
+            ok, _ = await gateway.handle('压测支付', params)
+            latencies.append(time.perf_counter() - begin)
+            return ok
+
+    begin = time.perf_counter()
+    results = await asyncio.gather(*[send(params) for params in callbacks])
+    elapsed = time.perf_counter() - begin
+    forged_ok, _ = await gateway.handle('压测支付', forged)
+    await gateway.stop(timeout=60)
+    latencies.sort()
+    print(f"回调 {len(callbacks)} 条({duplicates} 倍重复), 耗时 {elapsed:.2f}s, {len(callbacks) / elapsed:.0f} 条/秒, "
+          f"应答延迟 p50 {latencies[len(latencies) // 2] * 1000:.1f}ms p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms")
+    with db.engine.connect() as conn:
+        cards = conn.execute(select(Order.card).where(Order.state == 'delivered')).scalars().all()
+        records = conn.execute(select(PaymentCallback.state)).scalars().all()
+    print(f"全部应答成功: {all(results)}, 篡改金额被拒: {not forged_ok}, 已发货 {len(cards)}/{total}, "
+          f"卡密无重复: {len(set(cards)) == len(cards)}, 幂等记录 {len(records)} 条")
+    print(gateway.stats())
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark_callbacks())
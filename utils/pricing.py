@@ -0,0 +1,117 @@
+import json
+import time
+from bisect import bisect_right
+from typing import Optional
+
+
+"""
+代码说明：
+批发阶梯价。商品的 prod_price_tiers 保存为 JSON: [[起购数量, 单价], ...]，如 [[10, 8.5], [50, 8]] 表示
+买 10 件及以上每件 8.5，买 50 件及以上每件 8，不足 10 件按 prod_price。prod_price_wholesale 仍是前台展示用的文字，不参与计价。
+1. parse_price_tiers 校验并规范化阶梯价：起购数量为大于 1 的整数且不重复，单价不为负，按数量从小到大排序；商品新增和修改时调用。
+2. PriceTable 把全部商品的基础价和阶梯价编译成两个元组 (起购数量, 单价)，起购数量以 1 开头；
+   unit_price 用 bisect 在起购数量中二分查找，下单和前台询价都只是一次字典查找加一次二分，不再解析字符串。
+3. 价格表由 OrderManager 和商品缓存一起加载，商品新增、修改、删除时 invalidate 后下次用到再重新编译。
+"""
+
+
+def parse_price_tiers(text: Optional[str]) -> tuple:
+    """解析并校验阶梯价 JSON, 返回按起购数量排序的 ((数量, 单价), ...); 为空时返回 (), 格式不对时抛出 ValueError"""
+    if text is None or not text.strip():
+        return ()
+    try:
+        tiers = json.loads(text)
+    except ValueError:
+        raise ValueError("阶梯价应为 JSON, 如 [[10, 8.5], [50, 8]]")
+    if not isinstance(tiers, list):
+        raise ValueError("阶梯价应为 [[起购数量, 单价], ...]")
+    parsed = []
+    for tier in tiers:
+        if not isinstance(tier, (list, tuple)) or len(tier) != 2:
+            raise ValueError(f"阶梯价每一档应为 [起购数量, 单价]: {tier!r}")
+        num, price = tier
+        if isinstance(num, bool) or not isinstance(num, int) or num < 2:
+            raise ValueError(f"起购数量应为大于 1 的整数: {num!r}")
+        if isinstance(price, bool) or not isinstance(price, (int, float)) or price < 0:
+            raise ValueError(f"单价应为非负数: {price!r}")
+        parsed.append((num, float(price)))
+    parsed.sort()
+    if len({num for num, _ in parsed}) != len(parsed):
+        raise ValueError("起购数量不能重复")
+    return tuple(parsed)
+
+
+def dump_price_tiers(tiers: tuple) -> Optional[str]:
+    """规范化后的阶梯价写回 JSON, 没有阶梯价时为 None"""
+    return json.dumps([list(tier) for tier in tiers]) if tiers else None
+
+
+class PriceTable:
+    """compile 方法编译全部商品的价格, unit_price 方法返回买 num 件时的单价, quote 方法返回单价和总价, tiers 方法返回展示用的阶梯"""
+
+    def __init__(self):
+        self._prices = {}
+
+    @classmethod
+    def compile(cls, rows) -> 'PriceTable':
+        """rows 为 (商品名称, 基础价, 阶梯价 JSON); 阶梯价格式不对的商品只按基础价计价并打印提示"""
+        table = cls()
+        for name, price, tiers_text in rows:
+            try:
+                tiers = parse_price_tiers(tiers_text)
+            except ValueError as e:
+                print(f"商品 {name} 的阶梯价无效, 按基础价计价: {e}")
+                tiers = ()
+            table._prices[name] = ((1,) + tuple(num for num, _ in tiers), (price,) + tuple(p for _, p in tiers))
+        return table
+
+    def __contains__(self, name):
+        return name in self._prices
+
+    def unit_price(self, name: str, num: int) -> float:
+        breaks, prices = self._prices[name]
+        return prices[bisect_right(breaks, num) - 1]
+
+    def quote(self, name: str, num: int) -> tuple:
+        """(单价, 总价), 总价保留两位小数"""
+        price = self.unit_price(name, num)
+        return price, round(price * num, 2)
+
+    def tiers(self, name: str) -> list:
+        breaks, prices = self._prices[name]
+        return [{"min_num": num, "price": price} for num, price in zip(breaks, prices)]
+
+
+def benchmark_pricing(products=2000, tiers=8, lookups=200_000):
+    """每次询价都解析阶梯价 JSON 和查编译好的价格表的耗时对比, 以及两者结果是否一致"""
+    import random
+
+    rows = []
+    for i in range(products):
+        steps = sorted(random.sample(range(2, 1000), tiers))
+        rows.append((f"商品{i}", 10.0, json.dumps([[num, round(10 - 0.5 * (k + 1), 2)] for k, num in enumerate(steps)])))
+    raw = {name: (price, text) for name, price, text in rows}
+    queries = [(f"商品{random.randrange(products)}", random.randint(1, 1200)) for _ in range(lookups)]
+
+    def parse_each_time(name, num):
+        price, text = raw[name]
+        for min_num, tier_price in parse_price_tiers(text):
+            if num >= min_num:
+                price = tier_price
+        return price
+
+    begin = time.perf_counter()
+    expected = [parse_each_time(name, num) for name, num in queries]
+    parsed = (time.perf_counter() - begin) / lookups * 1e6
+    begin = time.perf_counter()
+    table = PriceTable.compile(rows)
+    compiled = (time.perf_counter() - begin) * 1000
+    begin = time.perf_counter()
+    got = [table.unit_price(name, num) for name, num in queries]
+    looked_up = (time.perf_counter() - begin) / lookups * 1e6
+    print(f"{products} 个商品每个 {tiers} 档: 编译价格表 {compiled:.1f}ms; 每次询价解析 {parsed:.2f}us, "
+          f"查价格表 {looked_up:.3f}us, 结果一致: {expected == got}")
+
+
+if __name__ == '__main__':
+    benchmark_pricing()
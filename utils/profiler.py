@@ -0,0 +1,317 @@
+import asyncio
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import Optional, Sequence
+from utils.databaseManager import beijing_now
+from utils.metrics import route_template
+
+
+"""
+代码说明：
+慢请求采样分析器，默认关闭，由管理员接口开启；关闭时中间件只多一次属性判断。
+开启后，匹配 paths 前缀的请求在开始时登记自己的协程，采样线程每 interval 秒读取一次事件循环线程的调用栈：
+1. 协程正在事件循环上运行: 从栈顶向下找到该请求的协程帧，截取这一段作为样本，同步阻塞事件循环的代码就在这里。
+2. 协程处于挂起状态: 沿 cr_await 链取出它正在等待的位置，叶子记为 <await 类型>，例如 asyncio.to_thread 里的同步数据库调用。
+请求结束时，耗时达到 threshold_ms 的、或者按 sample_every 每 N 个请求抽中的，保存为一份分析结果，否则丢弃。
+保存最近 max_profiles 份结果，可导出为 collapsed stacks (flamegraph.pl / speedscope 均可导入) 或 speedscope JSON。
+"""
+
+
+class RequestProfile:
+    """一个正在被采样的请求, samples 为 {调用栈: [样本数, 累计秒数]}"""
+    __slots__ = ('id', 'method', 'path', 'forced', 'thread_id', 'coro', 'root', 'begin', 'samples')
+
+    def __init__(self, profile_id: int, scope, coro, forced: bool):
+        self.id = profile_id
+        self.method = scope['method']
+        self.path = scope['path']
+        self.forced = forced
+        self.thread_id = threading.get_ident()
+        self.coro = coro
+        self.root = coro.cr_frame
+        self.begin = time.perf_counter()
+        self.samples = {}
+
+
+class SamplingProfiler:
+    """configure 方法修改开关和阈值, status 方法返回当前设置和计数。
+       begin / end 方法由中间件在请求开始和结束时调用, 采样在独立线程中进行。
+       profiles 方法返回已保存结果的摘要, export 方法按 collapsed 或 speedscope 格式导出一份结果。
+    """
+
+    def __init__(self, interval=0.005, threshold_ms: Optional[int] = 500, sample_every=0, paths: Sequence[str] = (),
+                 max_profiles=50, max_active=32, max_depth=128):
+        self.enabled = False
+        self.interval = interval
+        self.threshold_ms = threshold_ms
+        self.sample_every = sample_every
+        self.paths = tuple(paths)
+        self.max_active = max_active
+        self.max_depth = max_depth
+        self._profiles = deque(maxlen=max_profiles)
+        self._active = {}
+        self._path_counts = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closing = False
+        self._labels = {}
+        self.counters = {"profiled": 0, "kept": 0, "discarded": 0, "skipped": 0, "samples": 0, "sampler_seconds": 0.0}
+
+    def configure(self, enabled: bool, threshold_ms: Optional[int] = None, sample_every: Optional[int] = None,
+                  paths: Optional[Sequence[str]] = None, interval_ms: Optional[float] = None):
+        """threshold_ms 为 None 时只保存按 sample_every 抽中的请求; paths 为空时匹配全部请求"""
+        self.threshold_ms = threshold_ms
+        if sample_every is not None:
+            self.sample_every = sample_every
+        if paths is not None:
+            self.paths = tuple(paths)
+            self._path_counts = {}
+        if interval_ms is not None:
+            self.interval = interval_ms / 1000
+        if enabled and self._thread is None:
+            self._closing = False
+            self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+            self._thread.start()
+        self.enabled = enabled
+
+    def status(self):
+        return {"enabled": self.enabled, "threshold_ms": self.threshold_ms, "sample_every": self.sample_every,
+                "paths": list(self.paths), "interval_ms": self.interval * 1000, "active": len(self._active),
+                **self.counters}
+
+    def _select(self, path: str):
+        """返回 (是否采样, 是否按 sample_every 抽中)"""
+        if self.paths:
+            prefix = next((prefix for prefix in self.paths if path.startswith(prefix)), None)
+            if prefix is None:
+                return False, False
+        else:
+            prefix = ''
+        forced = False
+        if self.sample_every:
+            count = self._path_counts.get(prefix, 0) + 1
+            self._path_counts[prefix] = count
+            forced = count % self.sample_every == 0
+        return forced or self.threshold_ms is not None, forced
+
+    def begin(self, scope, coro) -> Optional[RequestProfile]:
+        """请求开始时在事件循环线程中调用, 不需要采样时返回 None"""
+        selected, forced = self._select(scope['path'])
+        if not selected:
+            return None
+        if len(self._active) >= self.max_active:
+            self.counters["skipped"] += 1
+            return None
+        profile = RequestProfile(next(self._ids), scope, coro, forced)
+        with self._lock:
+            self._active[profile.id] = profile
+        self.counters["profiled"] += 1
+        self._wakeup.set()
+        return profile
+
+    def end(self, profile: RequestProfile, scope, status: int):
+        elapsed_ms = (time.perf_counter() - profile.begin) * 1000
+        with self._lock:
+            self._active.pop(profile.id, None)
+            samples = profile.samples
+        profile.coro = profile.root = None
+        if not profile.forced and (self.threshold_ms is None or elapsed_ms < self.threshold_ms):
+            self.counters["discarded"] += 1
+            return
+        self.counters["kept"] += 1
+        self._profiles.append({"id": profile.id, "method": profile.method, "path": profile.path,
+                               "route": route_template(scope), "status": status, "elapsed_ms": round(elapsed_ms, 2),
+                               "forced": profile.forced, "samples": sum(count for count, _ in samples.values()),
+                               "time": beijing_now().strftime('%Y-%m-%d %H:%M:%S'), "stacks": samples})
+
+    def profiles(self):
+        return [{key: value for key, value in entry.items() if key != 'stacks'} for entry in reversed(self._profiles)]
+
+    def get(self, profile_id: int):
+        return next((entry for entry in self._profiles if entry["id"] == profile_id), None)
+
+    def clear(self):
+        self._profiles.clear()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = (getattr(code, 'co_qualname', code.co_name),
+                                          os.path.basename(code.co_filename), code.co_firstlineno)
+        return label
+
+    def _stack(self, profile: RequestProfile, frames) -> tuple:
+        """从根帧到叶子的调用栈, 元素为 (函数名, 文件名, 行号)"""
+        root = profile.root
+        frame, running = frames.get(profile.thread_id), []
+        while frame is not None and len(running) < self.max_depth:
+            running.append(frame)
+            if frame is root:
+                return tuple(self._label(f.f_code) for f in reversed(running))
+            frame = frame.f_back
+        # 不在运行: 沿 await 链找到挂起的位置
+        stack, awaitable = [], profile.coro
+        while awaitable is not None and len(stack) < self.max_depth:
+            frame = getattr(awaitable, 'cr_frame', None) or getattr(awaitable, 'gi_frame', None)
+            if frame is None:
+                stack.append((f"<await {type(awaitable).__name__}>", '', 0))
+                break
+            stack.append(self._label(frame.f_code))
+            awaitable = getattr(awaitable, 'cr_await', None) or getattr(awaitable, 'gi_yieldfrom', None)
+        return tuple(stack)
+
+    def sample(self, elapsed: float):
+        frames = sys._current_frames()
+        with self._lock:
+            for profile in list(self._active.values()):
+                if profile.root is None:
+                    continue
+                stack = self._stack(profile, frames)
+                entry = profile.samples.get(stack)
+                if entry is None:
+                    profile.samples[stack] = [1, elapsed]
+                else:
+                    entry[0] += 1
+                    entry[1] += elapsed
+        self.counters["samples"] += 1
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self._closing:
+            if not self._active:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                last = time.perf_counter()
+                continue
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            # 事件循环长时间持有 GIL 时实际间隔会变长, 按实际间隔计权
+            self.sample(now - last)
+            last = now
+            self.counters["sampler_seconds"] += time.perf_counter() - now
+
+    def close(self):
+        self.enabled = False
+        self._closing = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    @staticmethod
+    def _frame_name(label) -> str:
+        name, filename, line = label
+        return f"{name} ({filename}:{line})" if filename else name
+
+    def export(self, entry, fmt: str = 'collapsed'):
+        """collapsed: 每行 "根;...;叶 样本数"; speedscope: https://www.speedscope.app 的 JSON 格式, 权重为毫秒"""
+        stacks = entry["stacks"]
+        if fmt == 'collapsed':
+            return ''.join(f"{';'.join(self._frame_name(label) for label in stack)} {count}\n"
+                           for stack, (count, _) in stacks.items())
+        frames, index = [], {}
+        samples, weights = [], []
+        for stack, (_, seconds) in stacks.items():
+            sample = []
+            for label in stack:
+                if label not in index:
+                    index[label] = len(frames)
+                    name, filename, line = label
+                    frames.append({"name": name, "file": filename, "line": line} if filename else {"name": name})
+                sample.append(index[label])
+            samples.append(sample)
+            weights.append(round(seconds * 1000, 3))
+        name = f"{entry['method']} {entry['path']} {entry['elapsed_ms']}ms #{entry['id']}"
+        return {"$schema": "https://www.speedscope.app/file-format-schema.json", "name": name,
+                "shared": {"frames": frames},
+                "profiles": [{"type": "sampled", "name": name, "unit": "milliseconds", "startValue": 0,
+                              "endValue": round(sum(weights), 3), "samples": samples, "weights": weights}]}
+
+
+class ProfilerMiddleware:
+    """纯 ASGI 中间件, 放在准入控制里层, 被拒绝的请求不采样"""
+
+    def __init__(self, app, profiler: SamplingProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.profiler.enabled:
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        coro = self.app(scope, receive, send_wrapper)
+        profile = self.profiler.begin(scope, coro)
+        if profile is None:
+            return await coro
+        try:
+            await coro
+        finally:
+            self.profiler.end(profile, scope, status)
+
+
+async def benchmark_profiler(requests=1000, rounds=5):
+    """关闭/开启(阈值模式)时的单请求耗时, 以及一个偶发慢请求的采样结果"""
+    import statistics
+    import httpx
+    from fastapi import FastAPI
+
+    app = FastAPI()
+    profiler = SamplingProfiler(threshold_ms=50)
+
+    def slow_query(n):
+        total = 0
+        for i in range(n):
+            total += i * i
+        return total
+
+    @app.get('/items/{item_id}')
+    async def item(item_id: int):
+        if item_id % 500 == 499:
+            slow_query(2_000_000)
+            await asyncio.to_thread(time.sleep, 0.05)
+        return {"id": item_id}
+
+    async def run() -> float:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=ProfilerMiddleware(app, profiler)),
+                                     base_url="http://bench") as client:
+            begin = time.perf_counter()
+            for i in range(requests):
+                await client.get(f'/items/{i % 499}')
+            return (time.perf_counter() - begin) / requests
+
+    await run()
+    disabled, enabled = [], []
+    for _ in range(rounds):
+        profiler.configure(False, threshold_ms=50)
+        disabled.append(await run())
+        profiler.configure(True, threshold_ms=50)
+        enabled.append(await run())
+    disabled, enabled = statistics.median(disabled), statistics.median(enabled)
+    print(f"关闭 {disabled * 1e6:.0f}us/请求, 开启 {enabled * 1e6:.0f}us/请求, 额外 {(enabled - disabled) * 1e6:.0f}us")
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=ProfilerMiddleware(app, profiler)),
+                                 base_url="http://bench") as client:
+        await client.get('/items/499')
+    profiler.close()
+    entry = profiler.get(profiler.profiles()[0]["id"])
+    print({key: value for key, value in entry.items() if key != 'stacks'})
+    for line in sorted(profiler.export(entry).splitlines(), key=lambda line: -int(line.rsplit(' ', 1)[1]))[:3]:
+        print('  ' + line[-160:])
+    print(profiler.status())
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark_profiler())
@@ -0,0 +1,360 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Optional, Sequence
+from fastapi_users.jwt import decode_jwt
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:  # 未安装 redis 时只能使用进程内限流
+    aioredis = None
+
+
+"""
+代码说明：
+请求准入控制，作为最外层 ASGI 中间件，在进入路由和数据库之前决定放行、限流(429)或拒绝(503)。
+1. 令牌桶限流: 按规则匹配路径前缀，分别按 IP 和用户限速；桶状态默认存放在进程内，多进程部署时换成 RedisBackend 共享。
+2. 全局并发上限: 同时处理的请求超过上限时短暂排队，排队也满时立即返回 503，不让积压拖慢已放行的请求。
+3. 优先通道: 超级用户的后台请求(Token 中带 su 声明，见 utils/usersManager.py)和支付回调使用预留的并发名额，
+   前台被打满时管理员仍可操作；注册是公开的，普通用户的 Token 不能使用预留名额。
+"""
+
+
+class TokenBucket:
+    """令牌桶限速: 每秒补充 rate 个令牌, 最多积攒 capacity 个"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """预占一个令牌, 返回需要等待的秒数, 0 表示立即可用"""
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def try_take(self, cost: float = 1) -> float:
+        """令牌足够时扣除并返回 0, 不够时不扣除, 返回还需等待的秒数"""
+        self._refill()
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+    async def acquire(self):
+        wait = self.take()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class MemoryBackend:
+    """进程内令牌桶, 最多保存 max_keys 个桶, 超出时淘汰最久未访问的"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    async def take(self, key: str, rate: float, capacity: int, cost: float = 1) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, capacity)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.try_take(cost)
+
+
+class RedisBackend:
+    """Redis 共享令牌桶, 多个进程或多台机器共用限额; 一次 Lua 脚本调用完成补充和扣除"""
+    SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate, capacity, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 't', 'u')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+redis.call('HSET', KEYS[1], 't', tokens, 'u', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='ratelimit:'):
+        if aioredis is None:
+            raise RuntimeError("RedisBackend 需要安装 redis: pip install redis")
+        self.client = aioredis.from_url(url)
+        self.prefix = prefix
+        self._script = self.client.register_script(self.SCRIPT)
+
+    async def take(self, key: str, rate: float, capacity: int, cost: float = 1) -> float:
+        return float(await self._script(keys=[self.prefix + key], args=[rate, capacity, cost]))
+
+
+class RateRule:
+    """限流规则: 路径以 prefix 开头的请求, 按 scope(ip/user) 分别计数, 每秒 rate 个, 突发 capacity 个
+       scope 为 user 时未登录的请求不受该规则限制。
+    """
+
+    def __init__(self, prefix: str, rate: float, capacity: int, scope='ip'):
+        self.prefix = prefix
+        self.rate = rate
+        self.capacity = capacity
+        self.scope = scope
+
+
+DEFAULT_RULES = (
+    RateRule('/auth/jwt/login', rate=5 / 60, capacity=10),
+    RateRule('/auth/jwt/forgot-password', rate=2 / 60, capacity=5),
+    RateRule('/auth/jwt/reset-password', rate=2 / 60, capacity=5),
+    RateRule('/auth/jwt/register', rate=2 / 60, capacity=5),
+    RateRule('/auth/jwt/request-verify-token', rate=2 / 60, capacity=5),
+    RateRule('/api/frontend/checkout', rate=1, capacity=10),
+    RateRule('/api/frontend/checkout', rate=1, capacity=10, scope='user'),
+    RateRule('/api/frontend/', rate=20, capacity=60),
+    RateRule('/api/frontend/', rate=20, capacity=60, scope='user'),
+)
+# 支付平台的回调不按 IP 限速, 并且和后台一样使用预留并发名额
+PRIORITY_PREFIXES = ('/api/frontend/payment_notify/',)
+
+
+class AdmissionController:
+    """准入控制
+       admit 方法对一个请求做限流和并发判断, 放行后必须调用 release。
+       max_concurrent 为同时处理的请求上限, 其中 reserved 个名额只给优先请求。
+       超过上限时最多 max_waiting 个请求排队等待 queue_timeout 秒, 其余直接拒绝。
+    """
+
+    def __init__(self, secret: str, rules: Sequence[RateRule] = DEFAULT_RULES, backend=None,
+                 max_concurrent=64, reserved=8, max_waiting=64, queue_timeout=0.5,
+                 trust_forwarded=False, audience=("fastapi-users:auth",)):
+        self.secret = secret
+        self.rules = tuple(rules)
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.max_concurrent = max_concurrent
+        self.reserved = reserved
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self.trust_forwarded = trust_forwarded
+        self.audience = list(audience)
+        self.inflight = 0
+        self._waiters = OrderedDict()
+        self._tokens = OrderedDict()
+        self.counters = {"admitted": 0, "limited": 0, "shed": 0, "queued": 0, "backend_errors": 0}
+
+    def client_ip(self, scope) -> str:
+        if self.trust_forwarded:
+            for name, value in scope.get('headers', ()):
+                if name == b'x-forwarded-for':
+                    return value.decode('latin-1').split(',')[0].strip()
+        client = scope.get('client')
+        return client[0] if client else 'unknown'
+
+    def identify(self, scope) -> tuple:
+        """从 Bearer Token 中取出 (用户ID, 是否超级用户), 只验证签名和有效期, 不查数据库; 结果按 Token 缓存"""
+        for name, value in scope.get('headers', ()):
+            if name == b'authorization':
+                break
+        else:
+            return None, False
+        scheme, _, token = value.decode('latin-1').partition(' ')
+        if scheme.lower() != 'bearer' or not token:
+            return None, False
+        cached = self._tokens.get(token)
+        if cached is not None and cached[2] > time.time():
+            return cached[0], cached[1]
+        try:
+            payload = decode_jwt(token, self.secret, self.audience)
+        except Exception:
+            return None, False
+        superuser = payload.get('su') is True
+        self._tokens[token] = (payload.get('sub'), superuser, payload.get('exp', time.time() + 60))
+        if len(self._tokens) > 10000:
+            self._tokens.popitem(last=False)
+        return payload.get('sub'), superuser
+
+    async def check_rate(self, path: str, ip: str, user: Optional[str]) -> float:
+        """依次检查匹配的规则, 返回需要等待的秒数, 0 表示未超限"""
+        for index, rule in enumerate(self.rules):
+            if not path.startswith(rule.prefix):
+                continue
+            identity = ip if rule.scope == 'ip' else user
+            if identity is None:
+                continue
+            try:
+                wait = await self.backend.take(f"{index}:{identity}", rule.rate, rule.capacity)
+            except Exception as e:
+                # 共享后端不可用时放行, 由并发上限兜底
+                self.counters["backend_errors"] += 1
+                print(f"限流后端异常: {e!r}")
+                continue
+            if wait > 0:
+                return wait
+        return 0
+
+    def _has_slot(self, priority: bool) -> bool:
+        limit = self.max_concurrent if priority else self.max_concurrent - self.reserved
+        return self.inflight < limit
+
+    async def acquire_slot(self, priority: bool) -> bool:
+        """占用一个并发名额, 排队超时或排队已满时返回 False"""
+        # 优先请求不排在普通请求后面, 普通请求不插队
+        if self._has_slot(priority) and (priority or not self._waiters):
+            self.inflight += 1
+            return True
+        if len(self._waiters) >= self.max_waiting or self.queue_timeout <= 0:
+            return False
+        self.counters["queued"] += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[waiter] = priority
+        admitted = False
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+            admitted = True
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters.pop(waiter, None)
+            if not admitted:
+                if waiter.done() and not waiter.cancelled():
+                    # 超时或请求被取消(如客户端断开)的同时被唤醒, 名额已经转交过来, 必须归还
+                    self.release()
+                else:
+                    waiter.cancel()
+
+    def release(self):
+        """归还并发名额, 按排队顺序唤醒等待者, 优先请求可以使用预留名额"""
+        self.inflight -= 1
+        for waiter, priority in list(self._waiters.items()):
+            if waiter.done():
+                self._waiters.pop(waiter, None)
+                continue
+            if self._has_slot(priority):
+                self.inflight += 1
+                self._waiters.pop(waiter, None)
+                waiter.set_result(True)
+                if not self._has_slot(True):
+                    break
+
+    async def admit(self, scope):
+        """返回 (状态码, Retry-After 秒数); 状态码 None 表示放行"""
+        path = scope.get('path', '')
+        priority_path = path.startswith(PRIORITY_PREFIXES)
+        user, superuser = self.identify(scope)
+        priority = priority_path or (superuser and path.startswith('/api/backend/'))
+        if not priority_path:
+            wait = await self.check_rate(path, self.client_ip(scope), user)
+            if wait > 0:
+                self.counters["limited"] += 1
+                return 429, max(1, int(wait + 0.999))
+        if not await self.acquire_slot(priority):
+            self.counters["shed"] += 1
+            return 503, 1
+        self.counters["admitted"] += 1
+        return None, 0
+
+    def stats(self):
+        return {**self.counters, "inflight": self.inflight, "waiting": len(self._waiters)}
+
+
+REJECT_MESSAGES = {429: "请求过于频繁, 请稍后再试", 503: "服务繁忙, 请稍后再试"}
+
+
+class AdmissionMiddleware:
+    """纯 ASGI 中间件, 被拒绝的请求不会进入路由, 响应体格式与 ResponseModel 一致"""
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        status, retry_after = await self.controller.admit(scope)
+        if status is not None:
+            body = json.dumps({"code": status, "data": {}, "msg": REJECT_MESSAGES[status]}, ensure_ascii=False).encode()
+            await send({"type": "http.response.start", "status": status,
+                        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                                    (b"retry-after", str(retry_after).encode())]})
+            await send({"type": "http.response.body", "body": body})
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release()
+
+
+async def benchmark_overload(rate=600, duration=3, db_threads=4, work=0.02):
+    """模拟同步数据库调用的过载压测: 按固定速率发请求(约为处理能力的 3 倍),
+       比较有无准入控制时已放行请求的延迟, 以及过载时后台请求的延迟
+    """
+    import httpx
+    from concurrent.futures import ThreadPoolExecutor
+    from fastapi_users.jwt import generate_jwt
+
+    pool = ThreadPoolExecutor(max_workers=db_threads)
+
+    async def inner(scope, receive, send):
+        await asyncio.get_running_loop().run_in_executor(pool, time.sleep, work)
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    admin_token = generate_jwt({"sub": "admin", "aud": ["fastapi-users:auth"], "su": True}, "bench-secret-key-for-local-tests", 3600)
+
+    async def run(app, label):
+        transport = httpx.ASGITransport(app=app)
+        latencies, admin_latencies, statuses = [], [], {}
+
+        async def one(client, i):
+            admin = i % 20 == 0
+            headers = {"authorization": f"Bearer {admin_token}"} if admin else {}
+            path = '/api/backend/order_read' if admin else '/api/frontend/prod_read'
+            begin = time.perf_counter()
+            response = await client.get(path, headers=headers)
+            elapsed = time.perf_counter() - begin
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            if response.status_code == 200:
+                (admin_latencies if admin else latencies).append(elapsed)
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            begin = time.perf_counter()
+            tasks = []
+            for i in range(int(rate * duration)):
+                tasks.append(asyncio.create_task(one(client, i)))
+                # 开环发压: 按时间表发请求, 不等待前面的响应
+                delay = begin + (i + 1) / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - begin
+
+        def p99(values):
+            values = sorted(values)
+            return values[int(len(values) * 0.99)] * 1000 if values else float('nan')
+        print(f"{label}: 耗时 {elapsed:.2f}s, 状态码 {statuses}, 前台 p99 {p99(latencies):.0f}ms, 后台 p99 {p99(admin_latencies):.0f}ms")
+
+    print(f"处理能力约 {db_threads / work:.0f} 请求/秒, 发压 {rate} 请求/秒, 持续 {duration}s")
+    await run(inner, "无准入控制")
+    # 压测只有一个来源 IP, 这里只验证并发控制, 不启用限流规则
+    controller = AdmissionController("bench-secret-key-for-local-tests", rules=(), max_concurrent=db_threads * 2,
+                                     reserved=db_threads // 2, max_waiting=db_threads * 4, queue_timeout=0.1)
+    await run(AdmissionMiddleware(inner, controller), "准入控制")
+    print(controller.stats())
+    pool.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark_overload())
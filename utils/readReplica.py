@@ -0,0 +1,235 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+
+"""
+代码说明：
+读写分离，Database 在主库之外可以配置多个只读副本 (replica_urls)：
+1. read_* / search_* 查询方法(含仪表盘、订单搜索和导出)轮流从健康的副本读取，写操作和其它方法只用主库。
+2. 副本连接失败或查询时连接断开，会被标记为不可用 retry_after 秒，这次读取改从主库读；定时任务定期调用 check 检查副本，
+   PostgreSQL 副本的复制延迟超过 max_lag 秒时同样标记为不可用，恢复后自动重新使用。
+3. 读己之写：请求带上 X-Read-Your-Writes: 1 时整个请求都读主库；请求中通过 ORM 写入之后，同一请求余下的读取也改读主库。
+   primary_reads() 在代码块内强制读主库，用于写后立即读、不能容忍复制延迟的地方。
+4. 本地测试可以把 SQLite 主库复制一份作为副本 (copy_sqlite)，副本 URL 建议用只读方式打开:
+   sqlite:///file:database/replica.db?mode=ro&uri=true，文件丢失时连接失败，不会悄悄建出一个空库。
+"""
+
+_read_primary: ContextVar[bool] = ContextVar('read_primary', default=False)
+
+
+def pin_primary():
+    """当前请求(上下文)余下的读取都走主库"""
+    _read_primary.set(True)
+
+
+@contextmanager
+def primary_reads():
+    """代码块内的读取都走主库"""
+    token = _read_primary.set(True)
+    try:
+        yield
+    finally:
+        _read_primary.reset(token)
+
+
+class Replica:
+    __slots__ = ('url', 'engine', 'down_until', 'lag', 'reads', 'failures', 'last_error')
+
+    def __init__(self, url, engine):
+        self.url = url
+        self.engine = engine
+        self.down_until = 0.0
+        self.lag = None
+        self.reads = 0
+        self.failures = 0
+        self.last_error = None
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+
+class ReplicaSet:
+    """choose 方法轮流返回一个健康的副本, 没有可用副本或当前请求要求读主库时返回 None;
+       mark_down 方法把出错的副本暂停使用; check 方法检查全部副本的连通性和复制延迟, 由定时任务在每个进程中定期调用。
+    """
+
+    def __init__(self, replicas=(), retry_after=30, max_lag=5.0):
+        self.replicas = [Replica(url, engine) for url, engine in replicas]
+        self.retry_after = retry_after
+        self.max_lag = max_lag
+        self._cycle = itertools.cycle(self.replicas) if self.replicas else None
+        self._lock = threading.Lock()
+        self.counters = {"replica_reads": 0, "primary_reads": 0, "pinned_reads": 0, "fallbacks": 0}
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def choose(self):
+        if not self.replicas:
+            self.counters["primary_reads"] += 1
+            return None
+        if _read_primary.get():
+            self.counters["pinned_reads"] += 1
+            return None
+        with self._lock:
+            for _ in range(len(self.replicas)):
+                replica = next(self._cycle)
+                if replica.healthy:
+                    replica.reads += 1
+                    self.counters["replica_reads"] += 1
+                    return replica
+        self.counters["fallbacks"] += 1
+        return None
+
+    def mark_down(self, replica: Replica, error):
+        replica.down_until = time.monotonic() + self.retry_after
+        replica.failures += 1
+        replica.last_error = repr(error)[:200]
+        print(f"只读副本 {replica.engine.url.render_as_string(hide_password=True)} 不可用 {self.retry_after} 秒: {replica.last_error}")
+
+    def _probe(self, replica: Replica):
+        """连通性和复制延迟(秒); SQLite 副本另外确认不是空库"""
+        with replica.engine.connect() as conn:
+            dialect = conn.dialect.name
+            if dialect == 'postgresql':
+                return conn.execute(text("SELECT coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0) "
+                                         "WHERE pg_is_in_recovery() UNION ALL SELECT 0 LIMIT 1")).scalar()
+            if dialect == 'sqlite' and not conn.execute(text("SELECT count(*) FROM sqlite_master")).scalar():
+                raise RuntimeError("副本中没有任何表")
+            conn.execute(text("SELECT 1"))
+            return 0.0
+
+    def check(self) -> int:
+        """检查全部副本, 返回健康的副本数"""
+        healthy = 0
+        for replica in self.replicas:
+            try:
+                replica.lag = float(self._probe(replica))
+            except Exception as e:
+                self.mark_down(replica, e)
+                continue
+            if replica.lag > self.max_lag:
+                self.mark_down(replica, RuntimeError(f"复制延迟 {replica.lag:.1f} 秒"))
+                continue
+            replica.down_until = 0.0
+            healthy += 1
+        return healthy
+
+    def stats(self):
+        return {**self.counters,
+                "replicas": [{"url": replica.engine.url.render_as_string(hide_password=True), "healthy": replica.healthy,
+                              "lag": replica.lag, "reads": replica.reads, "failures": replica.failures,
+                              "last_error": replica.last_error} for replica in self.replicas]}
+
+
+def is_disconnect(error) -> bool:
+    """连接失败或连接断开, 而不是 SQL 本身的错误"""
+    return isinstance(error, DBAPIError) and (error.connection_invalidated or error.__class__.__name__ == 'OperationalError')
+
+
+class ReadYourWritesMiddleware:
+    """纯 ASGI 中间件, 请求头 X-Read-Your-Writes: 1 时该请求的读取都走主库; 每个请求开始时复位, 不会带到下一个请求"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        pinned = dict(scope['headers']).get(b'x-read-your-writes', b'').strip() in (b'1', b'true')
+        token = _read_primary.set(pinned)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _read_primary.reset(token)
+
+
+def copy_sqlite(source_path: str, replica_path: str):
+    """本地测试用: 用 SQLite 在线备份把主库完整复制到 replica_path, 复制期间主库照常读写"""
+    import sqlite3
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(replica_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+def benchmark_replicas(rows=200_000):
+    """SQLite 主库加一个复制出来的副本: 仪表盘读副本时主库上的写入耗时; 读己之写和副本失效时回退主库"""
+    import os
+    import tempfile
+    from datetime import timedelta
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy import insert, select, func
+    from utils.databaseManager import Database, Order, ProdInfo, beijing_now
+    from utils.databaseSchemas import ProdInfoResponse, OrderResponse
+    from utils.usersManager import User
+
+    folder = tempfile.mkdtemp()
+    primary_path, replica_path = os.path.join(folder, "primary.db"), os.path.join(folder, "replica.db")
+    db = Database(f'sqlite:///{primary_path}', echo=False)
+    db.create_tables()
+    User.__table__.create(db.engine)
+    now = beijing_now()
+    with db.engine.begin() as conn:
+        for offset in range(0, rows, 50000):
+            conn.execute(insert(Order), [
+                {"out_order_id": f"BENCH{i:012d}", "state": 'delivered', "status": True, "name": f"商品{i % 50}",
+                 "payment": "alipay", "num": 1, "price": 1, "total_price": 1, "contact": "-",
+                 "updatetime": now - timedelta(minutes=i)} for i in range(offset, min(rows, offset + 50000))])
+    db.engine.dispose()
+    copy_sqlite(primary_path, replica_path)
+
+    def write_latency(database, readers=4, writes=300):
+        """readers 个线程不停读仪表盘的同时, 主库逐条写入 writes 次的平均耗时"""
+        stop = threading.Event()
+
+        def read_loop():
+            while not stop.is_set():
+                database.search_dashboard()
+        with ThreadPoolExecutor(max_workers=readers) as executor:
+            for _ in range(readers):
+                executor.submit(read_loop)
+            begin = time.perf_counter()
+            for i in range(writes):
+                database.create_data(ProdInfo(name=f"写入{time.monotonic_ns()}-{i}", prod_price=1, state=True))
+            elapsed = (time.perf_counter() - begin) / writes
+            stop.set()
+        return elapsed * 1000
+
+    print(f"仪表盘读主库时, 主库写入平均 {write_latency(db):.2f}ms")
+    split = Database(f'sqlite:///{primary_path}', echo=False,
+                     replica_urls=[f'sqlite:///file:{replica_path}?mode=ro&uri=true'])
+    print(f"仪表盘读副本时, 主库写入平均 {write_latency(split):.2f}ms, {split.replicas.counters}")
+
+    # 读己之写: 副本是复制时的快照, 新写入只在主库
+    split.create_data(ProdInfo(name='刚写入的商品', prod_price=1, state=True))
+    fresh = [ProdInfo.name == '刚写入的商品']
+    with primary_reads():
+        print(f"primary_reads 内读到新写入: {split.search_filter(ProdInfo, ProdInfoResponse, fresh)}")
+
+    def in_new_context(fn):
+        # 新的上下文, 模拟另一个请求: 上面 create_data 的读己之写标记不带过来
+        import contextvars
+        return contextvars.Context().run(fn)
+    print(f"另一个请求读副本: {in_new_context(lambda: split.search_filter(ProdInfo, ProdInfoResponse, fresh))}")
+
+    # 副本失效: 删掉副本文件, 只读方式打不开, 回退主库
+    split.replicas.replicas[0].engine.dispose()
+    os.remove(replica_path)
+    with split.engine.connect() as conn:
+        expected = conn.execute(select(func.count(Order.id))).scalar()
+    got = in_new_context(lambda: split.read_datas(Order, OrderResponse, limit=1)['pager']['total'])
+    print(f"副本失效后读取回退主库: 订单数 {got} (主库 {expected}), 健康副本 {split.replicas.check()}, {split.replicas.stats()}")
+
+
+if __name__ == '__main__':
+    benchmark_replicas()
@@ -0,0 +1,232 @@
+import asyncio
+import functools
+import json
+import time
+from collections import OrderedDict
+from typing import Optional, Sequence
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse, Response
+from utils.databaseSchemas import ResponseModel
+from utils.metrics import registry as metrics_registry
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:  # 未安装 redis 时只能使用进程内缓存
+    aioredis = None
+
+
+"""
+代码说明：
+后台读接口的响应缓存，以装饰器的形式加在接口函数上，位于登录校验之后，缓存不会绕过权限检查。
+1. 缓存键为接口函数名加全部查询参数，缓存内容为编码好的 JSON 字节，命中时直接返回，不再查询数据库和序列化。
+2. 失效按标签进行: 每个标签有一个版本号，写接口调用 invalidate 把相关标签的版本号加一；
+   缓存条目记录写入时各标签的版本号，读取时版本号不一致即视为失效。查询前先取版本号，查询期间发生的修改不会被缓存下来。
+3. 默认进程内 LRU，条目数、总字节数和 TTL 都有上限；多进程部署时换成 RedisCacheBackend，各进程共享缓存和版本号。
+4. 只缓存 code 为 200 的响应；缓存后端出错时直接查询数据库，不影响接口本身。
+"""
+
+RESULT_LABELS = {"hits": "hit", "misses": "miss", "errors": "error"}
+
+
+class MemoryCacheBackend:
+    """进程内 LRU 缓存, 最多 max_entries 条、max_bytes 字节, 超出时淘汰最久未访问的"""
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (过期时间, 标签版本号, 响应体)
+        self._versions = {}
+        self._bytes = 0
+        self.evictions = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[2])
+
+    async def versions(self, tags: Sequence[str]) -> tuple:
+        return tuple(self._versions.get(tag, 0) for tag in tags)
+
+    async def get(self, key: str, tags: Sequence[str]) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, versions, body = entry
+        if expires < time.monotonic() or versions != await self.versions(tags):
+            self._pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return body
+
+    async def set(self, key: str, body: bytes, tags: Sequence[str], versions: tuple, ttl: float):
+        if len(body) > self.max_bytes:
+            return
+        self._pop(key)
+        self._entries[key] = (time.monotonic() + ttl, versions, body)
+        self._bytes += len(body)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._pop(next(iter(self._entries)))
+            self.evictions += 1
+
+    async def bump(self, tags: Sequence[str]):
+        for tag in tags:
+            self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self._bytes, "evictions": self.evictions}
+
+
+class RedisCacheBackend:
+    """Redis 共享缓存, 版本号用 INCR 维护; 条目格式为 "版本号,版本号\\n响应体", 内存上限由 Redis 的 maxmemory 策略负责"""
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='respcache:'):
+        if aioredis is None:
+            raise RuntimeError("RedisCacheBackend 需要安装 redis: pip install redis")
+        self.client = aioredis.from_url(url)
+        self.prefix = prefix
+
+    def _tag_keys(self, tags):
+        return [f"{self.prefix}tag:{tag}" for tag in tags]
+
+    async def versions(self, tags: Sequence[str]) -> tuple:
+        if not tags:
+            return ()
+        return tuple(int(value or 0) for value in await self.client.mget(self._tag_keys(tags)))
+
+    async def get(self, key: str, tags: Sequence[str]) -> Optional[bytes]:
+        # 条目和版本号在一次往返内取回
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.get(self.prefix + key)
+            if tags:
+                pipe.mget(self._tag_keys(tags))
+            results = await pipe.execute()
+        raw = results[0]
+        if raw is None:
+            return None
+        header, body = raw.split(b'\n', 1)
+        current = ','.join(str(int(value or 0)) for value in results[1]) if tags else ''
+        return body if header.decode() == current else None
+
+    async def set(self, key: str, body: bytes, tags: Sequence[str], versions: tuple, ttl: float):
+        header = ','.join(str(version) for version in versions).encode()
+        await self.client.set(self.prefix + key, header + b'\n' + body, ex=max(1, int(ttl)))
+
+    async def bump(self, tags: Sequence[str]):
+        async with self.client.pipeline(transaction=False) as pipe:
+            for tag_key in self._tag_keys(tags):
+                pipe.incr(tag_key)
+            await pipe.execute()
+
+    def stats(self):
+        return {}
+
+
+class ResponseCache:
+    """cached 装饰器缓存接口的响应, invalidate 方法在写接口中按标签清除缓存, stats 方法返回命中率等计数"""
+
+    def __init__(self, backend=None, ttl=60, metrics=metrics_registry):
+        self.backend = backend or MemoryCacheBackend()
+        self.ttl = ttl
+        self.metrics = metrics
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "invalidations": 0, "errors": 0}
+
+    def _count(self, route: str, result: str):
+        self.counters[result] += 1
+        self.metrics.response_cache.inc((route, RESULT_LABELS[result]))
+
+    def cached(self, *tags: str, ttl: Optional[float] = None):
+        """缓存 async 接口函数的 ResponseModel 返回值; 接口参数必须都是可 JSON 序列化的查询参数"""
+        ttl = self.ttl if ttl is None else ttl
+
+        def decorator(func):
+            route = func.__name__
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                key = f"{route}:{json.dumps(kwargs, sort_keys=True, default=str, ensure_ascii=False)}"
+                versions = None
+                try:
+                    body = await self.backend.get(key, tags)
+                    if body is not None:
+                        self._count(route, "hits")
+                        return Response(body, media_type="application/json", headers={"x-cache": "hit"})
+                    versions = await self.backend.versions(tags)
+                except Exception as e:
+                    self._count(route, "errors")
+                    print(f"响应缓存读取失败: {e!r}")
+                self._count(route, "misses")
+                result = await func(*args, **kwargs)
+                if versions is None or not isinstance(result, ResponseModel) or result.code != 200:
+                    return result
+                response = JSONResponse(jsonable_encoder(result), headers={"x-cache": "miss"})
+                try:
+                    await self.backend.set(key, response.body, tags, versions, ttl)
+                    self.counters["stores"] += 1
+                except Exception as e:
+                    self._count(route, "errors")
+                    print(f"响应缓存写入失败: {e!r}")
+                return response
+            return wrapper
+        return decorator
+
+    async def invalidate(self, *tags: str):
+        """写接口修改数据后调用, 使带有这些标签的缓存全部失效"""
+        try:
+            await self.backend.bump(tags)
+            self.counters["invalidations"] += 1
+        except Exception as e:
+            self.counters["errors"] += 1
+            print(f"响应缓存失效失败: {e!r}")
+
+    def stats(self):
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {**self.counters, "hit_rate": round(self.counters["hits"] / lookups, 4) if lookups else 0.0,
+                **self.backend.stats()}
+
+
+async def benchmark_cache(requests=2000, rows=200):
+    """后台分类列表接口有无缓存时的单请求耗时, 以及修改后缓存是否立即失效"""
+    import os
+    import tempfile
+    import httpx
+    from fastapi import FastAPI
+    from utils.databaseManager import Database, ProdCag
+    from utils.databaseSchemas import ProdCagResponse
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    db = Database(f'sqlite:///{path}', echo=False)
+    db.create_tables()
+    db.create_batch_data([ProdCag(name=f"分类{i}", sort=i, state=True) for i in range(rows)])
+    cache = ResponseCache()
+    app = FastAPI()
+
+    @app.get('/plain')
+    async def plain(skip: int = 0, limit: int = 100):
+        return ResponseModel(code=200, data=db.read_datas(ProdCag, ProdCagResponse, skip, limit), msg="分类查询成功")
+
+    @app.get('/cached')
+    @cache.cached('class')
+    async def cached(skip: int = 0, limit: int = 100):
+        return ResponseModel(code=200, data=db.read_datas(ProdCag, ProdCagResponse, skip, limit), msg="分类查询成功")
+
+    @app.patch('/rename')
+    async def rename(item_id: int, name: str):
+        db.update_data(ProdCag, {"id": item_id, "name": name})
+        await cache.invalidate('class')
+        return ResponseModel(code=200, data={}, msg="分类修改成功")
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for name in ('plain', 'cached'):
+            begin = time.perf_counter()
+            for i in range(requests):
+                await client.get(f'/{name}', params={"skip": (i % 4) * 10})
+            print(f"{name}: {(time.perf_counter() - begin) / requests * 1e6:.0f}us/请求")
+        assert (await client.get('/plain')).json() == (await client.get('/cached')).json()
+        await client.patch('/rename', params={"item_id": 1, "name": "改名后"})
+        response = await client.get('/cached')
+        print(f"修改后: x-cache={response.headers['x-cache']}, 第一条={response.json()['data']['records'][0]['name']}")
+    print(cache.stats())
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark_cache())
@@ -0,0 +1,229 @@
+import json
+import threading
+import time
+from collections import Counter
+from sqlalchemy import select, update, func, bindparam
+from utils.databaseManager import Config, Order, OrderRollup, ProdInfo
+
+
+"""
+代码说明：
+商品销量 prod_sales 的自动统计，销量为成交(已支付)订单数，和仪表盘热销榜的口径一致。
+1. 订单表的 sales_counted 标记订单是否已计入销量，新订单为 0。定时任务每 5 秒 flush 一次：在一个事务里取出已支付、未计入的订单，
+   条件 UPDATE 把它们标记为已计入(影响行数不符说明别的进程同时在写，整批回滚下次再来)，再按商品用一条 executemany UPDATE 加到 prod_sales。
+   标记和累加在同一个事务里，支付时不写 prod_sales，也不在进程内存里保存增量，进程退出不会丢失，多进程也不会重复计入。
+2. reconcile 在一个事务里按订单表中已计入的已支付订单和已归档订单的汇总(OrderRollup)重算全部商品的销量，只改写不一致的商品；
+   还没有计入的订单由之后的 flush 加上，不会和重算的结果重复。先锁住商品表(SQLite 为 BEGIN IMMEDIATE)再统计，
+   进行中的 flush 要么整个在统计之前提交，要么等重算提交后再累加。sales_counted 为空的旧订单视为已计入，只由重算统计。
+   定时任务在启动时和之后每小时执行一次，修正手工修改订单状态等造成的偏差；flush 和 reconcile 只在主节点进程执行，不会同时执行。
+3. 综合设置 other_optional.sales_statistics 为 1 时自动统计；为 0 时销量仅限手工修改，flush/reconcile 都不写入。
+   flush 每次重新读取设置，在任一进程修改设置后主节点随即生效。
+4. 自动统计时，前台直接读 prod_sales，仪表盘热销榜走 prod_sales 索引取前 N 个，不再对订单表做 GROUP BY。
+"""
+
+
+def load_sales_statistics(db) -> bool:
+    """读取综合设置中的 sales_statistics, 没有设置或设置不是有效的 JSON 时默认自动统计;
+       旧版本保存的 Python 字面量由数据库迁移 14 转换为 JSON
+    """
+    with db.engine.connect() as conn:
+        info = conn.execute(select(Config.info).where(Config.name == 'other_optional')).scalar()
+    if not info:
+        return True
+    try:
+        options = json.loads(info)
+    except ValueError:
+        return True
+    return str(options.get('sales_statistics', 1)) == '1'
+
+
+class SalesCounter:
+    """flush 方法把新支付的订单计入 prod_sales, reconcile 方法按订单重算全部商品的销量, top 方法返回销量前 n 的商品。"""
+
+    def __init__(self, db, enabled=True, batch_size=5000):
+        self.db = db
+        self.enabled = enabled
+        self.batch_size = batch_size  # flush 每个事务最多计入的订单数
+        self._write_lock = threading.Lock()  # flush 和 reconcile 依次执行
+        self.counters = {"flushes": 0, "flushed_orders": 0, "flush_conflicts": 0, "reconciles": 0, "corrected": 0,
+                         "last_reconcile": None}
+
+    def configure(self, enabled: bool):
+        """切换自动统计; 关闭期间支付的订单保持未计入, 重新打开后 reconcile 和 flush 会把它们补上"""
+        self.enabled = enabled
+
+    def flush(self) -> int:
+        """把已支付、未计入的订单计入 prod_sales, 返回计入的订单数"""
+        self.enabled = load_sales_statistics(self.db)
+        if not self.enabled:
+            return 0
+        with self._write_lock:
+            flushed = 0
+            while True:
+                count = self._flush()
+                flushed += count
+                if count < self.batch_size:
+                    return flushed
+
+    def _flush(self) -> int:
+        table = ProdInfo.__table__
+        with self.db.engine.connect() as conn:
+            rows = conn.execute(select(Order.id, Order.name).where(Order.status == True, Order.sales_counted == False)
+                                .order_by(Order.id).limit(self.batch_size)).all()
+            if not rows:
+                return 0
+            ids = [order_id for order_id, _ in rows]
+            marked = conn.execute(update(Order).where(Order.id.in_(ids), Order.sales_counted == False)
+                                  .values(sales_counted=True)).rowcount
+            if marked != len(ids):
+                conn.rollback()
+                self.counters["flush_conflicts"] += 1
+                return 0
+            counts = Counter(name for _, name in rows)
+            conn.execute(update(table).where(table.c.name == bindparam('b_name'))
+                         .values(prod_sales=func.coalesce(table.c.prod_sales, 0) + bindparam('b_count')),
+                         [{"b_name": name, "b_count": count} for name, count in counts.items()])
+            conn.commit()
+        self.counters["flushes"] += 1
+        self.counters["flushed_orders"] += len(ids)
+        return len(ids)
+
+    def reconcile(self) -> int:
+        """按订单表和归档汇总重算全部商品的销量, 返回改正的商品数"""
+        if not self.enabled:
+            return 0
+        with self._write_lock:
+            return self._reconcile()
+
+    def _reconcile(self) -> int:
+        table = ProdInfo.__table__
+        with self.db.engine.begin() as conn:
+            # 先锁商品表再统计: 统计之后提交的 flush 只能在重算提交后累加
+            if conn.dialect.name == 'sqlite':
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+                current = conn.execute(select(table.c.name, table.c.prod_sales)).all()
+            else:
+                current = conn.execute(select(table.c.name, table.c.prod_sales).with_for_update()).all()
+            sales = dict(conn.execute(select(OrderRollup.name, func.sum(OrderRollup.paid_orders))
+                                      .group_by(OrderRollup.name)).all())
+            for name, count in conn.execute(select(Order.name, func.count(Order.id))
+                                            .where(Order.status == True, Order.sales_counted.isnot(False))
+                                            .group_by(Order.name)):
+                sales[name] = sales.get(name, 0) + count
+            changes = [{"b_name": name, "b_sales": sales.get(name, 0)} for name, value in current
+                       if value != sales.get(name, 0)]
+            if changes:
+                conn.execute(update(table).where(table.c.name == bindparam('b_name'))
+                             .values(prod_sales=bindparam('b_sales')), changes)
+        self.counters["reconciles"] += 1
+        self.counters["corrected"] += len(changes)
+        self.counters["last_reconcile"] = time.strftime('%Y-%m-%d %H:%M:%S')
+        return len(changes)
+
+    def top(self, n=5) -> dict:
+        """销量前 n 的商品 {名称: 销量}, 沿 prod_sales 索引倒序读取 n 行"""
+        with self.db.engine.connect() as conn:
+            rows = conn.execute(select(ProdInfo.name, ProdInfo.prod_sales).where(ProdInfo.prod_sales > 0)
+                                .order_by(ProdInfo.prod_sales.desc()).limit(n)).all()
+        return {name: sales for name, sales in rows}
+
+    def stats(self):
+        return {**self.counters, "enabled": self.enabled}
+
+
+def benchmark_sales(rows=300_000, products=200, payments=20_000):
+    """rows 条订单上: 热销榜 GROUP BY 和读 prod_sales 索引的耗时对比; 逐单 UPDATE 和定时批量计入的耗时对比;
+       两个进程同时 flush、期间穿插 reconcile 时销量是否仍和订单表一致
+    """
+    import os
+    import tempfile
+    from datetime import timedelta
+    from concurrent.futures import ThreadPoolExecutor
+    from sqlalchemy import insert
+    from utils.databaseManager import Database, beijing_now
+
+    db = Database(f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}', echo=False)
+    db.create_tables()
+    now = beijing_now()
+    with db.engine.begin() as conn:
+        conn.execute(insert(ProdInfo), [{"name": f"商品{i}", "prod_price": 1, "state": True, "prod_sales": 0}
+                                        for i in range(products)])
+        for offset in range(0, rows, 50000):
+            conn.execute(insert(Order), [
+                {"out_order_id": f"BENCH{i:012d}", "state": 'delivered', "status": i % 10 != 0,
+                 "name": f"商品{(i * i) % products}", "payment": "alipay", "num": 1, "price": 1, "total_price": 1,
+                 "contact": "-", "updatetime": now - timedelta(seconds=i), "sales_counted": None}
+                for i in range(offset, min(rows, offset + 50000))])
+    counter = SalesCounter(db)
+    begin = time.perf_counter()
+    counter.reconcile()
+    print(f"首次校对 {products} 个商品: {time.perf_counter() - begin:.2f}s")
+
+    def timed(fn, repeat=20):
+        begin = time.perf_counter()
+        for _ in range(repeat):
+            result = fn()
+        return (time.perf_counter() - begin) / repeat * 1000, result
+
+    def group_by_top():
+        with db.engine.connect() as conn:
+            rows_ = conn.execute(select(Order.name, func.count(Order.id)).where(Order.status == True)
+                                 .group_by(Order.name)).all()
+        return dict(sorted(rows_, key=lambda item: item[1], reverse=True)[:5])
+    grouped_ms, grouped = timed(group_by_top)
+    indexed_ms, indexed = timed(counter.top)
+    # 销量相同的商品先后顺序不定, 比较排名上的销量
+    print(f"热销榜: GROUP BY {grouped_ms:.1f}ms, prod_sales 索引 {indexed_ms:.3f}ms, "
+          f"结果一致: {list(grouped.values()) == list(indexed.values())}")
+
+    names = [f"商品{(i * 7) % products}" for i in range(payments)]
+    begin = time.perf_counter()
+    for name in names:
+        with db.engine.begin() as conn:
+            conn.execute(update(ProdInfo).where(ProdInfo.name == name).values(prod_sales=ProdInfo.prod_sales + 1))
+    per_order = time.perf_counter() - begin
+
+    def pay(start, count):
+        with db.engine.begin() as conn:
+            conn.execute(insert(Order), [
+                {"out_order_id": f"PAID{start + i:012d}", "state": 'paid', "status": True, "name": names[start + i],
+                 "payment": "alipay", "num": 1, "price": 1, "total_price": 1, "contact": "-", "updatetime": now}
+                for i in range(count)])
+    batched = 0.0
+    for start in range(0, payments, 2000):  # 约等于每 5 秒计入一次
+        pay(start, min(2000, payments - start))
+        begin = time.perf_counter()
+        counter.flush()
+        batched += time.perf_counter() - begin
+    print(f"{payments} 次支付的销量更新: 逐单 UPDATE {per_order:.2f}s, 定时批量计入 {batched:.3f}s")
+    # 逐单 UPDATE 多加了一遍, 校对后应当改回和订单表一致
+    print(f"校对改正 {counter.reconcile()} 个商品, 之后热销榜与 GROUP BY 一致: "
+          f"{list(counter.top().values()) == list(group_by_top().values())}")
+
+    # 主节点切换时两个进程可能同时 flush; 期间还有新的支付和 reconcile
+    other = SalesCounter(db)
+
+    def keep_flushing(worker):
+        for _ in range(20):
+            try:
+                worker.flush()
+            except Exception:  # SQLite 写锁冲突, 下次再来
+                pass
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(keep_flushing, counter), executor.submit(keep_flushing, other)]
+        for start in range(payments, payments + 2000, 200):
+            names.extend(f"商品{(i * 7) % products}" for i in range(start, start + 200))
+            pay(start, 200)
+        executor.submit(counter.reconcile).result()
+        for future in futures:
+            future.result()
+    counter.flush()
+    with db.engine.connect() as conn:
+        total = conn.execute(select(func.sum(ProdInfo.prod_sales))).scalar()
+        paid = conn.execute(select(func.count(Order.id)).where(Order.status == True)).scalar()
+    print(f"并发 flush 后销量合计 {total}, 已支付订单 {paid}, 一致: {total == paid}")
+    print(counter.stats(), other.stats())
+
+
+if __name__ == '__main__':
+    benchmark_sales()
@@ -0,0 +1,400 @@
+import asyncio
+import os
+import random
+import socket
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+from sqlalchemy import update, insert, or_
+from sqlalchemy.exc import IntegrityError
+from utils.databaseManager import SchedulerLease, beijing_now
+
+
+"""
+代码说明：
+进程内的定时任务调度器，随应用生命周期启动和停止，过期订单清理、归档、日志保留期清理、WAL checkpoint 等维护任务都在这里注册。
+1. add 注册任务：interval 为间隔秒数，或 cron 为五段 cron 表达式(分 时 日 月 周，北京时间)；jitter 让每次运行随机推迟 0~jitter 秒，
+   多个进程、多个任务不会在同一时刻一起打到数据库；timeout 秒后还没结束记为超时。
+2. 同步函数在调度器自己的线程池中执行，不占用事件循环，也不占用请求处理用的默认线程池；同一个任务不会重叠执行，
+   上一次还没结束时跳过这一次。线程中的函数超时后无法中断，结束之前该任务不会再次开始；协程函数超时后被取消。
+3. 多个 worker 进程共用一个数据库时，leader_only 的任务只在持有 scheduler_lease 租约的进程中执行：租约每 lease/3 秒续期一次，
+   主节点退出时主动放弃，崩溃或卡住超过 lease 秒后由其它进程接手。只涉及本进程内存的任务(销量增量写入、只读副本检查)
+   用 leader_only=False，每个进程都执行。租约到期时间按各进程的本机时钟比较，多台主机部署时需要同步时钟。
+4. stats 返回是否为主节点，以及每个任务的上次开始时间、耗时、结果或错误、下次运行时间，由 /api/backend/scheduler_status 查看。
+"""
+
+
+class CronSchedule:
+    """五段 cron 表达式: 分 时 日 月 周(0 和 7 都是周日), 每段支持 *、a、a-b、a,b、*/n、a-b/n;
+       日和周都有限定时满足其一即可, 与 cron 相同。next_after 方法返回给定时间之后的下一个时刻。
+    """
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"cron 表达式应为 5 段: {expression!r}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(part, low, high) for part, (low, high) in zip(parts, self.FIELDS))
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day, self.any_weekday = parts[2] == '*', parts[4] == '*'
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> set:
+        values = set()
+        for item in field.split(','):
+            spec, _, step = item.partition('/')
+            if spec == '*':
+                start, end = low, high
+            elif '-' in spec:
+                start, end = map(int, spec.split('-', 1))
+            else:
+                start = int(spec)
+                end = high if step else start
+            step = int(step) if step else 1
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(f"cron 字段超出范围 {low}-{high}: {item!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day, weekday = moment.day in self.days, moment.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, moment: datetime) -> datetime:
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = candidate + timedelta(days=366 * 5)
+        while candidate < limit:
+            if candidate.month not in self.months:
+                candidate = (candidate.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(candidate):
+                candidate = (candidate + timedelta(days=1)).replace(hour=0, minute=0)
+            elif candidate.hour not in self.hours:
+                candidate = (candidate + timedelta(hours=1)).replace(minute=0)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"cron 表达式没有可执行的时刻: {self.expression!r}")
+
+
+class Job:
+    __slots__ = ('name', 'fn', 'interval', 'cron', 'jitter', 'timeout', 'leader_only', 'run_at_start', 'next_run',
+                 'task', 'runs', 'failures', 'timeouts', 'skipped', 'last_start', 'last_seconds', 'last_result',
+                 'last_error')
+
+    def __init__(self, name, fn, interval=None, cron=None, jitter=0.0, timeout=None, leader_only=True,
+                 run_at_start=False):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.cron = CronSchedule(cron) if cron else None
+        self.jitter = jitter
+        self.timeout = timeout
+        self.leader_only = leader_only
+        self.run_at_start = run_at_start
+        self.next_run = None
+        self.task = None
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.skipped = 0
+        self.last_start = None
+        self.last_seconds = None
+        self.last_result = None
+        self.last_error = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def schedule(self, now: datetime, first=False):
+        """计算下次运行时间, 加上随机推迟"""
+        if self.cron is not None:
+            base = self.cron.next_after(now)
+        else:
+            base = now + timedelta(seconds=0 if first and self.run_at_start else self.interval)
+        self.next_run = base + timedelta(seconds=random.uniform(0, self.jitter)) if self.jitter else base
+
+    def describe(self) -> str:
+        return f"cron {self.cron.expression}" if self.cron is not None else f"每 {self.interval} 秒"
+
+
+class LeaderLease:
+    """acquire 方法获取或续期租约, 返回当前进程是否为主节点; release 方法主动放弃租约, 其它进程不必等到过期"""
+
+    def __init__(self, db, name='scheduler', lease=30, announce=True):
+        self.db = db
+        self.name = name
+        self.lease = lease
+        self.announce = announce  # 成为或不再是主节点时打印
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.is_leader = False
+
+    def acquire(self) -> bool:
+        """自己持有或租约已过期时更新为自己, 没有租约行时插入; 两个进程同时争抢时只有一个 UPDATE/INSERT 成功"""
+        table = SchedulerLease.__table__
+        now = beijing_now()
+        values = {"owner": self.owner, "expires": now + timedelta(seconds=self.lease)}
+        with self.db.engine.begin() as conn:
+            taken = conn.execute(update(table).where(table.c.name == self.name,
+                                                     or_(table.c.owner == self.owner, table.c.expires < now))
+                                 .values(values)).rowcount
+        if not taken:
+            try:
+                with self.db.engine.begin() as conn:
+                    conn.execute(insert(table).values(name=self.name, **values))
+                taken = 1
+            except IntegrityError:
+                taken = 0
+        if bool(taken) != self.is_leader and self.announce:
+            print(f"定时任务: {self.owner} {'成为' if taken else '不再是'}主节点")
+        self.is_leader = bool(taken)
+        return self.is_leader
+
+    def release(self):
+        if not self.is_leader:
+            return
+        table = SchedulerLease.__table__
+        with self.db.engine.begin() as conn:
+            conn.execute(update(table).where(table.c.name == self.name, table.c.owner == self.owner)
+                         .values(expires=beijing_now() - timedelta(seconds=1)))
+        self.is_leader = False
+
+
+class Scheduler:
+    """add 方法注册任务; start / stop 方法启动和停止调度协程, stop 时等待正在执行的任务结束并放弃租约;
+       run_now 方法立即执行一次指定任务; stats 方法返回主节点状态和每个任务的运行情况。
+    """
+
+    def __init__(self, db, lease=30, workers=2):
+        self.leader = LeaderLease(db, lease=lease)
+        self.jobs = {}
+        self.workers = workers
+        self._executor = None
+        self._task = None
+
+    def add(self, name: str, fn: Callable, interval: Optional[float] = None, cron: Optional[str] = None,
+            jitter=0.0, timeout: Optional[float] = None, leader_only=True, run_at_start=False) -> Job:
+        """注册任务, interval 和 cron 二选一; run_at_start 为 True 的间隔任务启动后立即执行一次"""
+        if (interval is None) == (cron is None):
+            raise ValueError(f"定时任务 {name} 需要 interval 或 cron 其中之一")
+        job = Job(name, fn, interval, cron, jitter, timeout, leader_only, run_at_start)
+        self.jobs[name] = job
+        return job
+
+    async def _execute(self, job: Job):
+        job.last_start = beijing_now()
+        begin = time.perf_counter()
+        if asyncio.iscoroutinefunction(job.fn):
+            work = asyncio.ensure_future(job.fn())
+        else:
+            work = asyncio.get_running_loop().run_in_executor(self._executor, job.fn)
+        # 超时后线程仍在运行, 结束时取走结果或异常, 免得异常无人处理
+        work.add_done_callback(lambda future: future.cancelled() or future.exception())
+        job.task = work
+        try:
+            job.last_result = await asyncio.wait_for(asyncio.shield(work), job.timeout)
+            job.last_error = None
+        except asyncio.TimeoutError:
+            if asyncio.iscoroutinefunction(job.fn):
+                work.cancel()
+            job.timeouts += 1
+            job.last_error = f"超过 {job.timeout} 秒未完成"
+            print(f"定时任务 {job.name} 超时: {job.last_error}")
+        except Exception as e:
+            job.failures += 1
+            job.last_error = repr(e)[:200]
+            print(f"定时任务 {job.name} 失败: {e!r}")
+        finally:
+            job.runs += 1
+            job.last_seconds = round(time.perf_counter() - begin, 3)
+
+    async def run_now(self, name: str):
+        """立即执行一次, 不受主节点限制; 该任务正在执行时返回 False"""
+        job = self.jobs[name]
+        if job.running:
+            return False
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scheduler')
+        await self._execute(job)
+        return True
+
+    async def _run(self):
+        now = beijing_now()
+        for job in self.jobs.values():
+            job.schedule(now, first=True)
+        next_renew = 0.0
+        while True:
+            if time.monotonic() >= next_renew:
+                try:
+                    await asyncio.to_thread(self.leader.acquire)
+                except Exception as e:
+                    # 连不上数据库时不确定租约归属, 先不执行主节点任务
+                    self.leader.is_leader = False
+                    print(f"定时任务租约续期失败: {e!r}")
+                next_renew = time.monotonic() + self.leader.lease / 3
+            now = beijing_now()
+            for job in self.jobs.values():
+                if job.next_run > now:
+                    continue
+                job.schedule(now)
+                if job.leader_only and not self.leader.is_leader:
+                    continue
+                if job.running:
+                    job.skipped += 1
+                    continue
+                job.task = asyncio.create_task(self._execute(job))
+            now = beijing_now()
+            wait = min([(job.next_run - now).total_seconds() for job in self.jobs.values()]
+                       + [next_renew - time.monotonic()])
+            await asyncio.sleep(max(0.0, wait))
+
+    async def start(self):
+        if self._task is not None:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scheduler')
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=5):
+        """停止调度, 最多等待 timeout 秒让正在执行的任务结束, 然后放弃租约"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        running = [job.task for job in self.jobs.values() if job.running]
+        if running:
+            done, pending = await asyncio.wait(running, timeout=timeout)
+            if pending:
+                print(f"定时任务未结束: {[job.name for job in self.jobs.values() if job.running]}")
+        try:
+            await asyncio.to_thread(self.leader.release)
+        except Exception as e:
+            print(f"定时任务租约释放失败: {e!r}")
+        self._executor.shutdown(wait=False)
+        self._executor = None
+
+    def stats(self):
+        def moment(value):
+            return value.strftime('%Y-%m-%d %H:%M:%S') if value is not None else None
+        return {"leader": self.leader.is_leader, "owner": self.leader.owner,
+                "jobs": [{"name": job.name, "schedule": job.describe(), "leader_only": job.leader_only,
+                          "running": job.running, "runs": job.runs, "failures": job.failures,
+                          "timeouts": job.timeouts, "skipped": job.skipped, "last_start": moment(job.last_start),
+                          "last_seconds": job.last_seconds,
+                          "last_result": job.last_result if isinstance(job.last_result, (int, float, str)) else None,
+                          "last_error": job.last_error, "next_run": moment(job.next_run)}
+                         for job in self.jobs.values()]}
+
+
+"""
+数据库维护任务, 由调度器在线程中执行
+"""
+
+
+def wal_checkpoint(db):
+    """SQLite: 把 WAL 中已提交的页写回数据库文件, PASSIVE 模式不等待读写, 返回写回的页数; 其它数据库不处理
+       长时间有读取时自动 checkpoint 追不上写入, WAL 文件会一直变大, 定期执行一次
+    """
+    with db.engine.connect() as conn:
+        if conn.dialect.name != 'sqlite':
+            return None
+        busy, wal_pages, moved = conn.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)").one()
+        return moved
+
+
+def analyze(db):
+    """更新查询优化器的统计信息: SQLite 用 PRAGMA optimize, 只分析变化较大的表; 其它数据库 ANALYZE"""
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA optimize" if conn.dialect.name == 'sqlite' else "ANALYZE")
+        conn.commit()
+
+
+def vacuum(db, min_free_ratio=0.1):
+    """SQLite: 空闲页超过 min_free_ratio 时 VACUUM 整理数据库文件, 回收删除和归档留下的空间, 返回回收的页数;
+       VACUUM 期间阻塞写入, 只在低峰时段执行; PostgreSQL 由 autovacuum 处理, 这里不做
+    """
+    with db.engine.connect() as conn:
+        if conn.dialect.name != 'sqlite':
+            return None
+        free = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        total = conn.exec_driver_sql("PRAGMA page_count").scalar()
+        if not total or free < total * min_free_ratio:
+            return 0
+        conn.exec_driver_sql("VACUUM")
+        conn.commit()
+        return free
+
+
+def benchmark_scheduler(workers=3, seconds=6.0):
+    """workers 个调度器(模拟多个 worker 进程)共用一个数据库: 主节点任务只有一个在执行, 每个进程的任务都执行;
+       主节点停止后其它进程接手的耗时; 线程中执行的耗时任务对事件循环延迟的影响
+    """
+    import tempfile
+    from utils.databaseManager import Database
+
+    db = Database(f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}', echo=False)
+    db.create_tables()
+    runs = {}
+
+    def counter(key):
+        def job():
+            runs[key] = runs.get(key, 0) + 1
+        return job
+
+    def heavy():
+        # 纯 Python 计算也只占用调度器的线程, 事件循环照常调度(仍受 GIL 切换间隔影响)
+        begin = time.perf_counter()
+        while time.perf_counter() - begin < 0.5:
+            sum(range(1000))
+
+    async def main():
+        schedulers = []
+        for i in range(workers):
+            scheduler = Scheduler(db, lease=3)
+            scheduler.add('leader_job', counter(('leader', i)), interval=0.2, jitter=0.05)
+            scheduler.add('local_job', counter(('local', i)), interval=0.2, leader_only=False)
+            scheduler.add('heavy_job', heavy, interval=1, timeout=0.2)
+            schedulers.append(scheduler)
+            await scheduler.start()
+        loop = asyncio.get_running_loop()
+        worst = 0.0
+        begin = time.monotonic()
+        while time.monotonic() - begin < seconds / 2:
+            expected = loop.time() + 0.01
+            await asyncio.sleep(0.01)
+            worst = max(worst, loop.time() - expected)
+        leaders = [i for i, scheduler in enumerate(schedulers) if scheduler.leader.is_leader]
+        print(f"{workers} 个进程, 主节点 {leaders}; 主节点任务执行次数 "
+              f"{[runs.get(('leader', i), 0) for i in range(workers)]}, 每个进程的任务执行次数 "
+              f"{[runs.get(('local', i), 0) for i in range(workers)]}")
+        print(f"耗时任务在线程中执行期间, 事件循环最大延迟 {worst * 1000:.1f}ms, "
+              f"超时 {[scheduler.jobs['heavy_job'].timeouts for scheduler in schedulers]}")
+
+        # 主节点停止并放弃租约, 其余进程在下次续期(lease/3 秒内)接手
+        stopped = schedulers.pop(leaders[0])
+        await stopped.stop()
+        begin = time.monotonic()
+        while not any(scheduler.leader.is_leader for scheduler in schedulers):
+            await asyncio.sleep(0.01)
+        print(f"主节点停止后 {time.monotonic() - begin:.2f}s 由 "
+              f"{[scheduler.leader.owner for scheduler in schedulers if scheduler.leader.is_leader]} 接手")
+        for scheduler in schedulers:
+            await scheduler.stop()
+
+    asyncio.run(main())
+    cron = CronSchedule('30 3 * * 1-5')
+    moment = datetime(2024, 3, 1, 3, 30)  # 周五
+    print(f"cron '30 3 * * 1-5' 从 {moment} 起的下两次: {cron.next_after(moment)}, "
+          f"{cron.next_after(cron.next_after(moment))}")
+
+
+if __name__ == '__main__':
+    benchmark_scheduler()
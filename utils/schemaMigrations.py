@@ -0,0 +1,359 @@
+import asyncio
+import sys
+import time
+from contextlib import contextmanager
+from sqlalchemy import MetaData, case, inspect, select, text, update
+from sqlalchemy.schema import CreateTable
+from utils.databaseManager import Base, Database, Card, LoginLog, Order, ProdCag, ProdInfo, SchemaMigration, \
+    SchedulerLease, beijing_now
+from utils.scheduler import LeaderLease
+
+
+"""
+代码说明：
+数据库结构迁移，按版本号顺序执行 MIGRATIONS 中未执行过的迁移，执行完成的版本记录在 schema_migration 表。
+1. 每个迁移由若干步骤组成：CreateTables 建缺失的表，AddColumn 加列，CreateIndex 建索引，Backfill 回填数据，
+   RebuildTable 重建 SQLite 表，RunPython 执行任意函数。每一步都先检查是否已经完成，中途失败重启后可以从头重跑。
+2. Backfill 按主键顺序每批 batch_size 行、每批一个短事务，批与批之间按 duty 休眠(duty=0.5 即一半时间休眠)，
+   不会长时间占住 SQLite 的写锁；启动时 defer_backfills=True 只执行结构变更，回填交给后台 run_backfills 边服务边做，
+   回填完成后才记录这个迁移已执行。依赖回填数据的代码在回填完成前要能处理空值。
+3. RebuildTable 按 SQLite 官方的 12 步做法重建表：关闭外键检查，新建表、复制数据、删除旧表、改名、重建索引，
+   再检查外键；用于 ALTER TABLE 做不到的修改，例如给已有的列加外键约束。重建期间锁表，只在启动时、开始服务之前执行。
+4. dry_run 把数据库复制一份后在副本上执行全部未执行的迁移，报告每一步的耗时，回填按 duty 换算成在线执行的预计时长:
+   python -m utils.schemaMigrations database/database.db
+5. 多个进程同时启动时，upgrade 和记录迁移已执行都在 scheduler_lease 表的 schema_migration 租约内进行，拿不到租约的进程等待，
+   拿到后重新读取已执行的版本，不会重复执行结构变更或重复记录；持有者崩溃后租约到期由其它进程接手。
+   后台回填不持有租约，每批只更新仍符合条件的行，两个进程同时回填也不会出错，先完成的进程记录版本，另一个发现已记录后跳过。
+6. 新增迁移时在 MIGRATIONS 末尾追加，版本号递增，已经发布的迁移不要修改。
+"""
+
+
+class CreateTables:
+    """建立缺失的表, 已有的表不动"""
+
+    def describe(self):
+        return "建立缺失的表"
+
+    def apply(self, migrator):
+        existing = set(inspect(migrator.db.engine).get_table_names())
+        missing = [table for table in Base.metadata.sorted_tables if table.name not in existing]
+        Base.metadata.create_all(migrator.db.engine, tables=missing)
+
+
+class AddColumn:
+    """给已有的表加列, column 为模型上的列, 如 Order.state; 加列时不带外键和唯一约束, 需要时另外用 RebuildTable"""
+
+    def __init__(self, column):
+        self.column = column
+
+    def describe(self):
+        return f"{self.column.table.name} 新增列 {self.column.name}"
+
+    def apply(self, migrator):
+        engine, table = migrator.db.engine, self.column.table
+        if self.column.name in {column['name'] for column in inspect(engine).get_columns(table.name)}:
+            return
+        quote = engine.dialect.identifier_preparer.quote
+        column_type = self.column.type.compile(dialect=engine.dialect)
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(self.column.name)} {column_type}"))
+
+
+class CreateIndex:
+    """按名称建立模型上定义的索引, 已存在时跳过"""
+
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+
+    def describe(self):
+        return f"{self.table.name} 新建索引 {self.name}"
+
+    def apply(self, migrator):
+        index = next(index for index in self.table.indexes if index.name == self.name)
+        index.create(migrator.db.engine, checkfirst=True)
+
+
+class Backfill:
+    """分批回填: 每批取 where 条件下的 batch_size 个主键, UPDATE 这些行为 values, 直到没有符合条件的行
+       where / values 为返回 SQL 表达式的函数, 执行时才构造; 回填完成的行必须不再符合 where, 否则会重复处理
+    """
+
+    def __init__(self, model, where, values, batch_size=500, duty=0.5):
+        self.model = model
+        self.where = where
+        self.values = values
+        self.batch_size = batch_size
+        self.duty = duty
+
+    def describe(self):
+        return f"{self.model.__tablename__} 回填 {', '.join(self.values())}"
+
+    def apply(self, migrator):
+        model, engine = self.model, migrator.db.engine
+        done, after = 0, 0
+        while True:
+            begin = time.perf_counter()
+            with engine.begin() as conn:
+                ids = conn.execute(select(model.id).where(self.where(), model.id > after)
+                                   .order_by(model.id).limit(self.batch_size)).scalars().all()
+                if not ids:
+                    return done
+                conn.execute(update(model).where(model.id.in_(ids), self.where()).values(self.values()))
+            done += len(ids)
+            after = ids[-1]
+            migrator.progress[self.describe()] = done
+            if migrator.throttle:
+                time.sleep((time.perf_counter() - begin) * (1 / self.duty - 1))
+
+
+class RebuildTable:
+    """SQLite 重建表, 使表结构和模型一致; needed(inspector) 为 False 时跳过, 其它数据库只用 create_all 建表, 不需要重建"""
+
+    def __init__(self, model, needed, reason):
+        self.model = model
+        self.needed = needed
+        self.reason = reason
+
+    def describe(self):
+        return f"重建 {self.model.__tablename__}: {self.reason}"
+
+    def apply(self, migrator):
+        engine, table = migrator.db.engine, self.model.__table__
+        if engine.dialect.name != 'sqlite' or not self.needed(inspect(engine)):
+            return
+        # 新表放在一份完整的 MetaData 里, 外键引用的表才能解析
+        metadata = MetaData()
+        for other in Base.metadata.sorted_tables:
+            other.to_metadata(metadata)
+        rebuilt = table.to_metadata(metadata, name=f"_rebuild_{table.name}")
+        quote = engine.dialect.identifier_preparer.quote
+        with engine.connect() as conn:
+            foreign_keys = conn.exec_driver_sql("PRAGMA foreign_keys").scalar()
+            conn.exec_driver_sql("PRAGMA foreign_keys=OFF")  # 事务外才生效
+            conn.commit()
+            try:
+                with conn.begin():
+                    conn.exec_driver_sql("BEGIN IMMEDIATE")  # pysqlite 不会在 DDL 前开启事务, 显式开启, 整个重建要么都做要么都不做
+                    existing = {column['name'] for column in inspect(conn).get_columns(table.name)}
+                    columns = ', '.join(quote(column.name) for column in table.columns if column.name in existing)
+                    conn.execute(text(f"DROP TABLE IF EXISTS {quote(rebuilt.name)}"))
+                    conn.execute(CreateTable(rebuilt))
+                    rows = conn.execute(text(f"INSERT INTO {quote(rebuilt.name)} ({columns}) "
+                                             f"SELECT {columns} FROM {quote(table.name)}")).rowcount
+                    conn.execute(text(f"DROP TABLE {quote(table.name)}"))
+                    conn.execute(text(f"ALTER TABLE {quote(rebuilt.name)} RENAME TO {quote(table.name)}"))
+                    for index in table.indexes:
+                        index.create(conn)
+                    violations = conn.exec_driver_sql(f"PRAGMA foreign_key_check({quote(table.name)})").all()
+                    if violations:
+                        raise RuntimeError(f"{table.name} 有 {len(violations)} 行违反外键约束, 已回滚")
+            finally:
+                conn.exec_driver_sql(f"PRAGMA foreign_keys={foreign_keys}")
+                conn.commit()
+        return rows
+
+
+class RunPython:
+    def __init__(self, fn, description):
+        self.fn = fn
+        self.description = description
+
+    def describe(self):
+        return self.description
+
+    def apply(self, migrator):
+        return self.fn(migrator.db)
+
+
+class Migration:
+    def __init__(self, version: int, name: str, steps: list):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+
+def _prod_cag_fk_missing(inspector):
+    return not any(fk['referred_table'] == 'prod_cag' for fk in inspector.get_foreign_keys('prod_info'))
+
+
+# 版本 1-8 对应以前 upgrade_schema 自动补齐的列、索引和回填, 已经升级过的数据库执行时都会跳过
+MIGRATIONS = [
+    Migration(1, 'create_tables', [CreateTables()]),
+    Migration(2, 'login_log_user_event', [AddColumn(LoginLog.user_id), AddColumn(LoginLog.event),
+                                          CreateIndex(LoginLog.__table__, 'ix_login_log_updatetime')]),
+    Migration(3, 'order_state', [
+        AddColumn(Order.state),
+        Backfill(Order, lambda: Order.state.is_(None),
+                 lambda: {"state": case((Order.status == True, 'delivered'), else_='expired')}),
+        CreateIndex(Order.__table__, 'ix_order_state_updatetime')]),
+    Migration(4, 'order_user_history', [AddColumn(Order.user_id),
+                                        CreateIndex(Order.__table__, 'ix_order_user_updatetime'),
+                                        CreateIndex(Order.__table__, 'ix_order_contact_updatetime')]),
+    Migration(5, 'card_stock_index', [CreateIndex(Card.__table__, 'ix_card_prod_name_reuse_isused')]),
+    Migration(6, 'config_json', [RunPython(Database.migrate_config_json, "配置转换为 JSON")]),
+    Migration(7, 'prod_info_cag_id', [
+        AddColumn(ProdInfo.prod_cag_id),
+        Backfill(ProdInfo, lambda: ProdInfo.prod_cag_id.is_(None) & ProdInfo.prod_cag_name.in_(select(ProdCag.name)),
+                 lambda: {"prod_cag_id": select(ProdCag.id).where(ProdCag.name == ProdInfo.prod_cag_name).scalar_subquery()}),
+        CreateIndex(ProdInfo.__table__, 'ix_prod_info_cag_state')]),
+    Migration(8, 'prod_info_sales_index', [CreateIndex(ProdInfo.__table__, 'ix_prod_info_sales')]),
+    Migration(9, 'prod_info_cag_fk', [RebuildTable(ProdInfo, _prod_cag_fk_missing, "prod_cag_id 加外键约束")]),
+    Migration(10, 'scheduler_lease', [CreateTables()]),
+    Migration(11, 'prod_info_price_tiers', [AddColumn(ProdInfo.prod_price_tiers)]),
+    Migration(12, 'coupon', [CreateTables(), AddColumn(Order.coupon)]),
+    # 已有订单的 sales_counted 为空, 视为已计入, 不需要回填
+    Migration(13, 'order_sales_counted', [AddColumn(Order.sales_counted),
+                                          CreateIndex(Order.__table__, 'ix_order_sales_counted')]),
+    Migration(14, 'other_optional_json', [RunPython(Database.migrate_other_optional_json, "综合设置转换为 JSON")]),
+]
+
+# 订单归档库 (utils/orderArchive.py) 只有订单表, 订单表加列时在这里同样追加
+ARCHIVE_MIGRATIONS = [
+    Migration(1, 'archive_order', [RunPython(lambda db: Base.metadata.create_all(db.engine, tables=[Order.__table__]),
+                                             "建立订单表")]),
+    Migration(2, 'order_coupon', [AddColumn(Order.coupon)]),
+    Migration(3, 'order_sales_counted', [AddColumn(Order.sales_counted)]),
+]
+
+
+class SchemaMigrator:
+    """upgrade 方法执行未执行的迁移, defer_backfills 为 True 时回填留给 run_backfills 后台执行;
+       pending 方法返回未执行的迁移, stats 方法返回当前版本、未完成的版本、每一步的耗时和回填进度。
+    """
+
+    def __init__(self, db, migrations=MIGRATIONS, throttle=True, lease=300):
+        self.db = db
+        self.migrations = migrations
+        self.throttle = throttle  # 回填批与批之间是否休眠, dry_run 时关闭以测出实际耗时
+        self.report = []
+        self.progress = {}
+        self._deferred = []  # [(迁移, [回填步骤], 结构变更耗时)]
+        self._lease = LeaderLease(db, name='schema_migration', lease=lease, announce=False)
+
+    def applied(self) -> set:
+        SchemaMigration.__table__.create(self.db.engine, checkfirst=True)
+        with self.db.engine.connect() as conn:
+            return set(conn.execute(select(SchemaMigration.id)).scalars())
+
+    def pending(self) -> list:
+        applied = self.applied()
+        return [migration for migration in self.migrations if migration.version not in applied]
+
+    @contextmanager
+    def _locked(self):
+        """持有 schema_migration 租约期间执行, 其它进程持有时每秒重试; lease 秒内没有执行完的迁移会被其它进程接手"""
+        SchedulerLease.__table__.create(self.db.engine, checkfirst=True)
+        waited = False
+        while not self._lease.acquire():
+            if not waited:
+                print("数据库迁移: 其它进程正在迁移, 等待完成")
+                waited = True
+            time.sleep(1)
+        try:
+            yield
+        finally:
+            self._lease.release()
+
+    def _run_step(self, migration, step):
+        begin = time.perf_counter()
+        rows = step.apply(self)
+        seconds = time.perf_counter() - begin
+        self.report.append({"version": migration.version, "step": step.describe(), "rows": rows,
+                            "seconds": round(seconds, 3)})
+        return seconds
+
+    def _stamp(self, migration, seconds):
+        with self.db.engine.begin() as conn:
+            conn.execute(SchemaMigration.__table__.insert(), [{"id": migration.version, "name": migration.name,
+                                                                "seconds": round(seconds, 3), "updatetime": beijing_now()}])
+        print(f"数据库迁移: 版本 {migration.version} {migration.name} 完成, 耗时 {seconds:.2f}s")
+
+    def upgrade(self, defer_backfills=False) -> int:
+        """执行未执行的迁移, 返回完成的个数(回填留到后台的迁移不计入)"""
+        done = 0
+        with self._locked():
+            # 等到租约时其它进程可能已经执行过, 在租约内读取未执行的迁移
+            for migration in self.pending():
+                done += self._upgrade(migration, defer_backfills)
+        return done
+
+    def _upgrade(self, migration, defer_backfills) -> int:
+        seconds, backfills = 0.0, []
+        for step in migration.steps:
+            if defer_backfills and isinstance(step, Backfill):
+                backfills.append(step)
+                continue
+            seconds += self._run_step(migration, step)
+        if backfills:
+            self._deferred.append((migration, backfills, seconds))
+            return 0
+        self._stamp(migration, seconds)
+        return 1
+
+    def backfill_all(self) -> int:
+        """按版本顺序执行留到后台的回填, 每个迁移的回填完成后记录该迁移已执行; 其它进程已经记录的迁移不再回填和记录"""
+        done = 0
+        while self._deferred:
+            migration, backfills, seconds = self._deferred[0]
+            if migration.version not in self.applied():
+                for step in backfills:
+                    seconds += self._run_step(migration, step)
+                with self._locked():
+                    if migration.version not in self.applied():
+                        self._stamp(migration, seconds)
+                        done += 1
+            self._deferred.pop(0)
+        return done
+
+    async def run_backfills(self):
+        """后台协程: 执行留到后台的回填, 完成后结束"""
+        if not self._deferred:
+            return
+        try:
+            await asyncio.to_thread(self.backfill_all)
+        except Exception as e:
+            print(f"数据库迁移回填失败, 下次启动时继续: {e!r}")
+
+    def stats(self):
+        """version 为之前的版本全部完成的最高版本: 回填留到后台的版本未完成时, 之后的版本可能已经完成, 列在 applied_after_pending;
+           pending 列出全部未完成的版本, backfilling 为本进程正在后台回填的版本
+        """
+        applied = self.applied()
+        pending = [m for m in self.migrations if m.version not in applied]
+        version = min((m.version for m in pending), default=max(applied, default=0) + 1) - 1
+        return {"version": version, "latest": max(m.version for m in self.migrations),
+                "pending": [m.version for m in pending],
+                "pending_names": [f"{m.version} {m.name}" for m in pending],
+                "backfilling": [m.version for m, _, _ in self._deferred],
+                "applied_after_pending": sorted(v for v in applied if v > version),
+                "backfill_progress": dict(self.progress), "steps": list(self.report)}
+
+
+def dry_run(path='database/database.db'):
+    """在 SQLite 数据库的副本上执行全部未执行的迁移, 打印每一步的耗时, 原数据库不受影响"""
+    import os
+    import tempfile
+    from utils.readReplica import copy_sqlite
+
+    copy = os.path.join(tempfile.mkdtemp(), os.path.basename(path))
+    begin = time.perf_counter()
+    copy_sqlite(path, copy)
+    print(f"复制 {path} ({os.path.getsize(path) / 1e6:.1f}MB) 耗时 {time.perf_counter() - begin:.2f}s")
+    migrator = SchemaMigrator(Database(f'sqlite:///{copy}', echo=False), throttle=False)
+    pending = migrator.pending()
+    if not pending:
+        print("没有未执行的迁移")
+        return []
+    print(f"未执行的迁移: {', '.join(f'{m.version} {m.name}' for m in pending)}")
+    migrator.upgrade()
+    duties = {step.describe(): step.duty for m in pending for step in m.steps if isinstance(step, Backfill)}
+    for row in migrator.report:
+        online = f", 在线回填预计 {row['seconds'] / duties[row['step']]:.1f}s" if row['step'] in duties else ''
+        rows = f"{row['rows']} 行, " if row['rows'] is not None else ''
+        print(f"  {row['version']:>3} {row['step']}: {rows}{row['seconds']:.3f}s{online}")
+    return migrator.report
+
+
+if __name__ == '__main__':
+    dry_run(*sys.argv[1:])
@@ -1,28 +1,50 @@
-import ast
 import asyncio
+import json
 from utils.databaseManager import Notice, Database
+from utils.couponManager import CouponManager
+from utils.groupCommit import GroupCommitWriter
 from utils.databaseSchemas import NoticeResponse
+from utils.noticeManager import NoticeDispatcher
+from utils.orderManager import OrderManager
+from utils.paymentManager import PaymentGateway, PaymentRegistry
+from utils.schemaMigrations import SchemaMigrator
+from utils.salesCounter import SalesCounter, load_sales_statistics
 from utils.usersManager import init_user_tabel
 from utils.utils import EmailManager
 
 
 class SystemInit:
-    def __init__(self, database_url='sqlite:///database/database.db'):
+    def __init__(self, database_url='sqlite:///database/database.db', group_commit=False, replica_urls=()):
         self.database_url = database_url
+        self.replica_urls = replica_urls  # 只读副本, 查询类方法从副本读取
         self.db = self.init_database()
         self.email_manager = self.create_email_manager()
+        self.notice_dispatcher = NoticeDispatcher(self.db)
+        self.payment_registry = PaymentRegistry(self.db)
+        # group_commit 为 True 时下单、支付、发货的写操作合并提交, 下单并发高时开启
+        self.writer = GroupCommitWriter(self.db) if group_commit else None
+        # 综合设置 sales_statistics 为 1 时, 支付成功的订单自动计入商品销量
+        self.sales_counter = SalesCounter(self.db, enabled=load_sales_statistics(self.db))
+        self.coupon_manager = CouponManager(self.db)
+        self.order_manager = OrderManager(self.db, self.notice_dispatcher, payments=self.payment_registry,
+                                          writer=self.writer, coupons=self.coupon_manager)
+        self.payment_gateway = PaymentGateway(self.db, self.order_manager)
 
     def init_database(self):
         """
         数据库初始化
         """
         # 判断表是否存在
-        db = Database(self.database_url)
+        db = Database(self.database_url, replica_urls=self.replica_urls)
         table_names = db.table_names()
         print("数据库表名:", table_names)
+        self.schema_migrator = SchemaMigrator(db)
         if 'order' not in table_names:
-            db.create_tables()
+            self.schema_migrator.upgrade()
             db.create_example_data()
+        else:
+            # 已有数据库: 先执行结构变更, 数据回填在开始服务后由后台分批执行
+            self.schema_migrator.upgrade(defer_backfills=True)
         if 'user' not in table_names:
             # asyncio.run(init_user_tabel())
             asyncio.create_task(init_user_tabel())
@@ -33,7 +55,7 @@ class SystemInit:
         创建邮件管理器
         """
         email_param = self.db.search_data(Notice, NoticeResponse, [Notice.name == '邮箱通知'])
-        email_param = ast.literal_eval(email_param.config)
+        email_param = json.loads(email_param.config)
         email_manager = EmailManager(smtp_address=email_param['smtp_address'],
                                      sendmail=email_param['sendmail'],
                                      send_name=email_param['sendmail'],
@@ -6,6 +6,7 @@ from typing import Optional
 from typing import AsyncGenerator
 from fastapi import Depends, Request, Body
 from fastapi_users.exceptions import UserAlreadyExists
+from fastapi_users.jwt import generate_jwt
 from pydantic import BaseModel
 from sqlalchemy import Column, Float, Integer, DateTime
 from sqlalchemy.orm import DeclarativeBase
@@ -29,7 +30,7 @@ class User(SQLAlchemyBaseUserTableUUID, Base):
     money = Column(Float, default=0, nullable=False)
     numinvitpeople = Column(Integer, default=0, nullable=False)
     totalrebate = Column(Float, default=0, nullable=False)
-    updatetime = Column(DateTime, nullable=False, default=datetime.utcnow() + timedelta(hours=8))  # 存储当前时间
+    updatetime = Column(DateTime, nullable=False, default=lambda: datetime.utcnow() + timedelta(hours=8))  # 存储当前时间
 
 
 async def init_user_tabel():
@@ -67,6 +68,14 @@ async def get_user_db(session: AsyncSession = Depends(get_async_session)):
     yield SQLAlchemyUserDatabase(session, User)
 
 
+def audit(request: Optional[Request], user: User, event: str):
+    """把事件交给应用的审计日志管道, 没有请求上下文或未启用时忽略"""
+    audit_log = getattr(request.app.state, 'audit_log', None) if request is not None else None
+    if audit_log is not None:
+        ip = request.client.host if request.client else 'unknown'
+        audit_log.record(ip, str(user.id), event)
+
+
 class UserManager(UUIDIDMixin, BaseUserManager[User, uuid.UUID]):
     reset_password_token_secret = SECRET
     verification_token_secret = SECRET
@@ -80,6 +89,13 @@ class UserManager(UUIDIDMixin, BaseUserManager[User, uuid.UUID]):
             request（request，可选）：与注册相关联的请求。默认为“无”。
         """
         print(f"User {user.id} has registered.")
+        audit(request, user, 'register')
+
+    async def on_after_login(self, user: User, request: Optional[Request] = None, response=None):
+        """
+        登录成功后调用, 记录登录日志; 日志先进入内存队列, 由后台批量写入, 不阻塞登录。
+        """
+        audit(request, user, 'login')
 
     async def on_after_forgot_password(
             self, user: User, token: str, request: Optional[Request] = None
@@ -120,11 +136,22 @@ async def get_user_manager(user_db: SQLAlchemyUserDatabase = Depends(get_user_db
 bearer_transport = BearerTransport(tokenUrl="auth/jwt/login")
 
 
+class SuperuserClaimJWTStrategy(JWTStrategy):
+    """
+    签发的Token带有su声明（是否超级用户），准入控制（utils/rateLimiter.py）据此决定后台请求能否使用预留并发名额，不必查询数据库。
+    su只用于排队优先级，接口权限仍然按数据库中的用户判断；取消超级用户后，已签发的Token最多在有效期内保留优先级。
+    """
+
+    async def write_token(self, user: User) -> str:
+        data = {"sub": str(user.id), "aud": self.token_audience, "su": bool(user.is_superuser)}
+        return generate_jwt(data, self.encode_key, self.lifetime_seconds, algorithm=self.algorithm)
+
+
 def get_jwt_strategy() -> JWTStrategy:
     """
     返回一个JWTStrategy对象，该对象具有特定的机密和生存期（以秒为单位）。
     """
-    return JWTStrategy(secret=SECRET, lifetime_seconds=3600)
+    return SuperuserClaimJWTStrategy(secret=SECRET, lifetime_seconds=3600)
 
 
 auth_backend = AuthenticationBackend(
@@ -139,6 +166,7 @@ fastapi_users = FastAPIUsers[User, uuid.UUID](get_user_manager, [auth_backend])
 current_user = fastapi_users.current_user()
 # 获取当前用户（活跃）
 current_active_user = fastapi_users.current_user(active=True)
+current_optional_user = fastapi_users.current_user(active=True, optional=True)  # 游客也可访问, 未登录时为 None
 # 获取当前活跃且已验证的用户
 current_active_verified_user = fastapi_users.current_user(active=True, verified=True)
 # 获取当前活跃的超级用户